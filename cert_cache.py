@@ -0,0 +1,87 @@
+#!/usr/bin/env python
+
+# Copyright (c) 2015, Verisign, Inc.
+# All rights reserved.
+# 
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+# 
+# * Redistributions of source code must retain the above copyright notice, this
+#   list of conditions and the following disclaimer.
+# 
+# * Redistributions in binary form must reproduce the above copyright notice,
+#   this list of conditions and the following disclaimer in the documentation
+#   and/or other materials provided with the distribution.
+# 
+# * Neither the name of tlsa-survey nor the names of its
+#   contributors may be used to endorse or promote products derived from
+#   this software without specific prior written permission.
+# 
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+# SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+# OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+# Run-wide cache of fetched certificate chains, keyed by
+# (address, port, SNI name), the XMPP stream's to= name standing in for a
+# missing SNI name.  Failed fetches are cached too, for a shorter
+# time, so a dead host costs one timeout per run rather than one per name
+# pointing at it.  Concurrent requests for the same key wait for the first
+# fetch instead of running their own handshake.
+
+import time, threading, collections
+
+class CertCache(object):
+    def __init__(self, max_size=10000, ttl=21600, fail_ttl=600):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.fail_ttl = fail_ttl
+        self.lock = threading.Lock()
+        self.entries = collections.OrderedDict() # key -> (expire, value), LRU order
+        self.loading = {}                        # key -> threading.Event
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def fetch(self, key, load):
+        # load() returns the chain or None on failure
+        if self.max_size <= 0:
+            return load()
+        while True:
+            with self.lock:
+                e = self.entries.pop(key, None)
+                if e != None and e[0] > time.time():
+                    self.entries[key] = e
+                    self.hits += 1
+                    return e[1]
+                ev = self.loading.get(key)
+                if ev == None:
+                    ev = threading.Event()
+                    self.loading[key] = ev
+                    self.misses += 1
+                    break
+            ev.wait()
+        value = None
+        try:
+            value = load()
+        finally:
+            with self.lock:
+                ttl = self.ttl if value != None else self.fail_ttl
+                if ttl > 0:
+                    self.entries[key] = (time.time() + ttl, value)
+                    while len(self.entries) > self.max_size:
+                        self.entries.popitem(last=False)
+                        self.evictions += 1
+                del self.loading[key]
+            ev.set()
+        return value
+
+    def stats(self):
+        with self.lock:
+            return 'size[%d] hits[%d] misses[%d] evictions[%d]' % (len(self.entries), self.hits, self.misses, self.evictions)
@@ -0,0 +1,108 @@
+#!/usr/bin/env python
+
+# Copyright (c) 2015, Verisign, Inc.
+# All rights reserved.
+# 
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+# 
+# * Redistributions of source code must retain the above copyright notice, this
+#   list of conditions and the following disclaimer.
+# 
+# * Redistributions in binary form must reproduce the above copyright notice,
+#   this list of conditions and the following disclaimer in the documentation
+#   and/or other materials provided with the distribution.
+# 
+# * Neither the name of tlsa-survey nor the names of its
+#   contributors may be used to endorse or promote products derived from
+#   this software without specific prior written permission.
+# 
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+# SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+# OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+# TLSA association data of certificates, computed once per certificate.
+# Each DER certificate is parsed at most once and its full/SPKI x raw/SHA-256/SHA-512
+# values (selector 0/1, matching type 0/1/2) are kept, so checking a TLSA
+# RRset against a chain is a lookup per record.  Certificates are
+# memoized by the SHA-256 of their DER, which also saves the work for
+# intermediates shared by many servers.
+
+import hashlib, threading, collections
+import M2Crypto
+
+class CertDigests(object):
+    # selector 0 values are computed up front; selector 1 needs the DER
+    # parsed, which is only done when a TLSA record asks for it.  A
+    # certificate whose public key cannot be read matches no selector 1
+    # record instead of failing the target.
+    def __init__(self, der):
+        self.der = der
+        self.lock = threading.Lock()
+        self.data = {}
+        self.add(0, der)
+        self.spki = False       # not parsed yet, None if it failed
+
+    def add(self, selector, data):
+        self.data[(selector, 0)] = data
+        self.data[(selector, 1)] = hashlib.sha256(data).digest()
+        self.data[(selector, 2)] = hashlib.sha512(data).digest()
+
+    def digest(self, selector, mtype):
+        # None when the value cannot be computed
+        if selector == 1 and self.spki == False:
+            with self.lock:
+                if self.spki == False:
+                    try:
+                        spki = M2Crypto.X509.load_cert_der_string(self.der).get_pubkey().as_der()
+                        self.add(1, spki)
+                    except Exception:
+                        spki = None
+                    self.spki = spki
+        return self.data.get((selector, mtype))
+
+    def matches(self, selector, mtype, data):
+        return self.digest(selector, mtype) == data
+
+class DigestCache(object):
+    def __init__(self, max_size=10000):
+        self.max_size = max_size
+        self.lock = threading.Lock()
+        self.entries = collections.OrderedDict() # sha256(der) -> CertDigests, LRU order
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, der):
+        return self.fetch(hashlib.sha256(der).digest(), lambda: der)
+
+    def fetch(self, key, load):
+        # key is the SHA-256 of the DER, load() returns the DER on a miss
+        with self.lock:
+            d = self.entries.pop(key, None)
+            if d != None:
+                self.entries[key] = d
+                self.hits += 1
+                return d
+            self.misses += 1
+        d = CertDigests(load())
+        if self.max_size > 0:
+            with self.lock:
+                self.entries[key] = d
+                while len(self.entries) > self.max_size:
+                    self.entries.popitem(last=False)
+        return d
+
+    def chain(self, certs):
+        # list of DER certificates, leaf first
+        return [self.get(der) for der in certs]
+
+    def stats(self):
+        with self.lock:
+            return 'size[%d] hits[%d] misses[%d]' % (len(self.entries), self.hits, self.misses)
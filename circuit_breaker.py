@@ -0,0 +1,90 @@
+#!/usr/bin/env python
+
+# Copyright (c) 2015, Verisign, Inc.
+# All rights reserved.
+# 
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+# 
+# * Redistributions of source code must retain the above copyright notice, this
+#   list of conditions and the following disclaimer.
+# 
+# * Redistributions in binary form must reproduce the above copyright notice,
+#   this list of conditions and the following disclaimer in the documentation
+#   and/or other materials provided with the distribution.
+# 
+# * Neither the name of tlsa-survey nor the names of its
+#   contributors may be used to endorse or promote products derived from
+#   this software without specific prior written permission.
+# 
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+# SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+# OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+# Per-endpoint circuit breaker for certificate fetches.  Once an
+# (address, port) has timed out threshold times in a row its breaker opens
+# and further fetches to it fail at once instead of each waiting out the
+# full timeout; many names often share one dead mail host.  After cooldown
+# seconds one fetch is let through again, a success closes the breaker and
+# another timeout keeps it open for another cooldown.
+
+import time, threading
+
+class CircuitBreaker(object):
+    def __init__(self, threshold=3, cooldown=600):
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.lock = threading.Lock()
+        self.failures = {}  # key -> timeouts in a row
+        self.opened = {}    # key -> time the next fetch is let through
+        self.trips = 0
+        self.rejected = 0
+
+    def allow(self, key):
+        if self.threshold <= 0:
+            return True
+        with self.lock:
+            t = self.opened.get(key)
+            if t == None:
+                return True
+            now = time.time()
+            if now >= t:
+                self.opened[key] = now + self.cooldown
+                return True
+            self.rejected += 1
+            return False
+
+    def is_open(self, key):
+        with self.lock:
+            t = self.opened.get(key)
+            return t != None and time.time() < t
+
+    def success(self, key):
+        if self.threshold <= 0:
+            return
+        with self.lock:
+            self.failures.pop(key, None)
+            self.opened.pop(key, None)
+
+    def failure(self, key):
+        # a connect or handshake timeout
+        if self.threshold <= 0:
+            return
+        with self.lock:
+            n = self.failures.get(key, 0) + 1
+            self.failures[key] = n
+            if n >= self.threshold:
+                if not key in self.opened:
+                    self.trips += 1
+                self.opened[key] = time.time() + self.cooldown
+
+    def stats(self):
+        with self.lock:
+            return 'open[%d] trips[%d] rejected[%d]' % (len(self.opened), self.trips, self.rejected)
@@ -0,0 +1,203 @@
+#!/usr/bin/env python
+
+# Copyright (c) 2015, Verisign, Inc.
+# All rights reserved.
+# 
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+# 
+# * Redistributions of source code must retain the above copyright notice, this
+#   list of conditions and the following disclaimer.
+# 
+# * Redistributions in binary form must reproduce the above copyright notice,
+#   this list of conditions and the following disclaimer in the documentation
+#   and/or other materials provided with the distribution.
+# 
+# * Neither the name of tlsa-survey nor the names of its
+#   contributors may be used to endorse or promote products derived from
+#   this software without specific prior written permission.
+# 
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+# SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+# OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+# A single thread owns the sqlite3 connection and writes rows handed to it
+# through a bounded queue.  Rows are grouped per statement and written with
+# executemany inside one transaction per batch; a batch is flushed when it
+# holds batch_size rows or is flush_interval seconds old, and on close().
+# call(fn) runs fn in the writer thread once every row queued before it
+# is committed.
+#
+# A batch that hits a busy or locked database is retried.  If it still
+# cannot be written, or the thread dies for any other reason, the writer
+# stops: the batch is not counted, later call()s are never run (so the
+# journal does not mark lost rows done) and put(), call() and close()
+# raise DbWriterError instead of blocking on a queue nobody drains.
+
+import sys, time, threading, sqlite3
+import Queue
+
+def print_err(s):
+    sys.stderr.write(s)
+
+def create_tables(sqldb, table_name='tlsa_rdata'):
+    cur = sqldb.cursor()
+    sql_stat = "CREATE TABLE if not exists " + table_name + " (zone text, year int, month int, day int, timestamp, name text, port int, valid_info text, cert_usage int, selector int, mtype int, cert_info);"
+    cur.execute(sql_stat)
+    sql_stat = "CREATE UNIQUE INDEX if not exists " + table_name + "_uniq ON " + table_name + "(zone, year, month, day, timestamp, name, port, valid_info, cert_usage, selector, mtype, cert_info);"
+    cur.execute(sql_stat)
+    # input domains referencing an MX/SRV target that has TLSA records;
+    # the target itself is probed and written to table_name once a round
+    sql_stat = "CREATE TABLE if not exists " + table_name + "_target (zone text, year int, month int, day int, timestamp, domain text, name text, port int);"
+    cur.execute(sql_stat)
+    sql_stat = "CREATE UNIQUE INDEX if not exists " + table_name + "_target_uniq ON " + table_name + "_target(timestamp, domain, name, port);"
+    cur.execute(sql_stat)
+    # result of every probed address of a target
+    sql_stat = "CREATE TABLE if not exists " + table_name + "_addr (zone text, year int, month int, day int, timestamp, name text, port int, addr text, valid_info text);"
+    cur.execute(sql_stat)
+    sql_stat = "CREATE UNIQUE INDEX if not exists " + table_name + "_addr_uniq ON " + table_name + "_addr(timestamp, name, port, addr);"
+    cur.execute(sql_stat)
+    sqldb.commit()
+    cur.close()
+
+def create_chain_tables(sqldb, table_name='tlsa_rdata'):
+    # fetched chains, one row per distinct DER and one link per position of
+    # the sni (1) or non-SNI (0) chain of a tlsa_rdata target
+    cur = sqldb.cursor()
+    cur.execute("CREATE TABLE if not exists cert_der (hash text primary key, der blob);")
+    cur.execute("CREATE TABLE if not exists " + table_name + "_chain (zone text, year int, month int, day int, timestamp, name text, port int, sni int, position int, hash text);")
+    cur.execute("CREATE UNIQUE INDEX if not exists " + table_name + "_chain_uniq ON " + table_name + "_chain(timestamp, name, port, sni, position);")
+    sqldb.commit()
+    cur.close()
+
+def create_fetch_table(sqldb, table_name='tlsa_rdata'):
+    # when the chains of each target were last really fetched, for
+    # incremental surveys that carry results forward
+    cur = sqldb.cursor()
+    cur.execute("CREATE TABLE if not exists " + table_name + "_fetch (timestamp, name text, port int, fetched int);")
+    cur.execute("CREATE UNIQUE INDEX if not exists " + table_name + "_fetch_uniq ON " + table_name + "_fetch(timestamp, name, port);")
+    sqldb.commit()
+    cur.close()
+
+class DbWriterError(Exception):
+    pass
+
+class DbWriter(threading.Thread):
+    def __init__(self, sqldb, batch_size=500, flush_interval=1.0, max_queue=10000, metrics=None, retries=5):
+        threading.Thread.__init__(self)
+        self.setDaemon(True)
+        self.sqldb = sqldb
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.queue = Queue.Queue(max_queue)
+        self.metrics = metrics  # optional survey_metrics.Metrics
+        self.retries = retries
+        self.rows = 0
+        self.batches = 0
+        self.retried = 0
+        self.error = None       # why the writer stopped, if it failed
+
+    def enqueue(self, item):
+        # blocks when the writer falls behind, raises once it has failed
+        while True:
+            if self.error != None:
+                raise DbWriterError('db writer failed: %s' % self.error)
+            try:
+                self.queue.put(item, True, 1.0)
+                return
+            except Queue.Full:
+                pass
+
+    def put(self, sql, rows):
+        self.enqueue((sql, rows))
+
+    def call(self, fn):
+        self.enqueue(fn)
+
+    def close(self):
+        if self.error == None and self.is_alive():
+            self.enqueue(None)
+        self.join()
+        if self.error != None:
+            raise DbWriterError('db writer failed: %s' % self.error)
+
+    def flush(self, pending, num):
+        if num == 0:
+            return
+        start = time.time()
+        for attempt in range(self.retries + 1):
+            cur = self.sqldb.cursor()
+            try:
+                for sql, rows in pending:
+                    cur.executemany(sql, rows)
+                self.sqldb.commit()
+                break
+            except sqlite3.Error as e:
+                self.sqldb.rollback()
+                busy = isinstance(e, sqlite3.OperationalError) and ('locked' in str(e) or 'busy' in str(e))
+                if not busy or attempt == self.retries:
+                    raise DbWriterError('db write of %d rows failed: %s' % (num, str(e)))
+                self.retried += 1
+                print_err('[warn] db busy, retrying a write of %d rows: %s\n' % (num, str(e)))
+                time.sleep(0.1 * 2 ** attempt)
+            finally:
+                cur.close()
+        self.rows += num
+        self.batches += 1
+        if self.metrics != None:
+            self.metrics.observe('db_flush_seconds', time.time() - start)
+
+    def run(self):
+        try:
+            self.write_loop()
+        except BaseException as e:
+            self.error = str(e)
+            print_err('[error] db writer stopped, nothing after the last commit is written: %s\n' % self.error)
+
+    def write_loop(self):
+        pending = [] # [(sql, [rows])] in arrival order, one entry per statement
+        index = {}
+        num = 0
+        first = 0
+        while True:
+            wait = self.flush_interval
+            if num > 0:
+                wait = max(first + self.flush_interval - time.time(), 0)
+            try:
+                item = self.queue.get(True, wait)
+            except Queue.Empty:
+                item = ()
+            if item == None:
+                self.flush(pending, num)
+                return
+            if callable(item):
+                self.flush(pending, num)
+                pending = []
+                index = {}
+                num = 0
+                item()
+                continue
+            if item != ():
+                (sql, rows) = item
+                if num == 0:
+                    first = time.time()
+                if not sql in index:
+                    index[sql] = []
+                    pending.append((sql, index[sql]))
+                index[sql].extend(rows)
+                num += len(rows)
+            if num >= self.batch_size or (num > 0 and time.time() - first >= self.flush_interval):
+                self.flush(pending, num)
+                pending = []
+                index = {}
+                num = 0
+
+    def stats(self):
+        return 'rows[%d] batches[%d] retried[%d]' % (self.rows, self.batches, self.retried)
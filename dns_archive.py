@@ -0,0 +1,208 @@
+#!/usr/bin/env python
+
+# Copyright (c) 2015, Verisign, Inc.
+# All rights reserved.
+# 
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+# 
+# * Redistributions of source code must retain the above copyright notice, this
+#   list of conditions and the following disclaimer.
+# 
+# * Redistributions in binary form must reproduce the above copyright notice,
+#   this list of conditions and the following disclaimer in the documentation
+#   and/or other materials provided with the distribution.
+# 
+# * Neither the name of tlsa-survey nor the names of its
+#   contributors may be used to endorse or promote products derived from
+#   this software without specific prior written permission.
+# 
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+# SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+# OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+# Archive of the DNS responses a survey received, for --capture and
+# --replay.  The file is a sequence of records
+#
+#   >dBHHI  capture time, kind, rdtype, qname length, wire length
+#           qname, response in wire format
+#
+# after the magic 'TLSADNS2'; kind is RESPONSE (of any rcode), TIMEOUT or
+# ERROR (no wire data for the last two).  close() appends an index of
+# every record, 16 bytes each (64-bit hash of qname and rdtype, offset),
+# sorted like the signed_zones.py index, and a trailer with its offset, so
+# a replay binary-searches the mapped file instead of loading the keys;
+# an archive cut short by a crash is scanned and sorted in memory instead.
+# Sorting the index needs numpy (which comes with pyarrow).
+# Replayed lookups raise exactly what dns.resolver would have.
+
+import sys, struct, mmap, time, threading, hashlib
+import dns.message, dns.name, dns.rdatatype, dns.rdataclass, dns.rcode, dns.resolver
+
+MAGIC = 'TLSADNS2'
+RECORD = struct.Struct('>dBHHI')
+INDEX = struct.Struct('>QQ')
+TRAILER = struct.Struct('>Q8s')
+RESPONSE = 0
+TIMEOUT = 1
+ERROR = 2
+
+def archive_key(qname, rdtype):
+    return (str(qname).lower().rstrip('.') + '.', rdtype)
+
+def key_hash(qname, rdtype):
+    return struct.unpack('>Q', hashlib.md5('%s %d' % (qname, rdtype)).digest()[:8])[0]
+
+def load_numpy():
+    try:
+        import numpy
+    except ImportError:
+        raise ValueError('DNS archives need numpy')
+    return numpy
+
+def sort_index(np, entries):
+    # packed INDEX entries -> the same, sorted by hash then offset
+    a = np.frombuffer(bytes(entries), dtype=[('h', '>u8'), ('o', '>u8')]).copy()
+    a.sort(order=['h', 'o'])
+    return a.tostring()
+
+class ArchiveWriter(object):
+    def __init__(self, fn):
+        self.np = load_numpy()
+        self.f = open(fn, 'wb')
+        self.f.write(MAGIC)
+        self.offset = len(MAGIC)
+        self.lock = threading.Lock()
+        self.entries = bytearray()  # packed INDEX entries, in file order
+        self.records = 0
+
+    def add(self, qname, rdtype, kind, response=None):
+        (qname, rdtype) = archive_key(qname, dns.rdatatype.from_text(rdtype) if isinstance(rdtype, str) else rdtype)
+        wire = response.to_wire() if response != None else ''
+        data = RECORD.pack(time.time(), kind, rdtype, len(qname), len(wire)) + qname + wire
+        h = key_hash(qname, rdtype)
+        with self.lock:
+            if self.f == None:
+                return
+            self.entries += INDEX.pack(h, self.offset)
+            self.f.write(data)
+            self.offset += len(data)
+            self.records += 1
+
+    def close(self):
+        with self.lock:
+            index_offset = self.offset
+            self.f.write(sort_index(self.np, self.entries))
+            self.entries = bytearray()
+            self.f.write(TRAILER.pack(index_offset, MAGIC))
+            self.f.close()
+            self.f = None
+
+    def stats(self):
+        with self.lock:
+            return 'records[%d]' % self.records
+
+class Archive(object):
+    # read side, one or more archive files (e.g. one per --procs shard)
+    def __init__(self, fns):
+        self.np = load_numpy()
+        self.files = []     # (map, index, index base, entries), in --replay order
+        self.lock = threading.Lock()
+        self.entries = 0
+        self.hits = 0
+        self.misses = 0
+        for fn in fns:
+            self.load(fn)
+
+    def load(self, fn):
+        f = open(fn, 'rb')
+        m = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        f.close()
+        if m[:len(MAGIC)] != MAGIC:
+            raise ValueError('%s is not a DNS archive' % fn)
+        end = len(m)
+        pos = len(MAGIC)
+        if len(m) >= len(MAGIC) + TRAILER.size:
+            (index_offset, magic) = TRAILER.unpack_from(m, len(m) - TRAILER.size)
+            if magic == MAGIC and index_offset <= len(m) - TRAILER.size:
+                n = (len(m) - TRAILER.size - index_offset) // INDEX.size
+                self.files.append((m, m, index_offset, n))
+                self.entries += n
+                return
+        # no index, capture did not finish
+        sys.stderr.write('[warn] %s has no index, scanning it\n' % fn)
+        entries = bytearray()
+        while pos + RECORD.size <= end:
+            (t, kind, rdtype, n, w) = RECORD.unpack_from(m, pos)
+            if pos + RECORD.size + n + w > end:
+                break
+            qname = m[pos + RECORD.size:pos + RECORD.size + n]
+            entries += INDEX.pack(key_hash(qname, rdtype), pos)
+            pos += RECORD.size + n + w
+        n = len(entries) // INDEX.size
+        self.files.append((m, sort_index(self.np, entries), 0, n))
+        self.entries += n
+
+    def find(self, qname, rdtype):
+        # offset of the first record of (qname, rdtype): binary search for
+        # the hash, then check the records (in file order) for a collision
+        h = key_hash(qname, rdtype)
+        for (m, index, base, count) in self.files:
+            lo = 0
+            hi = count
+            while lo < hi:
+                mid = (lo + hi) // 2
+                if INDEX.unpack_from(index, base + mid * INDEX.size)[0] < h:
+                    lo = mid + 1
+                else:
+                    hi = mid
+            while lo < count:
+                (v, pos) = INDEX.unpack_from(index, base + lo * INDEX.size)
+                if v != h:
+                    break
+                (t, kind, t_rdtype, n, w) = RECORD.unpack_from(m, pos)
+                if t_rdtype == rdtype and m[pos + RECORD.size:pos + RECORD.size + n] == qname:
+                    return (m, pos)
+                lo += 1
+        return None
+
+    def query(self, qname, rdtype):
+        # like dns.resolver.Resolver.query; a name missing from the archive
+        # times out, nothing goes to the network
+        rdtype = dns.rdatatype.from_text(rdtype) if isinstance(rdtype, str) else rdtype
+        key = archive_key(qname, rdtype)
+        e = self.find(key[0], key[1])
+        with self.lock:
+            if e == None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        if e == None:
+            raise dns.resolver.Timeout()
+        (m, pos) = e
+        (t, kind, rdtype, n, w) = RECORD.unpack_from(m, pos)
+        if kind == TIMEOUT:
+            raise dns.resolver.Timeout()
+        if kind != RESPONSE:
+            raise dns.resolver.NoNameservers()
+        start = pos + RECORD.size + n
+        response = dns.message.from_wire(m[start:start + w])
+        name = dns.name.from_text(key[0])
+        if response.rcode() == dns.rcode.NXDOMAIN:
+            raise dns.resolver.NXDOMAIN(qnames=[name], responses={name: response})
+        if response.rcode() != dns.rcode.NOERROR:
+            # a SERVFAIL or REFUSED, raised as Resolver.query does
+            request = dns.message.make_query(name, rdtype, dns.rdataclass.IN)
+            raise dns.resolver.NoNameservers(request=request, errors=[('replay', False, 0, dns.rcode.to_text(response.rcode()), response)])
+        return dns.resolver.Answer(name, rdtype, dns.rdataclass.IN, response)
+
+    def stats(self):
+        with self.lock:
+            return 'entries[%d] hits[%d] misses[%d]' % (self.entries, self.hits, self.misses)
@@ -0,0 +1,114 @@
+#!/usr/bin/env python
+
+# Copyright (c) 2015, Verisign, Inc.
+# All rights reserved.
+# 
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+# 
+# * Redistributions of source code must retain the above copyright notice, this
+#   list of conditions and the following disclaimer.
+# 
+# * Redistributions in binary form must reproduce the above copyright notice,
+#   this list of conditions and the following disclaimer in the documentation
+#   and/or other materials provided with the distribution.
+# 
+# * Neither the name of tlsa-survey nor the names of its
+#   contributors may be used to endorse or promote products derived from
+#   this software without specific prior written permission.
+# 
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+# SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+# OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+# Run-wide DNS answer cache shared by every worker.  Positive answers are
+# kept until the Answer expires (smallest TTL in the RRset), NXDOMAIN and
+# NODATA answers are kept for the negative TTL taken from the SOA in the
+# authority section (RFC 2308); negative answers without an SOA are not
+# cached.  The number of entries is bounded, least recently used go first.
+
+import time, threading, collections
+import dns.name, dns.rdatatype
+
+NXDOMAIN = 'NXDOMAIN'
+NOANSWER = 'NOANSWER'
+
+def neg_ttl(response):
+    # RFC 2308 section 5: min of the SOA TTL and the SOA MINIMUM field
+    if response == None:
+        return None
+    for rrset in response.authority:
+        if rrset.rdtype == dns.rdatatype.SOA and len(rrset) > 0:
+            return min(rrset.ttl, rrset[0].minimum)
+    return None
+
+class DnsCache(object):
+    def __init__(self, max_size=100000, max_neg_ttl=3600):
+        self.max_size = max_size
+        self.max_neg_ttl = max_neg_ttl
+        self.lock = threading.Lock()
+        self.entries = collections.OrderedDict() # key -> (expire, answer or NXDOMAIN/NOANSWER)
+        self.hits = 0
+        self.neg_hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def key(self, qname, rdtype):
+        if isinstance(qname, dns.name.Name):
+            qname = qname.to_text()
+        if isinstance(rdtype, basestring):
+            rdtype = dns.rdatatype.from_text(rdtype)
+        qname = qname.lower()
+        if len(qname) > 1 and qname.endswith('.'):
+            qname = qname[:-1]
+        return (qname, rdtype)
+
+    def get(self, qname, rdtype):
+        # returns None on a miss, else an Answer, NXDOMAIN or NOANSWER
+        if self.max_size <= 0:
+            return None
+        k = self.key(qname, rdtype)
+        with self.lock:
+            e = self.entries.pop(k, None)
+            if e == None or e[0] <= time.time():
+                self.misses += 1
+                return None
+            self.entries[k] = e
+            if e[1] in (NXDOMAIN, NOANSWER):
+                self.neg_hits += 1
+            else:
+                self.hits += 1
+            return e[1]
+
+    def _put(self, k, expire, value):
+        with self.lock:
+            self.entries.pop(k, None)
+            self.entries[k] = (expire, value)
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+                self.evictions += 1
+
+    def put_answer(self, qname, rdtype, answer):
+        if self.max_size <= 0 or answer.expiration <= time.time():
+            return
+        self._put(self.key(qname, rdtype), answer.expiration, answer)
+
+    def put_negative(self, qname, rdtype, kind, response):
+        if self.max_size <= 0:
+            return
+        ttl = neg_ttl(response)
+        if ttl == None or ttl <= 0:
+            return
+        ttl = min(ttl, self.max_neg_ttl)
+        self._put(self.key(qname, rdtype), time.time() + ttl, kind)
+
+    def stats(self):
+        with self.lock:
+            return 'size[%d] hits[%d] neg_hits[%d] misses[%d] evictions[%d]' % (len(self.entries), self.hits, self.neg_hits, self.misses, self.evictions)
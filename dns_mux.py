@@ -0,0 +1,293 @@
+#!/usr/bin/env python
+
+# Copyright (c) 2015, Verisign, Inc.
+# All rights reserved.
+# 
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+# 
+# * Redistributions of source code must retain the above copyright notice, this
+#   list of conditions and the following disclaimer.
+# 
+# * Redistributions in binary form must reproduce the above copyright notice,
+#   this list of conditions and the following disclaimer in the documentation
+#   and/or other materials provided with the distribution.
+# 
+# * Neither the name of tlsa-survey nor the names of its
+#   contributors may be used to endorse or promote products derived from
+#   this software without specific prior written permission.
+# 
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+# SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+# OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+# A single-threaded DNS query multiplexer.  Queries are sent over a small
+# set of non-blocking UDP sockets and matched back by (socket, id), so one
+# event loop can keep thousands of queries in flight.  Each attempt goes to
+# a resolver picked from a resolver_pool.ResolverPool.  The timeout,
+# lifetime and TCP-fallback rules follow dns.resolver.Resolver.query so the
+# answers handed back are the same Answer objects send_query returns.
+# With a dns_stream.StreamTransport, queries go over its persistent TCP or
+# TLS connections instead of the UDP sockets.
+
+import socket, select, random, time, heapq, collections, threading
+import Queue
+import dns.message, dns.query, dns.rdatatype, dns.rdataclass, dns.rcode
+import dns.flags, dns.name, dns.resolver, dns.exception
+import dns_cache
+
+class _Query(object):
+    def __init__(self, qname, rdtype, callback):
+        self.qname = qname
+        self.rdtype = rdtype
+        self.callback = callback
+        self.request = None
+        self.key = None
+        self.server = None      # resolver_pool.Resolver of the current attempt
+        self.sent = 0
+        self.start = 0
+        self.deadline = 0
+        self.failures = 0
+        self.rcode = None       # of the last response, None if there was none
+
+class DnsMux(object):
+    def __init__(self, pool, timeout=5, lifetime=10, max_inflight=1000, num_socks=8, cache=None, stream=None):
+        self.pool = pool
+        self.cache = cache      # optional dns_cache.DnsCache
+        self.stream = stream    # optional dns_stream.StreamTransport
+        self.timeout = timeout
+        self.lifetime = lifetime
+        self.max_inflight = max_inflight
+        self.socks = []
+        self.family_socks = {}  # address family -> [sock index]
+        for af in set(socket.AF_INET6 if ':' in r.addr else socket.AF_INET for r in pool.resolvers):
+            self.family_socks[af] = []
+            for i in range(num_socks):
+                s = socket.socket(af, socket.SOCK_DGRAM)
+                s.setblocking(0)
+                try: # room for a burst of answers while the loop is busy
+                    s.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 1 << 20)
+                except socket.error:
+                    pass
+                self.family_socks[af].append(len(self.socks))
+                self.socks.append(s)
+        self.sock_ids = [set() for _ in self.socks]
+        self.next_sock = 0
+        self.inflight = {}      # (sock index, msg id) -> _Query
+        self.tcp_inflight = 0
+        self.backlog = collections.deque()
+        self.timers = []        # heap of (deadline, seq, key)
+        self.seq = 0
+        self.calls = Queue.Queue()  # callables posted from other threads
+
+    def submit(self, qname, rdtype, callback):
+        # callback(answer, rcode) is called from the loop thread, rcode is
+        # that of the last response (None if cached or none came), answer is a
+        # dns.resolver.Answer or None, exactly like send_query
+        if isinstance(qname, basestring):
+            qname = dns.name.from_text(qname)
+        if isinstance(rdtype, basestring):
+            rdtype = dns.rdatatype.from_text(rdtype)
+        if self.cache != None:
+            cached = self.cache.get(qname, rdtype)
+            if cached != None:
+                callback(None if isinstance(cached, str) else cached, None)
+                return
+        q = _Query(qname, rdtype, callback)
+        self.backlog.append(q)
+        self._fill()
+
+    def call_soon(self, fn):
+        # thread-safe, fn() runs in the loop thread
+        self.calls.put(fn)
+
+    def pending(self):
+        return len(self.inflight) + self.tcp_inflight + len(self.backlog)
+
+    def _fill(self):
+        while self.backlog and len(self.inflight) + self.tcp_inflight < self.max_inflight:
+            q = self.backlog.popleft()
+            if q.request == None:
+                q.start = time.time()
+                q.request = dns.message.make_query(q.qname, q.rdtype, dns.rdataclass.IN)
+            elif time.time() - q.start >= self.lifetime:
+                q.callback(None, q.rcode)
+                continue
+            if not self._send(q):
+                # every resolver is at its cap, wait for answers
+                self.backlog.appendleft(q)
+                return
+
+    def _send(self, q):
+        r = self.pool.acquire(block=False, exclude=q.server)
+        if r == None:
+            return False
+        q.server = r
+        if self.stream != None:
+            self._stream_send(q)
+            return True
+        socks = self.family_socks[socket.AF_INET6 if ':' in r.addr else socket.AF_INET]
+        idx = socks[self.next_sock % len(socks)]
+        self.next_sock += 1
+        ids = self.sock_ids[idx]
+        while True:
+            qid = random.randint(0, 65535)
+            if qid not in ids:
+                break
+        ids.add(qid)
+        q.request.id = qid
+        q.key = (idx, qid)
+        self.inflight[q.key] = q
+        q.sent = time.time()
+        q.deadline = min(q.sent + self.timeout, q.start + self.lifetime)
+        self.seq += 1
+        heapq.heappush(self.timers, (q.deadline, self.seq, q.key))
+        try:
+            self.socks[idx].sendto(q.request.to_wire(), (r.addr, r.port))
+        except socket.error:
+            pass # treated like a lost packet, the timer resends it
+        return True
+
+    def _release(self, q, ok):
+        del self.inflight[q.key]
+        self.sock_ids[q.key[0]].discard(q.key[1])
+        q.key = None
+        self.pool.release(q.server, time.time() - q.sent, ok)
+
+    def _finish(self, q, response):
+        answer = None
+        if response is not None:
+            q.rcode = response.rcode()
+        if response is not None and response.rcode() == dns.rcode.NOERROR:
+            try:
+                answer = dns.resolver.Answer(q.qname, q.rdtype, dns.rdataclass.IN, response)
+                if self.cache != None:
+                    self.cache.put_answer(q.qname, q.rdtype, answer)
+            except dns.resolver.NoAnswer:
+                if self.cache != None:
+                    self.cache.put_negative(q.qname, q.rdtype, dns_cache.NOANSWER, response)
+                answer = None
+        elif response is not None and response.rcode() == dns.rcode.NXDOMAIN:
+            if self.cache != None:
+                self.cache.put_negative(q.qname, q.rdtype, dns_cache.NXDOMAIN, response)
+        q.callback(answer, q.rcode)
+
+    def _retry(self, q):
+        # a failed attempt is retried once on another resolver, like
+        # Resolver.query moving on to its next nameserver
+        q.failures += 1
+        if q.failures < 2 and len(self.pool.resolvers) > 1:
+            self.backlog.appendleft(q)
+        else:
+            q.callback(None, q.rcode)
+
+    def _tcp_retry(self, q):
+        # truncated: retry over TCP in a helper thread so the loop never blocks
+        self.tcp_inflight += 1
+        remain = max(q.start + self.lifetime - time.time(), 0.1)
+        def run():
+            try:
+                response = dns.query.tcp(q.request, q.server.addr, remain, q.server.port)
+            except Exception:
+                response = None
+            def done():
+                self.tcp_inflight -= 1
+                self._finish(q, response)
+            self.call_soon(done)
+        t = threading.Thread(target=run)
+        t.setDaemon(True)
+        t.start()
+
+    def _stream_send(self, q):
+        self.tcp_inflight += 1
+        q.sent = time.time()
+        remain = max(q.start + self.lifetime - q.sent, 0.1)
+        def answered(response):
+            self.call_soon(lambda: self._stream_done(q, response))
+        self.stream.send(q.request, (q.server.addr, q.server.port), answered, min(self.timeout, remain))
+
+    def _stream_done(self, q, response):
+        # a stream is reliable, so unlike a lost UDP packet a timeout or a
+        # refused connection is not resent to the same resolver
+        self.tcp_inflight -= 1
+        if response is not None:
+            q.rcode = response.rcode()
+        ok = response is not None and q.rcode in (dns.rcode.NOERROR, dns.rcode.NXDOMAIN)
+        self.pool.release(q.server, time.time() - q.sent, ok)
+        if not ok:
+            self._retry(q)
+        else:
+            self._finish(q, response)
+
+    def _read(self, idx):
+        s = self.socks[idx]
+        while True:
+            try:
+                (wire, src) = s.recvfrom(65535)
+            except socket.error:
+                return
+            try:
+                response = dns.message.from_wire(wire)
+            except Exception:
+                continue
+            q = self.inflight.get((idx, response.id))
+            if q is None or src[0] != q.server.addr or src[1] != q.server.port:
+                continue
+            if not q.request.is_response(response):
+                continue
+            rcode = q.rcode = response.rcode()
+            if rcode != dns.rcode.NOERROR and rcode != dns.rcode.NXDOMAIN:
+                self._release(q, False)
+                self._retry(q)
+            elif response.flags & dns.flags.TC:
+                self._release(q, True)
+                self._tcp_retry(q)
+            else:
+                self._release(q, True)
+                self._finish(q, response)
+
+    def _expire(self):
+        now = time.time()
+        while self.timers and self.timers[0][0] <= now:
+            (deadline, seq, key) = heapq.heappop(self.timers)
+            q = self.inflight.get(key)
+            if q is None or q.deadline != deadline:
+                continue
+            self._release(q, False)
+            if now - q.start >= self.lifetime:
+                q.callback(None, q.rcode)
+            else:
+                self.backlog.appendleft(q)
+
+    def run_once(self, wait=0.1):
+        if self.timers:
+            wait = max(min(wait, self.timers[0][0] - time.time()), 0)
+        if self.inflight:
+            (rl, wl, xl) = select.select(self.socks, [], [], wait)
+            for s in rl:
+                self._read(self.socks.index(s))
+        elif wait > 0:
+            try:
+                fn = self.calls.get(True, wait)
+                fn()
+            except Queue.Empty:
+                pass
+        while True:
+            try:
+                fn = self.calls.get_nowait()
+            except Queue.Empty:
+                break
+            fn()
+        self._expire()
+        self._fill()
+
+    def close(self):
+        for s in self.socks:
+            s.close()
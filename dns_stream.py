@@ -0,0 +1,294 @@
+#!/usr/bin/env python
+
+# Copyright (c) 2015, Verisign, Inc.
+# All rights reserved.
+# 
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+# 
+# * Redistributions of source code must retain the above copyright notice, this
+#   list of conditions and the following disclaimer.
+# 
+# * Redistributions in binary form must reproduce the above copyright notice,
+#   this list of conditions and the following disclaimer in the documentation
+#   and/or other materials provided with the distribution.
+# 
+# * Neither the name of tlsa-survey nor the names of its
+#   contributors may be used to endorse or promote products derived from
+#   this software without specific prior written permission.
+# 
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+# SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+# OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+# Persistent DNS over TCP (RFC 7766) or TLS (RFC 7858) connections to the
+# resolvers.  A few connections are kept per resolver and many queries
+# are pipelined on each; answers are matched back by message id in
+# whatever order they arrive.  One I/O thread drives all connections with
+# non-blocking sockets, callers only queue requests, so the same transport
+# serves the worker threads (query) and the async engine (send).
+# Queries still unanswered when an established connection closes are sent
+# again on a new one until their deadline, as servers may close connections at any
+# time (RFC 7766, section 6.2.3).
+# TLS is opportunistic: the resolver's certificate is not verified.
+
+import os, socket, select, struct, random, time, threading, errno, ssl
+import dns.message, dns.rdataclass, dns.rdatatype, dns.rcode, dns.name
+import dns.resolver, dns.exception
+
+class _Request(object):
+    def __init__(self, request, callback, deadline):
+        self.request = request
+        self.callback = callback
+        self.deadline = deadline
+
+class _Conn(object):
+    def __init__(self, server, tls_ctx):
+        self.server = server
+        self.sock = socket.socket(socket.AF_INET6 if ':' in server[0] else socket.AF_INET, socket.SOCK_STREAM)
+        self.sock.setblocking(0)
+        self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.tls_ctx = tls_ctx
+        self.state = 'connect'  # connect, handshake, open, closed
+        self.established = False
+        self.want_write = True  # what the handshake waits for
+        self.out = ''
+        self.inbuf = ''
+        self.pending = {}       # msg id -> _Request
+        self.opened = time.time()
+        err = self.sock.connect_ex(server)
+        if err not in (0, errno.EINPROGRESS, errno.EWOULDBLOCK):
+            self.state = 'closed'
+
+    def wants_write(self):
+        if self.state == 'connect':
+            return True
+        if self.state == 'handshake':
+            return self.want_write
+        return self.state == 'open' and len(self.out) > 0
+
+    def wants_read(self):
+        if self.state == 'handshake':
+            return not self.want_write
+        return self.state == 'open'
+
+class StreamTransport(object):
+    def __init__(self, tls=False, conns=2, connect_timeout=5):
+        self.conns_per_server = conns
+        self.connect_timeout = connect_timeout
+        self.tls_ctx = None
+        if tls:
+            self.tls_ctx = ssl.SSLContext(ssl.PROTOCOL_SSLv23)
+            self.tls_ctx.check_hostname = False
+            self.tls_ctx.verify_mode = ssl.CERT_NONE
+        self.lock = threading.Lock()
+        self.conns = {}         # (addr, port) -> [_Conn]
+        self.next_conn = 0
+        (self.wake_r, self.wake_w) = os.pipe()
+        self.opened = 0
+        self.queries = 0
+        self.resent = 0
+        self.timeouts = 0
+        t = threading.Thread(target=self.run)
+        t.setDaemon(True)
+        t.start()
+
+    def send(self, request, server, callback, timeout):
+        # callback(response) runs in the I/O thread, response is a
+        # dns.message.Message or None on timeout or connection failure
+        with self.lock:
+            self.queries += 1
+            self._queue(_Request(request, callback, time.time() + timeout), server)
+        os.write(self.wake_w, 'x')
+
+    def query(self, qname, rdtype, server, timeout):
+        # blocking, raises like dns.resolver.Resolver.query
+        if isinstance(qname, basestring):
+            qname = dns.name.from_text(qname)
+        if isinstance(rdtype, basestring):
+            rdtype = dns.rdatatype.from_text(rdtype)
+        request = dns.message.make_query(qname, rdtype, dns.rdataclass.IN)
+        ev = threading.Event()
+        box = []
+        def done(response):
+            box.append(response)
+            ev.set()
+        self.send(request, server, done, timeout)
+        ev.wait()
+        response = box[0]
+        if response is None:
+            raise dns.resolver.Timeout
+        if response.rcode() == dns.rcode.NXDOMAIN:
+            raise dns.resolver.NXDOMAIN(qnames=[qname], responses={qname: response})
+        if response.rcode() != dns.rcode.NOERROR:
+            # as Resolver.query reports a SERVFAIL or REFUSED
+            raise dns.resolver.NoNameservers(request=request, errors=[(server[0], True, server[1], dns.rcode.to_text(response.rcode()), response)])
+        return dns.resolver.Answer(qname, rdtype, dns.rdataclass.IN, response)
+
+    def _queue(self, req, server):
+        # lock held; round robin over the server's connections, opening
+        # new ones up to conns_per_server
+        conns = self.conns.setdefault(server, [])
+        if len(conns) < self.conns_per_server:
+            c = _Conn(server, self.tls_ctx)
+            self.opened += 1
+            conns.append(c)
+        else:
+            self.next_conn += 1
+            c = conns[self.next_conn % len(conns)]
+        while True:
+            qid = random.randint(0, 65535)
+            if qid not in c.pending:
+                break
+        req.request.id = qid
+        c.pending[qid] = req
+        wire = req.request.to_wire()
+        c.out += struct.pack('!H', len(wire)) + wire
+
+    def _close(self, c, done):
+        # lock held; requests still waiting go on a new connection, unless
+        # this one never got up: the server is not reachable then
+        c.state = 'closed'
+        try:
+            c.sock.close()
+        except socket.error:
+            pass
+        conns = self.conns.get(c.server, [])
+        if c in conns:
+            conns.remove(c)
+        for req in c.pending.values():
+            if not c.established or req.deadline <= time.time():
+                self.timeouts += 1
+                done.append((req.callback, None))
+            else:
+                self.resent += 1
+                self._queue(req, c.server)
+        c.pending = {}
+
+    def _connected(self, c):
+        err = c.sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+        if err != 0:
+            return False
+        if c.tls_ctx == None:
+            c.state = 'open'
+            c.established = True
+            return True
+        c.sock = c.tls_ctx.wrap_socket(c.sock, do_handshake_on_connect=False)
+        c.state = 'handshake'
+        return self._handshake(c)
+
+    def _handshake(self, c):
+        try:
+            c.sock.do_handshake()
+        except ssl.SSLWantReadError:
+            c.want_write = False
+            return True
+        except ssl.SSLWantWriteError:
+            c.want_write = True
+            return True
+        except (ssl.SSLError, socket.error):
+            return False
+        c.state = 'open'
+        c.established = True
+        return True
+
+    def _write(self, c):
+        try:
+            n = c.sock.send(c.out)
+        except (ssl.SSLWantReadError, ssl.SSLWantWriteError):
+            return True
+        except (ssl.SSLError, socket.error) as e:
+            return getattr(e, 'errno', None) in (errno.EAGAIN, errno.EWOULDBLOCK)
+        c.out = c.out[n:]
+        return True
+
+    def _read(self, c, done):
+        while True:
+            try:
+                data = c.sock.recv(65535)
+            except (ssl.SSLWantReadError, ssl.SSLWantWriteError):
+                break
+            except (ssl.SSLError, socket.error) as e:
+                if getattr(e, 'errno', None) in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    break
+                return False
+            if data == '':
+                return False
+            c.inbuf += data
+        while len(c.inbuf) >= 2:
+            l = struct.unpack('!H', c.inbuf[:2])[0]
+            if len(c.inbuf) < 2 + l:
+                break
+            wire = c.inbuf[2:2 + l]
+            c.inbuf = c.inbuf[2 + l:]
+            try:
+                response = dns.message.from_wire(wire)
+            except Exception:
+                continue
+            req = c.pending.get(response.id)
+            if req == None or not req.request.is_response(response):
+                continue
+            del c.pending[response.id]
+            done.append((req.callback, response))
+        return True
+
+    def _expire(self, done):
+        now = time.time()
+        for conns in self.conns.values():
+            for c in list(conns):
+                if c.state in ('connect', 'handshake') and now - c.opened > self.connect_timeout:
+                    self._close(c, done)
+                    continue
+                for (qid, req) in c.pending.items():
+                    if req.deadline <= now:
+                        del c.pending[qid]
+                        self.timeouts += 1
+                        done.append((req.callback, None))
+
+    def run(self):
+        while True:
+            with self.lock:
+                conns = [c for cs in self.conns.values() for c in cs]
+                rl = [self.wake_r] + [c.sock for c in conns if c.wants_read()]
+                wl = [c.sock for c in conns if c.wants_write()]
+            try:
+                (rl, wl, xl) = select.select(rl, wl, [], 0.1)
+            except select.error:
+                continue
+            if self.wake_r in rl:
+                os.read(self.wake_r, 4096)
+            rl = set(rl)
+            wl = set(wl)
+            done = []
+            with self.lock:
+                for c in conns:
+                    if c.state == 'closed':
+                        self._close(c, done)
+                        continue
+                    ok = True
+                    if c.state == 'connect' and c.sock in wl:
+                        ok = self._connected(c)
+                    elif c.state == 'handshake' and (c.sock in rl or c.sock in wl):
+                        ok = self._handshake(c)
+                    elif c.state == 'open':
+                        if c.sock in wl:
+                            ok = self._write(c)
+                        # TLS may hold decrypted data select cannot see
+                        if ok and (c.sock in rl or (c.tls_ctx != None and c.sock.pending() > 0)):
+                            ok = self._read(c, done)
+                    if not ok:
+                        self._close(c, done)
+                self._expire(done)
+            for (callback, response) in done:
+                callback(response)
+
+    def stats(self):
+        with self.lock:
+            return 'connections[%d] opened[%d] queries[%d] resent[%d] timeouts[%d]' % (sum(len(cs) for cs in self.conns.values()), self.opened, self.queries, self.resent, self.timeouts)
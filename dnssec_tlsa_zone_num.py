@@ -28,7 +28,7 @@
 # OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
 # OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
 
-import sqlite3, getopt, datetime, os, sys, calendar, subprocess, bz2
+import sqlite3, getopt, datetime, os, sys, calendar, subprocess, bz2, itertools, multiprocessing
 from datetime import date, timedelta
 
 def print_err(s):
@@ -104,8 +104,72 @@ def usage(comm):
     print '\t -n  NUMBER        number of days, must be a positive integer'
     print '\t -z  SELECT ZONE   zone name, used as input prefix'
     print '\t                   process all zone in db if empty'
+    print '\t -j  NUMBER        days counted in parallel, default 1'
+    print '\t -H  HISTORY       read the per-day counts from a tlsa_history.py'
+    print '\t                   database instead of data/stats.DATE.db'
 
-def insert_zone_db(in_path, in_fn, date_text, num_days, zone):
+def cached_line_num(fn, line_cache, new_counts):
+    # line_cache: path -> (size, mtime, lines) as stored in the line_num table
+    st = os.stat(fn)
+    c = line_cache.get(fn)
+    if c != None and c[0] == st.st_size and c[1] == int(st.st_mtime):
+        return c[2]
+    n = get_line_num(fn)
+    new_counts.append((fn, st.st_size, int(st.st_mtime), n))
+    return n
+
+def count_day(job):
+    # zone_num rows for the day before select_date, one GROUP BY over that
+    # day's survey, or its tlsa_daily rollup in a tlsa_history.py database;
+    # may run in a worker process
+    (in_path, select_date, zone, line_cache, history) = job
+    dy_str_tmp, dm_str_tmp, dd_str_tmp = select_date.split('-')
+    dy_str_tmp_1, dm_str_tmp_1, dd_str_tmp_1 = str(get_date(int(dy_str_tmp), int(dm_str_tmp), int(dd_str_tmp), -1)).split('-')
+    if history != '':
+        conn = sqlite3.connect(history)
+        c = conn.cursor()
+        sql_stat = 'select zone, tlsa_name, tlsa_zone from tlsa_daily where year=? and month=? and day=?'
+        if zone == '':
+            c.execute(sql_stat, (int(dy_str_tmp), int(dm_str_tmp), int(dd_str_tmp)))
+        else:
+            c.execute(sql_stat + ' and zone=?', (int(dy_str_tmp), int(dm_str_tmp), int(dd_str_tmp), zone))
+        return count_rows(c, conn, in_path, zone, line_cache, dy_str_tmp_1, dm_str_tmp_1, dd_str_tmp_1)
+    conn = sqlite3.connect(in_path + '/data/stats.%s.db' % select_date)
+    conn.create_function('level2_zone', 1, get_zone)
+    c = conn.cursor()
+    base_select = 'select distinct name, port, zone from tlsa_rdata where year=%s and month=%s and day=%s' % (dy_str_tmp,
+                                                                                                              dm_str_tmp,
+                                                                                                              dd_str_tmp)
+    if zone == '':
+        sql_stat = 'select zone, count(*), count(distinct level2_zone(name)) from (%s) group by zone' % base_select
+        c.execute(sql_stat)
+    else:
+        sql_stat = 'select zone, count(*), count(distinct level2_zone(name)) from (%s) where zone=? group by zone' % base_select
+        c.execute(sql_stat, (zone,))
+    return count_rows(c, conn, in_path, zone, line_cache, dy_str_tmp_1, dm_str_tmp_1, dd_str_tmp_1)
+
+def count_rows(c, conn, in_path, zone, line_cache, dy_str_tmp_1, dm_str_tmp_1, dd_str_tmp_1):
+    # c holds (zone, tlsa_name, tlsa_zone) rows of one day
+    rows = []
+    new_counts = []
+    for (z, total_name, zc) in c.fetchall():
+        ds_name_file = in_path + '/input/' + z + '-signed-zones-' + dy_str_tmp_1 + dm_str_tmp_1 + dd_str_tmp_1 + '.bz2'
+        total_dnssec = -1 #-1 means files does not exist
+        if os.path.isfile(ds_name_file):
+            total_dnssec = cached_line_num(ds_name_file, line_cache, new_counts)
+        print_err('%s-%s-%s: zone[%s] tlsa_name[%d] tlsa_zone[%d] dnssec_zone[%d]\n' % (dy_str_tmp_1,
+                                                                                      dm_str_tmp_1,
+                                                                                      dd_str_tmp_1,
+                                                                                      z,
+                                                                                      total_name,
+                                                                                      zc,
+                                                                                      total_dnssec))
+        rows.append((z, int(dy_str_tmp_1), int(dm_str_tmp_1), int(dd_str_tmp_1), total_name, zc, total_dnssec))
+    c.close()
+    conn.close()
+    return (rows, new_counts)
+
+def insert_zone_db(in_path, in_fn, date_text, num_days, zone, jobs=1, history=''):
     sql_stat = ''
     if not os.path.isfile(in_fn):
         print_err('[warn] create %s\n' % in_fn)
@@ -119,75 +183,37 @@ def insert_zone_db(in_path, in_fn, date_text, num_days, zone):
 
     sqldb = sqlite3.connect(in_fn)
     sqldb_cur = sqldb.cursor()
+    # line counts of the signed-zones files, so reruns do not decompress them again
+    sqldb_cur.execute("CREATE TABLE if not exists line_num (path text primary key, size int, mtime int, lines int)")
+    line_cache = {}
+    for (path, size, mtime, lines) in sqldb_cur.execute('select path, size, mtime, lines from line_num'):
+        line_cache[path] = (size, mtime, lines)
 
     dy_str, dm_str, dd_str = date_text.split('-')
     dy = int(dy_str)
     dm = int(dm_str)
     dd = int(dd_str)        
-    total_name = 0
-    total_dnssec = 0
-    top_zone = {}
-    level2_zone = {}
-    tmp_lev2_zone = ''
-    tmp_top_zone = ''
-    for x in range(0, 1 + num_days):
-        select_date = str(get_date(dy, dm, dd, x))
-        select_date_1 = str(get_date(dy, dm, dd, x - 1))
-        dy_str_tmp, dm_str_tmp, dd_str_tmp = select_date.split('-')
-        dy_str_tmp_1, dm_str_tmp_1, dd_str_tmp_1 = select_date_1.split('-')
-        conn = sqlite3.connect(in_path + '/data/stats.%s.db' % select_date)
-        c = conn.cursor()
-        base_select = 'select distinct name, port, zone from tlsa_rdata where year=%s and month=%s and day=%s' % (dy_str_tmp,
-                                                                                                                  dm_str_tmp,
-                                                                                                                  dd_str_tmp)
-        if zone == '':
-            sql_stat = 'select distinct name from (%s)' % base_select
-        else:
-            sql_stat = 'select distinct name from (%s) where zone=\'%s\'' % (base_select, zone)
-        level2_zone.clear()
-        top_zone.clear()
-        c.execute(sql_stat)
-        for row in c:
-            n = row[0]
-            tmp_lev2_zone = get_zone(n)
-            tmp_top_zone = get_tld(n)
-            if not tmp_lev2_zone in level2_zone: #check uniq level 2 zone
-                level2_zone[tmp_lev2_zone] = 1
-                if not tmp_top_zone in top_zone:
-                    top_zone[tmp_top_zone] = 0
-                top_zone[tmp_top_zone] += 1 # count the total number of uniq TLSA enabled level 2 zone, based on gTLD
-        for z, zc in top_zone.iteritems():
-            sql_stat = 'select count(*) from (select distinct name, port from (%s) where zone=\'%s\')' % (base_select,z)
-            c.execute(sql_stat)
-            total_name = -1
-            total_name = c.fetchone()[0]
-            ds_name_file = in_path + '/input/' + z + '-signed-zones-' + dy_str_tmp_1 + dm_str_tmp_1 + dd_str_tmp_1 + '.bz2'
-            total_dnssec = -1 #-1 means files does not exist
-            if os.path.isfile(ds_name_file):
-                total_dnssec = get_line_num(ds_name_file)
-            print_err('%s: zone[%s] tlsa_name[%d] tlsa_zone[%d] dnssec_zone[%d]\n' % (select_date_1,
-                                                                                      z,
-                                                                                      total_name, 
-                                                                                      zc, 
-                                                                                      total_dnssec))
-            sqldb_cur.execute("INSERT INTO zone_num VALUES (\'%s\', %s, %s, %s, %d, %d, %d)" % (z,
-                                                                                                dy_str_tmp_1, 
-                                                                                                dm_str_tmp_1,
-                                                                                                dd_str_tmp_1,
-                                                                                                total_name, 
-                                                                                                zc, 
-                                                                                                total_dnssec))
-            sqldb.commit()
-
-        c.close()
-        conn.close()
+    days = [(in_path, str(get_date(dy, dm, dd, x)), zone, line_cache, history) for x in range(0, 1 + num_days)]
+    workers = None
+    if jobs > 1 and len(days) > 1:
+        workers = multiprocessing.Pool(jobs)
+        results = workers.imap(count_day, days)
+    else:
+        results = itertools.imap(count_day, days)
+    for (rows, new_counts) in results:
+        sqldb_cur.executemany('INSERT INTO zone_num VALUES (?, ?, ?, ?, ?, ?, ?)', rows)
+        sqldb_cur.executemany('INSERT OR REPLACE INTO line_num VALUES (?, ?, ?, ?)', new_counts)
+        sqldb.commit()
+    if workers != None:
+        workers.close()
+        workers.join()
     
     sqldb_cur.close()
     sqldb.close()
 
 def main():
     try:
-        opts, args = getopt.getopt(sys.argv[1:], 'hi:p:d:n:z:H:', ['help', 'input=', 'path=', 'date=', 'numdays=', 'zone='])
+        opts, args = getopt.getopt(sys.argv[1:], 'hi:p:d:n:z:j:H:', ['help', 'input=', 'path=', 'date=', 'numdays=', 'zone=', 'jobs=', 'history='])
     except getopt.GetoptError as err:
         print_err(str(err) + '\n')
         usage(sys.argv[0])
@@ -198,6 +224,8 @@ def main():
     action    = ''
     zone      = ''
     num_days  = -1
+    jobs      = 1
+    history   = ''
     for o, a in opts:
         if o in ('-h', '--help'):
             usage(sys.argv[0])
@@ -212,6 +240,10 @@ def main():
             zone = a
         elif o in ('-n', '--numdays'):
             num_days = int(a)
+        elif o in ('-j', '--jobs'):
+            jobs = int(a)
+        elif o in ('-H', '--history'):
+            history = a
 
     if date_text == '':
         usage(sys.argv[0])
@@ -233,7 +265,10 @@ def main():
         usage(sys.argv[0])
         sys.exit('[error] input file is empty, abort!')
 
-    insert_zone_db(in_path, in_fn, date_text, num_days, zone)
+    if history != '' and not os.path.isfile(history):
+        sys.exit('[error] history[%s] does not exist, abort!' % history)
+
+    insert_zone_db(in_path, in_fn, date_text, num_days, zone, jobs, history)
 
 if __name__ == "__main__":
     main()
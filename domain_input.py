@@ -0,0 +1,102 @@
+#!/usr/bin/env python
+
+# Copyright (c) 2015, Verisign, Inc.
+# All rights reserved.
+# 
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+# 
+# * Redistributions of source code must retain the above copyright notice, this
+#   list of conditions and the following disclaimer.
+# 
+# * Redistributions in binary form must reproduce the above copyright notice,
+#   this list of conditions and the following disclaimer in the documentation
+#   and/or other materials provided with the distribution.
+# 
+# * Neither the name of tlsa-survey nor the names of its
+#   contributors may be used to endorse or promote products derived from
+#   this software without specific prior written permission.
+# 
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+# SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+# OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+# Streaming input for the survey: plain, .bz2, .gz or .xz domain lists are
+# read line by line, and an optional Bloom filter drops repeated domains
+# in constant memory (a false positive drops a domain, see BloomFilter).
+
+import sys, bz2, gzip, hashlib, struct, math
+
+def open_input(fn):
+    if fn == '-':
+        return sys.stdin
+    if fn.endswith('.bz2'):
+        return bz2.BZ2File(fn, 'rb')
+    if fn.endswith('.gz'):
+        return gzip.open(fn, 'rb')
+    if fn.endswith('.xz'):
+        try:
+            import lzma
+        except ImportError:
+            try:
+                from backports import lzma
+            except ImportError:
+                sys.exit('[error] reading %s needs the lzma module (backports.lzma), abort!' % fn)
+        return lzma.open(fn, 'rb')
+    return open(fn, 'r')
+
+class BloomFilter(object):
+    # num_bits is rounded up to a multiple of 8; with n items the false
+    # positive rate is about (1 - exp(-k * n / m)) ** k
+    def __init__(self, num_bits, num_hashes=7):
+        self.num_bytes = (num_bits + 7) // 8
+        self.num_bits = self.num_bytes * 8
+        self.num_hashes = num_hashes
+        self.bits = bytearray(self.num_bytes)
+        self.added = 0
+
+    def add(self, s):
+        # returns True if s was (probably) already present
+        (h1, h2) = struct.unpack('<QQ', hashlib.md5(s).digest())
+        present = True
+        for i in range(self.num_hashes):
+            pos = (h1 + i * h2) % self.num_bits
+            mask = 1 << (pos & 7)
+            if not self.bits[pos >> 3] & mask:
+                present = False
+                self.bits[pos >> 3] |= mask
+        if not present:
+            self.added += 1
+        return present
+
+    def fp_rate(self):
+        return (1 - math.exp(-float(self.num_hashes) * self.added / self.num_bits)) ** self.num_hashes
+
+def shard_of(domain, num_shards):
+    # stable across processes, hosts and Python versions
+    domain = domain.lower().rstrip('.')
+    return struct.unpack('<Q', hashlib.md5(domain).digest()[:8])[0] % num_shards
+
+def read_domains(f, seen=None, shard=None):
+    # yields (line number, domain); seen is an optional BloomFilter,
+    # shard an optional (k, n) to keep only domains with shard_of() == k
+    lineno = 0
+    for l in f:
+        lineno += 1
+        if len(l) == 0 or l[0] == '#' or l == '\n':
+            continue
+        l = l.strip()
+        if len(l) == 0:
+            continue
+        if shard != None and shard_of(l, shard[1]) != shard[0]:
+            continue
+        if seen != None and seen.add(l.lower().rstrip('.')):
+            continue
+        yield (lineno, l)
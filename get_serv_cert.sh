@@ -31,7 +31,7 @@
 echoerr() { echo -e "$@" 1>&2; }
 usage() {
     #echoerr "[error] arguments are required"
-    echoerr "example: $0 -n google.com -p 443 [-s google.com] [-a] [-h 1.2.3.4] [-4] [-6]"
+    echoerr "example: $0 -n google.com -p 443 [-s google.com] [-a] [-h 1.2.3.4] [-t 20] [-4] [-6]"
 }
 cmd_exists () { type "$1" &> /dev/null; }
 
@@ -51,7 +51,7 @@ CONN_NAME=""
 SERV_NAME=""
 SHOW_CERTS=""
 HOST_IP=""
-while getopts ":n:p:s:h:a" opt; do
+while getopts ":n:p:s:h:t:a" opt; do
     case $opt in
 	n)
 	    CONN_NAME=$OPTARG
@@ -65,6 +65,9 @@ while getopts ":n:p:s:h:a" opt; do
 	h)
 	    HOST_IP=$OPTARG
 	    ;;
+	t)
+	    TIMEOUT_NUM=$OPTARG
+	    ;;
 	a)
 	    SHOW_CERTS="-showcerts"
 	    ;;
@@ -102,7 +105,10 @@ fi
 #echo "sni_ext   = $SNI_EXT"
 
 OPENSSL_COM=""
-if [ ! -z $HOST_IP ] ; then
+if [ ! -z $HOST_IP ] && [[ $HOST_IP == *:* ]] ; then
+    # IPv6 literal
+    OPENSSL_COM="openssl s_client -connect [$HOST_IP]:$PORT_NUM"
+elif [ ! -z $HOST_IP ] ; then
     OPENSSL_COM="openssl s_client -host $HOST_IP -port $PORT_NUM"
 else
     # must have CONN_NAME, get IPv4 only, otherwise with -connect $name:$port, 
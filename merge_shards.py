@@ -0,0 +1,88 @@
+#!/usr/bin/env python
+
+# Copyright (c) 2015, Verisign, Inc.
+# All rights reserved.
+# 
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+# 
+# * Redistributions of source code must retain the above copyright notice, this
+#   list of conditions and the following disclaimer.
+# 
+# * Redistributions in binary form must reproduce the above copyright notice,
+#   this list of conditions and the following disclaimer in the documentation
+#   and/or other materials provided with the distribution.
+# 
+# * Neither the name of tlsa-survey nor the names of its
+#   contributors may be used to endorse or promote products derived from
+#   this software without specific prior written permission.
+# 
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+# SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+# OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+# Merge per-shard survey databases (stats.<date>.<shard>.db) into the daily
+# database dnssec_tlsa_zone_num.py reads.  Rows already present are skipped
+# through the tables' unique indexes, so merging twice is harmless.
+
+import sys, os, getopt, sqlite3
+import db_writer
+
+def print_err(s):
+    sys.stderr.write(s)
+
+def merge_db(sqldb, shard_fns):
+    cur = sqldb.cursor()
+    tables = [row[0] for row in cur.execute("select name from sqlite_master where type='table'")]
+    for fn in shard_fns:
+        if not os.path.isfile(fn):
+            print_err('[warn] shard %s does not exist, skipped\n' % fn)
+            continue
+        cur.execute('ATTACH DATABASE ? AS shard', (fn,))
+        for (t,) in cur.execute("select name from shard.sqlite_master where type='table'").fetchall():
+            if not t in tables:
+                continue
+            cur.execute('INSERT OR IGNORE INTO main.%s SELECT * FROM shard.%s' % (t, t))
+            print_err('merged %s from %s: %d rows\n' % (t, fn, cur.rowcount))
+        sqldb.commit()
+        cur.execute('DETACH DATABASE shard')
+    cur.close()
+
+def usage(comm):
+    print 'usage: %s -o OUTPUT SHARD_DB...' % comm
+    print '\t -h           print this message'
+    print '\t -o  OUTPUT   merged database, created if needed'
+
+def main():
+    try:
+        opts, args = getopt.getopt(sys.argv[1:], 'ho:', ['help', 'output='])
+    except getopt.GetoptError as err:
+        print_err(str(err) + '\n')
+        usage(sys.argv[0])
+        sys.exit(1)
+    out_fn = ''
+    for o, a in opts:
+        if o in ('-h', '--help'):
+            usage(sys.argv[0])
+            sys.exit()
+        elif o in ('-o', '--output'):
+            out_fn = a
+    if out_fn == '' or len(args) == 0:
+        usage(sys.argv[0])
+        sys.exit(1)
+    sqldb = sqlite3.connect(out_fn)
+    db_writer.create_tables(sqldb)
+    db_writer.create_chain_tables(sqldb)
+    db_writer.create_fetch_table(sqldb)
+    merge_db(sqldb, args)
+    sqldb.close()
+
+if __name__ == "__main__":
+    main()
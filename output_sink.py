@@ -0,0 +1,193 @@
+#!/usr/bin/env python
+
+# Copyright (c) 2015, Verisign, Inc.
+# All rights reserved.
+# 
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+# 
+# * Redistributions of source code must retain the above copyright notice, this
+#   list of conditions and the following disclaimer.
+# 
+# * Redistributions in binary form must reproduce the above copyright notice,
+#   this list of conditions and the following disclaimer in the documentation
+#   and/or other materials provided with the distribution.
+# 
+# * Neither the name of tlsa-survey nor the names of its
+#   contributors may be used to endorse or promote products derived from
+#   this software without specific prior written permission.
+# 
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+# SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+# OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+# Output sinks for the tlsa_rdata rows of write_db.  The SQLite sink is the
+# survey db as always; the columnar sinks write Parquet or Arrow IPC files
+# under DIR/TABLE/date=YYYY-MM-DD/zone=TLD/, hive style, so a reader can
+# prune by date and TLD and scan months of rounds without opening a db per
+# day.  In those files cert_info is binary (cert_data), name and
+# valid_info are dictionary encoded and zone and the date live in the path.
+#
+# Columnar rows are buffered per partition and written as a new part file
+# once a partition has batch_size rows or max_bytes of data, once its
+# oldest row is max_age seconds old, on flush() and on close.  flush() is
+# called before each journal checkpoint, so no line is marked done while
+# its rows are only in memory.  Duplicate rows are dropped within a
+# partition's buffer, so memory stays bounded by the buffers.  A part file
+# only appears under its final name when it is complete, so the files of
+# an interrupted run are missing rather than broken.
+
+import os, time, threading
+
+class SqliteSink(object):
+    def __init__(self, writer, table_name):
+        self.writer = writer
+        self.sql = 'INSERT OR IGNORE INTO %s VALUES (?,?,?,?,?,?,?,?,?,?,?,?)' % table_name
+
+    def write(self, rows):
+        # duplicates hit the UNIQUE INDEX and are skipped, as the old rollback did
+        self.writer.put(self.sql, rows)
+
+    def flush(self):
+        # the rows are queued on the writer ahead of anything deferred to it
+        pass
+
+    def close(self):
+        pass
+
+    def stats(self):
+        return 'sqlite'
+
+class Partition(object):
+    # buffered rows of one date and zone
+    def __init__(self):
+        self.rows = []
+        self.seen = set()   # like the sqlite UNIQUE INDEX, for this buffer
+        self.bytes = 0
+        self.first = time.time()
+
+class ColumnarSink(object):
+    # fmt is parquet or arrow (IPC file format, which can be memory mapped)
+    def __init__(self, fmt, out_dir, table_name, batch_size=100000, compression='snappy', max_bytes=64 << 20, max_age=300.0):
+        try:
+            import pyarrow, pyarrow.parquet
+        except ImportError:
+            raise ValueError('the %s sink needs pyarrow' % fmt)
+        self.pa = pyarrow
+        self.pq = pyarrow.parquet
+        self.fmt = fmt
+        self.dir = os.path.join(out_dir, table_name)
+        self.batch_size = batch_size
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        self.compression = compression
+        self.lock = threading.Lock()
+        self.parts = {}     # (date, zone) -> Partition
+        self.last_sweep = time.time()
+        self.seq = 0
+        self.rows = 0
+        self.files = 0
+        self.schema = pyarrow.schema([
+            ('timestamp', pyarrow.int64()),
+            ('name', pyarrow.dictionary(pyarrow.int32(), pyarrow.string())),
+            ('port', pyarrow.int32()),
+            ('valid_info', pyarrow.dictionary(pyarrow.int32(), pyarrow.string())),
+            ('cert_usage', pyarrow.int8()),
+            ('selector', pyarrow.int8()),
+            ('mtype', pyarrow.int8()),
+            ('cert_data', pyarrow.binary())])
+
+    def write(self, rows):
+        # rows are tlsa_rdata rows: zone, year, month, day, timestamp, name,
+        # port, valid_info, cert_usage, selector, mtype, cert_info (hex)
+        full = []
+        now = time.time()
+        with self.lock:
+            for r in rows:
+                key = ('%04d-%02d-%02d' % (r[1], r[2], r[3]), r[0])
+                part = self.parts.get(key)
+                if part == None:
+                    part = self.parts[key] = Partition()
+                if r in part.seen:
+                    continue
+                part.seen.add(r)
+                part.rows.append(r)
+                part.bytes += len(r[5]) + len(r[7]) + len(r[11]) / 2 + 32
+                if len(part.rows) >= self.batch_size or part.bytes >= self.max_bytes:
+                    full.append((key, self.parts.pop(key).rows))
+            if now - self.last_sweep >= 1.0:
+                # partitions nothing was written to lately
+                self.last_sweep = now
+                for key in [k for k in self.parts if now - self.parts[k].first >= self.max_age]:
+                    full.append((key, self.parts.pop(key).rows))
+        for (key, part) in full:
+            self.write_part(key, part)
+
+    def flush(self):
+        # write out every buffered row, so the journal may mark its line done
+        with self.lock:
+            parts = [(key, part.rows) for (key, part) in self.parts.items()]
+            self.parts = {}
+        for (key, part) in sorted(parts):
+            self.write_part(key, part)
+
+    def close(self):
+        self.flush()
+
+    def table(self, part):
+        pa = self.pa
+        cols = zip(*part)
+        arrays = [pa.array(cols[4], pa.int64()),
+                  pa.array(cols[5], pa.string()).dictionary_encode(),
+                  pa.array(cols[6], pa.int32()),
+                  pa.array(cols[7], pa.string()).dictionary_encode(),
+                  pa.array(cols[8], pa.int8()),
+                  pa.array(cols[9], pa.int8()),
+                  pa.array(cols[10], pa.int8()),
+                  pa.array([ct.decode('hex') for ct in cols[11]], pa.binary())]
+        return pa.Table.from_arrays(arrays, schema=self.schema)
+
+    def write_part(self, key, part):
+        (date, zone) = key
+        d = os.path.join(self.dir, 'date=' + date, 'zone=' + (zone if zone else '_'))
+        with self.lock:
+            self.seq += 1
+            fn = os.path.join(d, 'part-%d-%d-%d.%s' % (part[0][4], os.getpid(), self.seq, self.fmt))
+        if not os.path.isdir(d):
+            try:
+                os.makedirs(d)
+            except OSError:
+                if not os.path.isdir(d):
+                    raise
+        table = self.table(part)
+        tmp = fn + '.tmp'
+        if self.fmt == 'parquet':
+            self.pq.write_table(table, tmp, compression=self.compression)
+        else:
+            w = self.pa.RecordBatchFileWriter(tmp, table.schema)
+            w.write_table(table)
+            w.close()
+        os.rename(tmp, fn)
+        with self.lock:
+            self.rows += len(part)
+            self.files += 1
+
+    def stats(self):
+        with self.lock:
+            return '%s[%s] rows[%d] files[%d]' % (self.fmt, self.dir, self.rows, self.files)
+
+def open_sink(spec, writer, table_name):
+    # spec is sqlite, parquet:DIR or arrow:DIR
+    if spec == 'sqlite':
+        return SqliteSink(writer, table_name)
+    (fmt, sep, out_dir) = spec.partition(':')
+    if fmt in ['parquet', 'arrow'] and out_dir != '':
+        return ColumnarSink(fmt, out_dir, table_name)
+    raise ValueError('unknown sink %s' % spec)
@@ -0,0 +1,91 @@
+#!/usr/bin/env python
+
+# Copyright (c) 2015, Verisign, Inc.
+# All rights reserved.
+# 
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+# 
+# * Redistributions of source code must retain the above copyright notice, this
+#   list of conditions and the following disclaimer.
+# 
+# * Redistributions in binary form must reproduce the above copyright notice,
+#   this list of conditions and the following disclaimer in the documentation
+#   and/or other materials provided with the distribution.
+# 
+# * Neither the name of tlsa-survey nor the names of its
+#   contributors may be used to endorse or promote products derived from
+#   this software without specific prior written permission.
+# 
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+# SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+# OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+# A stage of the pipeline engine: a pool of worker threads taking items
+# from a bounded queue.  put() blocks while the queue is full, so a slow
+# stage holds back the stages feeding it instead of letting its backlog
+# grow without bound.  Stages must form a chain without cycles or a full
+# queue could wait on itself.
+
+import sys, time, threading, Queue
+
+class Stage(object):
+    # handle(ctx, item) does the work, ctx = init(myid) is per worker
+    def __init__(self, name, workers, handle, max_queue=1000, init=None, metrics=None):
+        self.name = name
+        self.workers = workers
+        self.handle = handle
+        self.init = init
+        self.metrics = metrics  # optional survey_metrics.Metrics
+        self.queue = Queue.Queue(max_queue)
+        self.lock = threading.Lock()
+        self.busy = 0
+        self.done = 0
+        self.errors = 0
+        if metrics != None:
+            metrics.gauge(name + '_queue', self.queue.qsize)
+            metrics.gauge(name + '_busy', lambda: self.busy)
+
+    def start(self):
+        for i in range(self.workers):
+            t = threading.Thread(target=self.run, args=(i,))
+            t.setDaemon(True)
+            t.start()
+
+    def put(self, item):
+        self.queue.put(item)
+
+    def run(self, myid):
+        ctx = self.init(myid) if self.init != None else None
+        while True:
+            item = self.queue.get()
+            with self.lock:
+                self.busy += 1
+            start = time.time()
+            try:
+                self.handle(ctx, item)
+            except:
+                with self.lock:
+                    self.errors += 1
+                sys.stderr.write('[%s %d] error: %s\n' % (self.name, myid, sys.exc_info()))
+            if self.metrics != None:
+                self.metrics.observe('stage_seconds', time.time() - start, stage=self.name)
+            with self.lock:
+                self.busy -= 1
+                self.done += 1
+            self.queue.task_done()
+
+    def join(self):
+        # waits until every item put so far is handled
+        self.queue.join()
+
+    def stats(self):
+        with self.lock:
+            return '%s[workers=%d done=%d errors=%d queue=%d]' % (self.name, self.workers, self.done, self.errors, self.queue.qsize())
@@ -0,0 +1,91 @@
+#!/usr/bin/env python
+
+# Copyright (c) 2015, Verisign, Inc.
+# All rights reserved.
+# 
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+# 
+# * Redistributions of source code must retain the above copyright notice, this
+#   list of conditions and the following disclaimer.
+# 
+# * Redistributions in binary form must reproduce the above copyright notice,
+#   this list of conditions and the following disclaimer in the documentation
+#   and/or other materials provided with the distribution.
+# 
+# * Neither the name of tlsa-survey nor the names of its
+#   contributors may be used to endorse or promote products derived from
+#   this software without specific prior written permission.
+# 
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+# SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+# OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+# MX and SRV targets are often shared by thousands of domains.  Each
+# (target, port) is probed once a round by whichever domain claims it
+# first; the other domains only record that they reference it.  Domains
+# that come in while the probe is running are remembered and handed back
+# when it finishes, so the caller can write the domain -> target mapping
+# for targets that turned out to have TLSA records.  after(key, fn) runs
+# fn once the prober has called recorded(key), i.e. has handed every row
+# of the target to the writer, so a domain that only references a target
+# is not journaled done before the target is written.
+
+import threading
+
+class ProbeTargets(object):
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.state = {}     # (name, port) -> None while probing, then has TLSA
+        self.waiting = {}   # (name, port) -> [domain] while probing
+        self.recording = {} # (name, port) -> [fn] until its rows are written
+        self.probes = 0
+        self.shared = 0
+
+    def claim(self, key, domain):
+        # returns (probe, referrers): probe is True if the caller has to
+        # probe key and call done(); referrers are domains to map to key now
+        with self.lock:
+            if not key in self.state:
+                self.state[key] = None
+                self.waiting[key] = [domain]
+                self.recording[key] = []
+                self.probes += 1
+                return (True, [])
+            self.shared += 1
+            if self.state[key] == None:
+                self.waiting[key].append(domain)
+                return (False, [])
+            return (False, [domain] if self.state[key] else [])
+
+    def done(self, key, has_tlsa):
+        # returns the domains that referenced key so far, if it has TLSA
+        with self.lock:
+            self.state[key] = has_tlsa
+            referrers = self.waiting.pop(key)
+        return referrers if has_tlsa else []
+
+    def recorded(self, key):
+        # the prober wrote every row of key, even if done() was never reached
+        with self.lock:
+            fns = self.recording.pop(key, [])
+        for fn in fns:
+            fn()
+
+    def after(self, key, fn):
+        with self.lock:
+            if key in self.recording:
+                self.recording[key].append(fn)
+                return
+        fn()
+
+    def stats(self):
+        with self.lock:
+            return 'targets[%d] probes[%d] shared[%d]' % (len(self.state), self.probes, self.shared)
@@ -0,0 +1,110 @@
+#!/usr/bin/env python
+
+# Copyright (c) 2015, Verisign, Inc.
+# All rights reserved.
+# 
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+# 
+# * Redistributions of source code must retain the above copyright notice, this
+#   list of conditions and the following disclaimer.
+# 
+# * Redistributions in binary form must reproduce the above copyright notice,
+#   this list of conditions and the following disclaimer in the documentation
+#   and/or other materials provided with the distribution.
+# 
+# * Neither the name of tlsa-survey nor the names of its
+#   contributors may be used to endorse or promote products derived from
+#   this software without specific prior written permission.
+# 
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+# SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+# OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+# A pool of recursive resolvers shared by all workers.  Each resolver keeps
+# an exponentially weighted latency and error rate; queries go to the
+# better of two randomly picked healthy resolvers (weighted by how many
+# queries they already have outstanding), and no resolver gets more than
+# max_outstanding queries at once.  Every probe_every-th pick ignores
+# health so a resolver that recovered gets traffic again.
+
+import random, threading
+
+class Resolver(object):
+    def __init__(self, addr, port):
+        self.addr = addr
+        self.port = port
+        self.latency = 0.1      # EWMA, seconds
+        self.err_rate = 0.0     # EWMA of failures
+        self.outstanding = 0
+        self.queries = 0
+        self.errors = 0
+
+    def healthy(self):
+        return self.err_rate < 0.5
+
+    def score(self):
+        return self.latency * (self.outstanding + 1) * (1 + 10 * self.err_rate)
+
+class ResolverPool(object):
+    def __init__(self, servers, max_outstanding=64, alpha=0.1, probe_every=100):
+        # servers is a list of (addr, port)
+        self.resolvers = [Resolver(a, p) for (a, p) in servers]
+        self.max_outstanding = max_outstanding
+        self.alpha = alpha
+        self.probe_every = probe_every
+        self.picks = 0
+        self.cond = threading.Condition()
+
+    def pick(self):
+        # caller holds the lock, returns None when all are at the cap
+        free = [r for r in self.resolvers if r.outstanding < self.max_outstanding]
+        if len(free) == 0:
+            return None
+        self.picks += 1
+        healthy = [r for r in free if r.healthy()]
+        if len(healthy) == 0 or self.picks % self.probe_every == 0:
+            healthy = free
+        if len(healthy) == 1:
+            return healthy[0]
+        (a, b) = random.sample(healthy, 2)
+        return a if a.score() <= b.score() else b
+
+    def acquire(self, block=True, exclude=None):
+        with self.cond:
+            while True:
+                r = self.pick()
+                if r != None and r is exclude and len(self.resolvers) > 1:
+                    others = [x for x in self.resolvers if x is not exclude and x.outstanding < self.max_outstanding]
+                    if others:
+                        r = random.choice(others)
+                if r != None:
+                    r.outstanding += 1
+                    r.queries += 1
+                    return r
+                if not block:
+                    return None
+                self.cond.wait()
+
+    def release(self, r, latency, ok):
+        # ok is False for timeouts and server failures, NXDOMAIN is fine
+        with self.cond:
+            r.outstanding -= 1
+            if ok:
+                r.latency += self.alpha * (latency - r.latency)
+                r.err_rate -= self.alpha * r.err_rate
+            else:
+                r.errors += 1
+                r.err_rate += self.alpha * (1 - r.err_rate)
+            self.cond.notify()
+
+    def stats(self):
+        with self.cond:
+            return ' '.join('%s:%d[queries=%d errors=%d latency=%.3f]' % (r.addr, r.port, r.queries, r.errors, r.latency) for r in self.resolvers)
@@ -0,0 +1,191 @@
+#!/usr/bin/env python
+
+# Copyright (c) 2015, Verisign, Inc.
+# All rights reserved.
+# 
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+# 
+# * Redistributions of source code must retain the above copyright notice, this
+#   list of conditions and the following disclaimer.
+# 
+# * Redistributions in binary form must reproduce the above copyright notice,
+#   this list of conditions and the following disclaimer in the documentation
+#   and/or other materials provided with the distribution.
+# 
+# * Neither the name of tlsa-survey nor the names of its
+#   contributors may be used to endorse or promote products derived from
+#   this software without specific prior written permission.
+# 
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+# SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+# OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+# In-process replacement for get_serv_cert.sh: connect, do STARTTLS where
+# the protocol needs it, run the TLS handshake with M2Crypto and return the
+# certificate chain the server sent, as a list of DER strings.
+
+import sys, socket, ssl, getopt
+from M2Crypto import SSL
+
+CONNECT_TIMEOUT = 5
+STARTTLS_TIMEOUT = 10
+HANDSHAKE_TIMEOUT = 10
+
+SMTP_PORTS = [25, 587]
+XMPP_PORTS = {5222: 'jabber:client', 5269: 'jabber:server'}
+EHLO_NAME = socket.getfqdn()
+
+class CertFetchError(Exception):
+    # stage is one of connect, starttls, handshake
+    # reason is timeout or error
+    def __init__(self, stage, reason, msg=''):
+        Exception.__init__(self, '%s %s %s' % (stage, reason, msg))
+        self.stage = stage
+        self.reason = reason
+
+def print_err(s):
+    sys.stderr.write(s)
+
+class LineReader(object):
+    def __init__(self, sock):
+        self.sock = sock
+        self.buf = ''
+
+    def recv(self):
+        data = self.sock.recv(4096)
+        if len(data) == 0:
+            raise socket.error('connection closed')
+        self.buf += data
+
+    def readline(self):
+        while not '\n' in self.buf:
+            self.recv()
+        (line, self.buf) = self.buf.split('\n', 1)
+        return line.rstrip('\r')
+
+    def read_until(self, marks):
+        while True:
+            for m in marks:
+                if m in self.buf:
+                    return m
+            self.recv()
+
+def smtp_reply(rd):
+    # multi-line replies are "250-..." up to the last "250 ..."
+    while True:
+        line = rd.readline()
+        if len(line) < 4 or line[3] != '-':
+            return line[:3]
+
+def smtp_starttls(sock):
+    rd = LineReader(sock)
+    if smtp_reply(rd) != '220':
+        raise socket.error('no SMTP greeting')
+    sock.sendall('EHLO %s\r\n' % EHLO_NAME)
+    if smtp_reply(rd) != '250':
+        raise socket.error('EHLO refused')
+    sock.sendall('STARTTLS\r\n')
+    if smtp_reply(rd) != '220':
+        raise socket.error('STARTTLS refused')
+
+def xmpp_starttls(sock, domain, ns):
+    rd = LineReader(sock)
+    sock.sendall("<?xml version='1.0'?><stream:stream to='%s' xmlns='%s' "
+                 "xmlns:stream='http://etherx.jabber.org/streams' version='1.0'>" % (domain, ns))
+    rd.read_until(['</stream:features>', '<stream:error'])
+    if not 'urn:ietf:params:xml:ns:xmpp-tls' in rd.buf:
+        raise socket.error('STARTTLS not offered')
+    rd.buf = ''
+    sock.sendall("<starttls xmlns='urn:ietf:params:xml:ns:xmpp-tls'/>")
+    if rd.read_until(['<proceed', '<failure', '<stream:error']) != '<proceed':
+        raise socket.error('STARTTLS refused')
+
+def tls_handshake(sock, sni, timeout):
+    ctx = SSL.Context('sslv23')
+    ctx.set_verify(SSL.verify_none, 0)
+    conn = SSL.Connection(ctx, sock=sock)
+    timeo = SSL.timeout(int(timeout), int((timeout % 1) * 1000000))
+    conn.set_socket_read_timeout(timeo)
+    conn.set_socket_write_timeout(timeo)
+    if sni != '':
+        conn.set_tlsext_host_name(sni)
+    conn.setup_ssl()
+    conn.set_connect_state()
+    if conn.connect_ssl() != 1:
+        # SO_RCVTIMEO expired, OpenSSL reports it as a retryable read
+        raise socket.timeout('handshake timed out')
+    chain = conn.get_peer_cert_chain()
+    certs = []
+    if chain != None:
+        for cert in chain:
+            certs.append(cert.as_der())
+    return certs
+
+def get_serv_cert(addr, port, name, sni='',
+                  connect_timeout=CONNECT_TIMEOUT,
+                  starttls_timeout=STARTTLS_TIMEOUT,
+                  handshake_timeout=HANDSHAKE_TIMEOUT,
+                  connect_port=None):
+    # name is used for the XMPP stream header, sni may be empty; port picks
+    # the protocol, connect_port (default port) is where to connect
+    stage = 'connect'
+    sock = None
+    try:
+        sock = socket.create_connection((addr, connect_port if connect_port != None else port), connect_timeout)
+        stage = 'starttls'
+        sock.settimeout(starttls_timeout)
+        if port in SMTP_PORTS:
+            smtp_starttls(sock)
+        elif port in XMPP_PORTS:
+            xmpp_starttls(sock, sni if sni != '' else name, XMPP_PORTS[port])
+        # M2Crypto does blocking I/O on the fd, timeouts go through SO_RCVTIMEO
+        stage = 'handshake'
+        sock.settimeout(None)
+        return tls_handshake(sock, sni, handshake_timeout)
+    except socket.timeout as e:
+        raise CertFetchError(stage, 'timeout', str(e))
+    except (socket.error, SSL.SSLError) as e:
+        raise CertFetchError(stage, 'error', str(e))
+    finally:
+        if sock != None:
+            sock.close()
+
+def usage(comm):
+    print 'usage: %s -h IP -p PORT [-n NAME] [-s SNI]' % comm
+
+def main():
+    try:
+        opts, args = getopt.getopt(sys.argv[1:], 'h:p:n:s:', ['host=', 'port=', 'name=', 'sni='])
+    except getopt.GetoptError as err:
+        print_err(str(err) + '\n')
+        usage(sys.argv[0])
+        sys.exit(1)
+    addr = ''
+    port = 0
+    name = ''
+    sni = ''
+    for o, a in opts:
+        if o in ('-h', '--host'):
+            addr = a
+        elif o in ('-p', '--port'):
+            port = int(a)
+        elif o in ('-n', '--name'):
+            name = a
+        elif o in ('-s', '--sni'):
+            sni = a
+    if addr == '' or port == 0:
+        usage(sys.argv[0])
+        sys.exit(1)
+    for der in get_serv_cert(addr, port, name if name != '' else addr, sni):
+        sys.stdout.write(ssl.DER_cert_to_PEM_cert(der))
+
+if __name__ == "__main__":
+    main()
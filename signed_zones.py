@@ -0,0 +1,180 @@
+#!/usr/bin/env python
+
+# Copyright (c) 2015, Verisign, Inc.
+# All rights reserved.
+# 
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+# 
+# * Redistributions of source code must retain the above copyright notice, this
+#   list of conditions and the following disclaimer.
+# 
+# * Redistributions in binary form must reproduce the above copyright notice,
+#   this list of conditions and the following disclaimer in the documentation
+#   and/or other materials provided with the distribution.
+# 
+# * Neither the name of tlsa-survey nor the names of its
+#   contributors may be used to endorse or promote products derived from
+#   this software without specific prior written permission.
+# 
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+# SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+# OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+# Membership index of DNSSEC-signed zones, built from the per-TLD
+# input/<tld>-signed-zones-YYYYMMDD.bz2 lists that dnssec_tlsa_zone_num.py
+# counts.  The index file holds the covered TLDs and the sorted 64-bit
+# hashes of every zone name, 8 bytes per zone; it is built once a day and
+# memory-mapped by the survey, lookups are a binary search over the map.
+#
+#   usage: signed_zones.py -p PATH -d YYYY-MM-DD -o INDEX
+
+import sys, os, glob, getopt, mmap, struct, hashlib, array, bz2, datetime
+
+MAGIC = 'TLSASZ01'
+
+def print_err(s):
+    sys.stderr.write(s)
+
+def zone_hash(name):
+    name = name.lower().rstrip('.')
+    return struct.unpack('<Q', hashlib.md5(name).digest()[:8])[0]
+
+def hash_array():
+    for code in ['L', 'Q']:
+        try:
+            if array.array(code).itemsize == 8:
+                return array.array(code)
+        except ValueError:
+            pass
+    sys.exit('[error] no 64-bit array type, abort!')
+
+def build_index(in_path, date_text, out_fn):
+    # in_path is the directory holding input/, date_text the date in the
+    # signed-zones file names
+    try:
+        import numpy
+    except ImportError:
+        sys.exit('[error] building the index needs numpy, abort!')
+    ymd = date_text.replace('-', '')
+    files = sorted(glob.glob(os.path.join(in_path, 'input', '*-signed-zones-%s.bz2' % ymd)))
+    if len(files) == 0:
+        sys.exit('[error] no signed-zones files for %s in %s/input, abort!' % (ymd, in_path))
+    tlds = []
+    hashes = hash_array()
+    for fn in files:
+        tlds.append(os.path.basename(fn).split('-signed-zones-')[0].lower())
+        f = bz2.BZ2File(fn, 'rb')
+        try:
+            for l in f:
+                l = l.strip()
+                if len(l) == 0 or l[0] == '#':
+                    continue
+                hashes.append(zone_hash(l))
+        finally:
+            f.close()
+        print_err('%s: %d zones\n' % (fn, len(hashes)))
+    # array has no sort(), numpy sorts and dedups the buffer in place of it
+    hashes = numpy.unique(numpy.frombuffer(hashes, dtype=numpy.uint64))
+    head = ','.join(tlds)
+    head += ' ' * (-len(head) % 8)
+    tmp_fn = out_fn + '.tmp'
+    with open(tmp_fn, 'wb') as f:
+        f.write(MAGIC)
+        f.write(struct.pack('<QQ', len(hashes), len(head)))
+        f.write(head)
+        f.write(hashes.tostring())
+    os.rename(tmp_fn, out_fn)
+    return len(hashes)
+
+class SignedZones(object):
+    def __init__(self, fn):
+        self.f = open(fn, 'rb')
+        self.map = mmap.mmap(self.f.fileno(), 0, access=mmap.ACCESS_READ)
+        if self.map[:8] != MAGIC:
+            sys.exit('[error] %s is not a signed zone index, abort!' % fn)
+        (self.count, head_len) = struct.unpack_from('<QQ', self.map, 8)
+        self.tlds = set(x for x in self.map[24:24 + head_len].strip().split(',') if x != '')
+        self.base = 24 + head_len
+        self.fmt = '=Q'
+
+    def covers(self, name):
+        # True if name's TLD has a signed-zones list in the index
+        return name.lower().rstrip('.').rsplit('.', 1)[-1] in self.tlds
+
+    def __contains__(self, name):
+        h = zone_hash(name)
+        lo = 0
+        hi = self.count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            v = struct.unpack_from(self.fmt, self.map, self.base + mid * 8)[0]
+            if v < h:
+                lo = mid + 1
+            elif v > h:
+                hi = mid
+            else:
+                return True
+        return False
+
+    def maybe_signed(self, name):
+        # False only if name's TLD is covered and none of its parent zones
+        # (below the TLD) is in the list
+        if not self.covers(name):
+            return True
+        w = name.lower().rstrip('.').split('.')
+        for i in range(len(w) - 1):
+            if '.'.join(w[i:]) in self:
+                return True
+        return False
+
+    def close(self):
+        self.map.close()
+        self.f.close()
+
+def usage(comm):
+    print 'usage: %s [-hpdo]' % comm
+    print '\t -h                print this message'
+    print '\t -p  INPUT PATH    directory holding input/'
+    print '\t -d  YYYY-MM-DD    date of the signed-zones files'
+    print '\t -o  INDEX         index file to write'
+
+def main():
+    try:
+        opts, args = getopt.getopt(sys.argv[1:], 'hp:d:o:', ['help', 'path=', 'date=', 'output='])
+    except getopt.GetoptError as err:
+        print_err(str(err) + '\n')
+        usage(sys.argv[0])
+        sys.exit(1)
+    in_path = ''
+    date_text = ''
+    out_fn = ''
+    for o, a in opts:
+        if o in ('-h', '--help'):
+            usage(sys.argv[0])
+            sys.exit()
+        elif o in ('-p', '--path'):
+            in_path = a
+        elif o in ('-d', '--date'):
+            date_text = a
+        elif o in ('-o', '--output'):
+            out_fn = a
+    if in_path == '' or date_text == '' or out_fn == '':
+        usage(sys.argv[0])
+        sys.exit(1)
+    try:
+        datetime.datetime.strptime(date_text, '%Y-%m-%d')
+    except ValueError:
+        sys.exit('[error] date is not valid, abort!')
+    n = build_index(in_path, date_text, out_fn)
+    print_err('%s: %d signed zones\n' % (out_fn, n))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,156 @@
+#!/usr/bin/env python
+
+# Copyright (c) 2015, Verisign, Inc.
+# All rights reserved.
+# 
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+# 
+# * Redistributions of source code must retain the above copyright notice, this
+#   list of conditions and the following disclaimer.
+# 
+# * Redistributions in binary form must reproduce the above copyright notice,
+#   this list of conditions and the following disclaimer in the documentation
+#   and/or other materials provided with the distribution.
+# 
+# * Neither the name of tlsa-survey nor the names of its
+#   contributors may be used to endorse or promote products derived from
+#   this software without specific prior written permission.
+# 
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+# SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+# OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+# Progress journal for --resume.  Input lines are numbered as they are
+# read; the journal records the round (timestamp and date) and, every few
+# seconds, a low-water mark below which every line is done plus the few
+# finished lines above it:
+#
+#   round <timestamp> <year> <month> <day>
+#   mark <lineno>
+#   done <lineno>
+#
+# Only the last mark and the done lines after it matter on resume, so one
+# small append per interval is all a running survey pays.  Progress is
+# handed to defer(fn) when given (the db writer, so a line is only marked
+# done once its rows are committed).  A line that also depends on rows
+# written for another line (a shared MX/SRV target) is held: complete()
+# only takes effect once every hold() has been release()d.
+
+import os, time, threading, collections
+
+class Journal(object):
+    def __init__(self, fn, interval=5.0, defer=None):
+        self.fn = fn
+        self.interval = interval
+        self.defer = defer
+        self.lock = threading.Lock()
+        self.f = None
+        self.mark = 0               # every line below mark is done
+        self.done = set()           # done lines at or above mark
+        self.issued = collections.deque()
+        self.holds = {}             # lineno -> holds not yet released
+        self.held = set()           # completed lines waiting for their holds
+        self.last_flush = 0
+        self.round = None           # (timestamp, year, month, day)
+
+    def load(self):
+        # read an existing journal, returns False if there is none
+        if not os.path.isfile(self.fn):
+            return False
+        with open(self.fn, 'r') as f:
+            for l in f:
+                w = l.split()
+                if len(w) == 5 and w[0] == 'round':
+                    self.round = tuple(int(x) for x in w[1:])
+                elif len(w) == 2 and w[0] == 'mark':
+                    self.mark = int(w[1])
+                    self.done = set()
+                elif len(w) == 2 and w[0] == 'done':
+                    self.done.add(int(w[1]))
+        return self.round != None
+
+    def open(self, timestamp, year, month, day):
+        if self.round == None:
+            self.round = (timestamp, year, month, day)
+            self.f = open(self.fn, 'w')
+            self.f.write('round %d %d %d %d\n' % self.round)
+            self.sync()
+        else:
+            self.f = open(self.fn, 'a')
+
+    def is_done(self, lineno):
+        return lineno < self.mark or lineno in self.done
+
+    def issue(self, lineno):
+        with self.lock:
+            self.issued.append(lineno)
+
+    def hold(self, lineno):
+        with self.lock:
+            self.holds[lineno] = self.holds.get(lineno, 0) + 1
+
+    def release(self, lineno):
+        with self.lock:
+            n = self.holds.pop(lineno) - 1
+            if n > 0:
+                self.holds[lineno] = n
+            elif lineno in self.held:
+                self.held.discard(lineno)
+                self.finish(lineno)
+
+    def complete(self, lineno):
+        with self.lock:
+            if lineno in self.holds:
+                self.held.add(lineno)
+            else:
+                self.finish(lineno)
+
+    def finish(self, lineno):
+        # caller holds the lock
+        self.done.add(lineno)
+        while self.issued and self.issued[0] in self.done:
+            n = self.issued.popleft()
+            self.done.discard(n)
+            self.mark = n + 1
+        if time.time() - self.last_flush >= self.interval:
+            self.flush()
+
+    def flush(self):
+        # caller holds the lock
+        self.done = set(n for n in self.done if n >= self.mark)
+        text = 'mark %d\n' % self.mark
+        for n in self.done:
+            text += 'done %d\n' % n
+        self.last_flush = time.time()
+        if self.defer != None:
+            self.defer(lambda: self.write(text))
+        else:
+            self.write(text)
+
+    def write(self, text):
+        if self.f == None:
+            return
+        self.f.write(text)
+        self.sync()
+
+    def sync(self):
+        self.f.flush()
+        os.fsync(self.f.fileno())
+
+    def close(self):
+        # call after the db writer is closed, everything is committed then
+        if self.f == None:
+            return
+        with self.lock:
+            self.defer = None
+            self.flush()
+            self.f.close()
+            self.f = None
@@ -0,0 +1,208 @@
+#!/usr/bin/env python
+
+# Copyright (c) 2015, Verisign, Inc.
+# All rights reserved.
+# 
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+# 
+# * Redistributions of source code must retain the above copyright notice, this
+#   list of conditions and the following disclaimer.
+# 
+# * Redistributions in binary form must reproduce the above copyright notice,
+#   this list of conditions and the following disclaimer in the documentation
+#   and/or other materials provided with the distribution.
+# 
+# * Neither the name of tlsa-survey nor the names of its
+#   contributors may be used to endorse or promote products derived from
+#   this software without specific prior written permission.
+# 
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+# SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+# OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+# Run-time instrumentation of a survey: latency histograms per stage,
+# counters and queue-depth gauges.  A reporter thread prints a progress
+# line every few seconds and dump() writes everything at the end, as a
+# Prometheus textfile (FILE.prom) or JSON (anything else).
+
+import sys, os, time, json, threading, bisect
+
+# upper bounds in seconds, like Prometheus' le buckets
+BUCKETS = [0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60]
+
+def print_err(s):
+    sys.stderr.write(s)
+
+def label_key(labels):
+    return tuple(sorted(labels.items()))
+
+def fmt_labels(key, extra=()):
+    items = list(key) + list(extra)
+    if len(items) == 0:
+        return ''
+    return '{' + ','.join('%s="%s"' % (k, str(v).replace('"', '\\"')) for (k, v) in items) + '}'
+
+class Histogram(object):
+    def __init__(self):
+        self.counts = [0] * (len(BUCKETS) + 1) # last one is +Inf
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, v):
+        self.counts[bisect.bisect_left(BUCKETS, v)] += 1
+        self.count += 1
+        self.sum += v
+
+    def quantile(self, q):
+        # upper bound of the bucket holding the q-th observation
+        if self.count == 0:
+            return 0.0
+        rank = q * self.count
+        n = 0
+        for (i, c) in enumerate(self.counts):
+            n += c
+            if n >= rank:
+                return BUCKETS[i] if i < len(BUCKETS) else float('inf')
+        return float('inf')
+
+class _Timer(object):
+    def __init__(self, metrics, name, labels):
+        self.metrics = metrics
+        self.name = name
+        self.labels = labels
+
+    def __enter__(self):
+        self.start = time.time()
+        return self
+
+    def __exit__(self, *exc):
+        self.metrics.observe(self.name, time.time() - self.start, **self.labels)
+        return False
+
+class Metrics(object):
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.started = time.time()
+        self.histograms = {}    # name -> {label key -> Histogram}
+        self.counters = {}      # name -> {label key -> value}
+        self.gauges = {}        # name -> fn() returning the current value
+
+    def observe(self, name, seconds, **labels):
+        key = label_key(labels)
+        with self.lock:
+            h = self.histograms.setdefault(name, {}).get(key)
+            if h == None:
+                h = self.histograms[name][key] = Histogram()
+            h.observe(seconds)
+
+    def timer(self, name, **labels):
+        # with metrics.timer('get_cert_seconds'): ...
+        return _Timer(self, name, labels)
+
+    def inc(self, name, n=1, **labels):
+        key = label_key(labels)
+        with self.lock:
+            c = self.counters.setdefault(name, {})
+            c[key] = c.get(key, 0) + n
+
+    def gauge(self, name, fn):
+        self.gauges[name] = fn
+
+    def counter(self, name, **labels):
+        with self.lock:
+            return self.counters.get(name, {}).get(label_key(labels), 0)
+
+    def total(self, name):
+        with self.lock:
+            return sum(self.counters.get(name, {}).values())
+
+    def merged(self, name):
+        # one histogram over all label values of name
+        m = Histogram()
+        with self.lock:
+            for h in self.histograms.get(name, {}).values():
+                for (i, c) in enumerate(h.counts):
+                    m.counts[i] += c
+                m.count += h.count
+                m.sum += h.sum
+        return m
+
+    def read_gauges(self):
+        values = {}
+        for (name, fn) in self.gauges.items():
+            try:
+                values[name] = fn()
+            except Exception:
+                pass
+        return values
+
+    def progress(self):
+        elapsed = max(time.time() - self.started, 0.001)
+        domains = self.total('domains_total')
+        line = '[progress] %ds %d domains (%.1f/s) %d targets' % (elapsed, domains, domains / elapsed, self.total('targets_total'))
+        for (name, short) in [('dns_query_seconds', 'dns'), ('get_cert_seconds', 'cert'), ('is_valid_seconds', 'valid'), ('write_db_seconds', 'db')]:
+            h = self.merged(name)
+            if h.count > 0:
+                line += ' %s p50/p99 %g/%gs' % (short, h.quantile(0.5), h.quantile(0.99))
+        for (name, v) in sorted(self.read_gauges().items()):
+            line += ' %s %s' % (name, v)
+        return line
+
+    def start_reporter(self, interval):
+        def run():
+            while True:
+                time.sleep(interval)
+                print_err(self.progress() + '\n')
+        t = threading.Thread(target=run)
+        t.setDaemon(True)
+        t.start()
+
+    def to_dict(self):
+        d = {'elapsed_seconds': time.time() - self.started, 'histograms': {}, 'counters': {}, 'gauges': self.read_gauges()}
+        with self.lock:
+            for (name, hs) in self.histograms.items():
+                d['histograms'][name] = [{'labels': dict(k), 'count': h.count, 'sum': h.sum,
+                                          'buckets': dict(zip([str(b) for b in BUCKETS] + ['+Inf'], h.counts))} for (k, h) in hs.items()]
+            for (name, cs) in self.counters.items():
+                d['counters'][name] = [{'labels': dict(k), 'value': v} for (k, v) in cs.items()]
+        return d
+
+    def to_prom(self, prefix='tlsa_survey_'):
+        lines = []
+        with self.lock:
+            for (name, hs) in sorted(self.histograms.items()):
+                lines.append('# TYPE %s%s histogram' % (prefix, name))
+                for (k, h) in sorted(hs.items()):
+                    n = 0
+                    for (b, c) in zip([str(b) for b in BUCKETS] + ['+Inf'], h.counts):
+                        n += c
+                        lines.append('%s%s_bucket%s %d' % (prefix, name, fmt_labels(k, [('le', b)]), n))
+                    lines.append('%s%s_sum%s %f' % (prefix, name, fmt_labels(k), h.sum))
+                    lines.append('%s%s_count%s %d' % (prefix, name, fmt_labels(k), h.count))
+            for (name, cs) in sorted(self.counters.items()):
+                lines.append('# TYPE %s%s counter' % (prefix, name))
+                for (k, v) in sorted(cs.items()):
+                    lines.append('%s%s%s %d' % (prefix, name, fmt_labels(k), v))
+        for (name, v) in sorted(self.read_gauges().items()):
+            lines.append('# TYPE %s%s gauge' % (prefix, name))
+            lines.append('%s%s %s' % (prefix, name, v))
+        lines.append('# TYPE %selapsed_seconds gauge' % prefix)
+        lines.append('%selapsed_seconds %f' % (prefix, time.time() - self.started))
+        return '\n'.join(lines) + '\n'
+
+    def dump(self, fn):
+        tmp_fn = fn + '.tmp'
+        with open(tmp_fn, 'w') as f:
+            if fn.endswith('.prom'):
+                f.write(self.to_prom())
+            else:
+                json.dump(self.to_dict(), f, indent=1, sort_keys=True)
+        os.rename(tmp_fn, fn)
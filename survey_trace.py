@@ -0,0 +1,167 @@
+#!/usr/bin/env python
+
+# Copyright (c) 2015, Verisign, Inc.
+# All rights reserved.
+# 
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+# 
+# * Redistributions of source code must retain the above copyright notice, this
+#   list of conditions and the following disclaimer.
+# 
+# * Redistributions in binary form must reproduce the above copyright notice,
+#   this list of conditions and the following disclaimer in the documentation
+#   and/or other materials provided with the distribution.
+# 
+# * Neither the name of tlsa-survey nor the names of its
+#   contributors may be used to endorse or promote products derived from
+#   this software without specific prior written permission.
+# 
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+# SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+# OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+# Per-domain tracing for --trace.  Each input domain gets one JSON line
+# when it is finished: its total time and the spans of the work done for
+# it, DNS queries at the top and everything done for a target (name:port)
+# under that target:
+#
+#   {"domain": "example.com", "line": 7, "plan": "full", "start": ..., "dur": 1.2,
+#    "spans": [{"op": "dns", "t": 0.0, "dur": 0.01, "rrtype": "MX", ...}],
+#    "targets": {"mx.example.com:25": [{"op": "cert", ...}, ...]}}
+#
+# t is the start of a span relative to the domain.  Work runs with the
+# domain's trace active on the thread (active()), so the hooks in the
+# survey only call span(); without an active trace that is one thread
+# local lookup returning a shared no-op span.
+
+import time, json, threading
+
+_local = threading.local()
+
+class _NoSpan(object):
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def set(self, **attrs):
+        pass
+
+NO_SPAN = _NoSpan()
+
+class _Span(object):
+    def __init__(self, trace, target, op, attrs):
+        self.trace = trace
+        self.target = target
+        self.op = op
+        self.attrs = attrs
+
+    def __enter__(self):
+        self.start = time.time()
+        return self
+
+    def __exit__(self, *exc):
+        self.trace.add(self.op, self.start, time.time() - self.start, self.target, self.attrs)
+        return False
+
+    def set(self, **attrs):
+        self.attrs.update(attrs)
+
+def span(op, **attrs):
+    # with survey_trace.span('dns', rrtype='MX') as s: ... s.set(rcode=...)
+    trace = getattr(_local, 'trace', None)
+    if trace == None:
+        return NO_SPAN
+    return _Span(trace, getattr(_local, 'target', None), op, attrs)
+
+class active(object):
+    # with active(trace, 'mx.example.com:25'): spans go to that trace and
+    # target until the block ends; trace may be None
+    def __init__(self, trace, target=None):
+        self.trace = trace
+        self.target = target
+
+    def __enter__(self):
+        self.saved = (getattr(_local, 'trace', None), getattr(_local, 'target', None))
+        _local.trace = self.trace
+        _local.target = self.target
+        return self
+
+    def __exit__(self, *exc):
+        (_local.trace, _local.target) = self.saved
+        return False
+
+def target_key(qn, port):
+    return '%s:%d' % (qn, port)
+
+def context():
+    # (trace, target) of this thread, to carry over to another thread
+    return (getattr(_local, 'trace', None), getattr(_local, 'target', None))
+
+def in_target(qn, port):
+    # spans in the block go under target qn:port of the active trace
+    trace = getattr(_local, 'trace', None)
+    if trace == None:
+        return NO_SPAN
+    return active(trace, target_key(qn, port))
+
+class DomainTrace(object):
+    def __init__(self, tracer, qn, lineno):
+        self.tracer = tracer
+        self.qn = qn
+        self.lineno = lineno
+        self.plan = 'full'
+        self.start = time.time()
+        self.lock = threading.Lock()
+        self.spans = []
+        self.targets = {}
+        self.done = False
+
+    def add(self, op, start, dur, target=None, attrs={}):
+        s = dict(attrs)
+        s['op'] = op
+        s['t'] = round(start - self.start, 6)
+        s['dur'] = round(dur, 6)
+        with self.lock:
+            if self.done:
+                # a background probe that outlived the domain
+                return
+            if target == None:
+                self.spans.append(s)
+            else:
+                self.targets.setdefault(target, []).append(s)
+
+    def finish(self):
+        with self.lock:
+            self.done = True
+        self.tracer.write({'domain': self.qn, 'line': self.lineno, 'plan': self.plan,
+                           'start': round(self.start, 3), 'dur': round(time.time() - self.start, 6),
+                           'spans': self.spans, 'targets': self.targets})
+
+class Tracer(object):
+    def __init__(self, fn):
+        self.f = open(fn, 'a')
+        self.lock = threading.Lock()
+        self.domains = 0
+
+    def domain(self, qn, lineno):
+        return DomainTrace(self, qn, lineno)
+
+    def write(self, record):
+        line = json.dumps(record, separators=(',', ':')) + '\n'
+        with self.lock:
+            self.f.write(line)
+            self.domains += 1
+
+    def close(self):
+        with self.lock:
+            self.f.close()
@@ -0,0 +1,381 @@
+#!/usr/bin/env python
+
+# Copyright (c) 2015, Verisign, Inc.
+# All rights reserved.
+# 
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+# 
+# * Redistributions of source code must retain the above copyright notice, this
+#   list of conditions and the following disclaimer.
+# 
+# * Redistributions in binary form must reproduce the above copyright notice,
+#   this list of conditions and the following disclaimer in the documentation
+#   and/or other materials provided with the distribution.
+# 
+# * Neither the name of tlsa-survey nor the names of its
+#   contributors may be used to endorse or promote products derived from
+#   this software without specific prior written permission.
+# 
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+# SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+# OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+# Offline end-to-end benchmark.  Starts a DNS stand-in (UDP and pipelined
+# TCP) serving synthetic zones (TLSA, MX, SRV, NXDOMAIN and slow answers in
+# configurable proportions) and TLS, SMTP STARTTLS and XMPP STARTTLS listeners on
+# 127.0.0.1 presenting a generated CA/intermediate/leaf chain, then runs
+# tlsa_survey.py against them and reports domains/sec, per-domain latency
+# (exact quantiles of the domain times in the survey's --trace output) and
+# the survey's peak RSS.  Arguments after -- go to tlsa_survey.py:
+#
+#   ./tlsa_bench.py -n 2000 -- -e async -t 20
+
+import sys, os, time, json, socket, ssl, random, hashlib, getopt, shutil, struct
+import threading, subprocess, tempfile, resource, sqlite3, glob, math
+import dns.message, dns.rrset, dns.rcode, dns.rdatatype
+from M2Crypto import RSA, EVP, X509, ASN1
+
+SERVICES = {443: 'tls', 465: 'tls', 25: 'smtp', 587: 'smtp', 5222: 'xmpp', 5269: 'xmpp'}
+
+def print_err(s):
+    sys.stderr.write(s)
+
+def make_key():
+    pk = EVP.PKey()
+    pk.assign_rsa(RSA.gen_key(2048, 65537, lambda *args: None))
+    return pk
+
+def make_cert(cn, key, serial, issuer=None, issuer_key=None, ca=False):
+    cert = X509.X509()
+    cert.set_version(2)
+    cert.set_serial_number(serial)
+    name = X509.X509_Name()
+    name.CN = cn
+    cert.set_subject(name)
+    cert.set_issuer(issuer.get_subject() if issuer != None else name)
+    cert.set_pubkey(key)
+    t = ASN1.ASN1_UTCTIME()
+    t.set_time(int(time.time()) - 86400)
+    cert.set_not_before(t)
+    t = ASN1.ASN1_UTCTIME()
+    t.set_time(int(time.time()) + 30 * 86400)
+    cert.set_not_after(t)
+    if ca:
+        cert.add_ext(X509.new_extension('basicConstraints', 'CA:TRUE', 1))
+    cert.sign(issuer_key if issuer_key != None else key, 'sha256')
+    return cert
+
+def make_chain(work_dir):
+    # returns (chain file, key file, TLSA data of the leaf's SPKI)
+    ca_key = make_key()
+    ca = make_cert('bench root', ca_key, 1, ca=True)
+    inter_key = make_key()
+    inter = make_cert('bench intermediate', inter_key, 2, ca, ca_key, ca=True)
+    leaf_key = make_key()
+    leaf = make_cert('bench leaf', leaf_key, 3, inter, inter_key)
+    chain_fn = os.path.join(work_dir, 'chain.pem')
+    key_fn = os.path.join(work_dir, 'key.pem')
+    with open(chain_fn, 'w') as f:
+        f.write(leaf.as_pem() + inter.as_pem())
+    leaf_key.save_key(key_fn, None)
+    return (chain_fn, key_fn, hashlib.sha256(leaf.get_pubkey().as_der()).hexdigest())
+
+class Zones(object):
+    # synthetic zones b<N>.bench., the profile of each domain is drawn from
+    # the mix with a per-domain seed, so a run is reproducible
+    def __init__(self, num, mix, seed, spki_hash):
+        self.num = num
+        self.mix = mix
+        self.seed = seed
+        self.spki_hash = spki_hash
+        self.profiles = {}
+        for i in range(num):
+            r = random.Random(seed * 1000003 + i)
+            p = {}
+            for k in ['nx', 'tlsa', 'match', 'mx', 'srv', 'slow']:
+                p[k] = r.random() < mix[k]
+            p['bad'] = '%064x' % r.getrandbits(256)
+            self.profiles['b%d.bench.' % i] = p
+
+    def domains(self):
+        return ['b%d.bench' % i for i in range(self.num)]
+
+    def expected_ok(self):
+        return sum(1 for p in self.profiles.values() if not p['nx'] and p['tlsa'] and p['match'])
+
+    def answer(self, q):
+        # returns (response, slow)
+        r = dns.message.make_response(q)
+        qn = q.question[0].name.to_text().lower()
+        t = q.question[0].rdtype
+        labels = qn.rstrip('.').split('.')
+        p = self.profiles.get('.'.join(labels[-2:]) + '.')
+        if p == None or p['nx']:
+            r.set_rcode(dns.rcode.NXDOMAIN)
+            return (r, p != None and p['slow'])
+        dom = '.'.join(labels[-2:]) + '.'
+        host = qn
+        if labels[0].startswith('_') and len(labels) > 2 and labels[1] == '_tcp':
+            host = '.'.join(labels[2:]) + '.'
+        if t == dns.rdatatype.A and host == qn and qn in [dom, 'www.' + dom, 'mail.' + dom, 'xmpp.' + dom]:
+            r.answer.append(dns.rrset.from_text(qn, 300, 'IN', 'A', '127.0.0.1'))
+        elif t == dns.rdatatype.MX and qn == dom and p['mx']:
+            r.answer.append(dns.rrset.from_text(qn, 300, 'IN', 'MX', '10 mail.' + dom))
+        elif t == dns.rdatatype.SRV and qn == '_xmpp-client._tcp.' + dom and p['srv']:
+            r.answer.append(dns.rrset.from_text(qn, 300, 'IN', 'SRV', '0 0 5222 xmpp.' + dom))
+        elif t == dns.rdatatype.TLSA and p['tlsa'] and self.has_tlsa(p, labels[0], host, dom):
+            data = self.spki_hash if p['match'] else p['bad']
+            r.answer.append(dns.rrset.from_text(qn, 300, 'IN', 'TLSA', '3 1 1 ' + data))
+        else:
+            r.authority.append(dns.rrset.from_text('bench.', 300, 'IN', 'SOA', 'ns.bench. admin.bench. 1 3600 600 86400 60'))
+        return (r, p['slow'])
+
+    def has_tlsa(self, p, port_label, host, dom):
+        if host in [dom, 'www.' + dom]:
+            return port_label == '_443'
+        if host == 'mail.' + dom:
+            return p['mx'] and port_label in ['_25', '_587', '_465']
+        if host == 'xmpp.' + dom:
+            return p['srv'] and port_label == '_5222'
+        return False
+
+def serve_dns(sock, zones, slow_ms):
+    while True:
+        (wire, src) = sock.recvfrom(65535)
+        try:
+            q = dns.message.from_wire(wire)
+        except Exception:
+            continue
+        (r, slow) = zones.answer(q)
+        out = r.to_wire()
+        if slow:
+            threading.Timer(slow_ms / 1000.0, sock.sendto, (out, src)).start()
+        else:
+            sock.sendto(out, src)
+
+def recv_exact(conn, n):
+    buf = ''
+    while len(buf) < n:
+        data = conn.recv(n - len(buf))
+        if data == '':
+            return None
+        buf += data
+    return buf
+
+def serve_dns_conn(conn, zones, slow_ms):
+    # answers go out as they are ready, so slow ones come back out of order
+    lock = threading.Lock()
+    def send(out):
+        with lock:
+            try:
+                conn.sendall(struct.pack('!H', len(out)) + out)
+            except socket.error:
+                pass
+    while True:
+        head = recv_exact(conn, 2)
+        wire = head and recv_exact(conn, struct.unpack('!H', head)[0])
+        if not wire:
+            break
+        (r, slow) = zones.answer(dns.message.from_wire(wire))
+        if slow:
+            threading.Timer(slow_ms / 1000.0, send, (r.to_wire(),)).start()
+        else:
+            send(r.to_wire())
+    conn.close()
+
+def serve_dns_tcp(sock, zones, slow_ms):
+    while True:
+        (conn, addr) = sock.accept()
+        start_daemon(serve_dns_conn, conn, zones, slow_ms)
+
+def read_until(conn, marks):
+    buf = ''
+    while not any(m in buf for m in marks):
+        data = conn.recv(4096)
+        if data == '':
+            raise socket.error('closed')
+        buf += data
+    return buf
+
+def serve_tls(conn, kind, ctx):
+    try:
+        conn.settimeout(10)
+        if kind == 'smtp':
+            conn.sendall('220 bench ESMTP\r\n')
+            read_until(conn, ['\n'])
+            conn.sendall('250-bench\r\n250 STARTTLS\r\n')
+            read_until(conn, ['\n'])
+            conn.sendall('220 ready\r\n')
+        elif kind == 'xmpp':
+            read_until(conn, ["version='1.0'>", 'version="1.0">'])
+            conn.sendall("<?xml version='1.0'?><stream:stream xmlns='jabber:client' "
+                         "xmlns:stream='http://etherx.jabber.org/streams' version='1.0'>"
+                         "<stream:features><starttls xmlns='urn:ietf:params:xml:ns:xmpp-tls'/></stream:features>")
+            read_until(conn, ['/>'])
+            conn.sendall("<proceed xmlns='urn:ietf:params:xml:ns:xmpp-tls'/>")
+        tls = ctx.wrap_socket(conn, server_side=True)
+        tls.close()
+    except (socket.error, ssl.SSLError):
+        pass
+    finally:
+        conn.close()
+
+def listen(kind, ctx):
+    s = socket.socket()
+    s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    s.bind(('127.0.0.1', 0))
+    s.listen(128)
+    def run():
+        while True:
+            (conn, addr) = s.accept()
+            t = threading.Thread(target=serve_tls, args=(conn, kind, ctx))
+            t.setDaemon(True)
+            t.start()
+    t = threading.Thread(target=run)
+    t.setDaemon(True)
+    t.start()
+    return s.getsockname()[1]
+
+def start_daemon(fn, *args):
+    t = threading.Thread(target=fn, args=args)
+    t.setDaemon(True)
+    t.start()
+
+def run_survey(work_dir, dns_port, port_map, domains, survey_args):
+    in_fn = os.path.join(work_dir, 'domains.txt')
+    with open(in_fn, 'w') as f:
+        f.write('\n'.join(domains) + '\n')
+    out_fn = os.path.join(work_dir, 'bench.db')
+    trace_fn = os.path.join(work_dir, 'trace.jsonl')
+    survey = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'tlsa_survey.py')
+    argv = [sys.executable, survey, '-n', '-s', '127.0.0.1:%d' % dns_port,
+            '--port-map', ','.join('%d:%d' % x for x in sorted(port_map.items())),
+            '-i', in_fn, '-o', out_fn, '--trace', trace_fn, '--progress', '0'] + survey_args
+    with open(os.path.join(work_dir, 'survey.log'), 'w') as log:
+        start = time.time()
+        rc = subprocess.call(argv, stderr=log)
+        elapsed = time.time() - start
+    if rc != 0:
+        sys.exit('[error] tlsa_survey.py failed (%d), see %s/survey.log' % (rc, work_dir))
+    return (out_fn, trace_fn, elapsed)
+
+def domain_times(trace_fn):
+    # wall-clock time of every domain, from the trace (trace.N.jsonl per
+    # child with --procs)
+    times = []
+    for fn in glob.glob(trace_fn) + glob.glob(os.path.splitext(trace_fn)[0] + '.*.jsonl'):
+        for l in open(fn):
+            times.append(json.loads(l)['dur'])
+    return sorted(times)
+
+def quantile(times, q):
+    # nearest rank of the sorted times
+    if len(times) == 0:
+        return 0.0
+    return times[max(int(math.ceil(q * len(times))) - 1, 0)]
+
+def report(zones, out_fn, trace_fn, elapsed):
+    times = domain_times(trace_fn)
+    db = sqlite3.connect(out_fn)
+    outcomes = dict(db.execute('select valid_info, count(*) from (select distinct name, port, valid_info from tlsa_rdata) group by 1').fetchall())
+    db.close()
+    r = {'domains': zones.num,
+         'seconds': elapsed,
+         'domains_per_sec': zones.num / elapsed,
+         'domain_p50_seconds': quantile(times, 0.5),
+         'domain_p99_seconds': quantile(times, 0.99),
+         'peak_rss_kb': resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss,
+         'outcomes': outcomes,
+         'expected_ok_domains': zones.expected_ok()}
+    print 'domains          %d' % r['domains']
+    print 'seconds          %.2f' % r['seconds']
+    print 'domains/sec      %.1f' % r['domains_per_sec']
+    print 'domain p50/p99   %g/%gs' % (r['domain_p50_seconds'], r['domain_p99_seconds'])
+    print 'peak RSS         %d KB' % r['peak_rss_kb']
+    print 'outcomes         %s' % ' '.join('%s=%d' % x for x in sorted(outcomes.items()))
+    return r
+
+def usage(comm):
+    print 'usage: %s [options] [-- tlsa_survey.py options]' % comm
+    print '\t -h              print this message'
+    print '\t -n  NUM         number of domains, default 1000'
+    print '\t --seed=NUM      seed of the zone mix, default 1'
+    print '\t --tlsa=FRAC     domains with TLSA records, default 0.3'
+    print '\t --match=FRAC    of those, records matching the chain, default 0.7'
+    print '\t --mx=FRAC       domains with an MX, default 0.5'
+    print '\t --srv=FRAC      domains with an XMPP SRV, default 0.2'
+    print '\t --nx=FRAC       NXDOMAIN domains, default 0.1'
+    print '\t --slow=FRAC     domains answered late, default 0.05'
+    print '\t --slow-ms=MS    delay of slow answers, default 500'
+    print '\t -o  FILE        also write the results as JSON'
+    print '\t -k              keep the work directory'
+
+def main():
+    try:
+        opts, args = getopt.getopt(sys.argv[1:], 'hn:o:k', ['help', 'seed=', 'tlsa=', 'match=', 'mx=', 'srv=', 'nx=', 'slow=', 'slow-ms='])
+    except getopt.GetoptError as err:
+        print_err(str(err) + '\n')
+        usage(sys.argv[0])
+        sys.exit(1)
+    num = 1000
+    seed = 1
+    mix = {'tlsa': 0.3, 'match': 0.7, 'mx': 0.5, 'srv': 0.2, 'nx': 0.1, 'slow': 0.05}
+    slow_ms = 500
+    out_fn = ''
+    keep = False
+    for o, a in opts:
+        if o in ('-h', '--help'):
+            usage(sys.argv[0])
+            sys.exit()
+        elif o == '-n':
+            num = int(a)
+        elif o == '--seed':
+            seed = int(a)
+        elif o == '--slow-ms':
+            slow_ms = int(a)
+        elif o == '-o':
+            out_fn = a
+        elif o == '-k':
+            keep = True
+        else:
+            mix[o[2:]] = float(a)
+
+    work_dir = tempfile.mkdtemp(prefix='tlsa_bench.')
+    try:
+        (chain_fn, key_fn, spki_hash) = make_chain(work_dir)
+        zones = Zones(num, mix, seed, spki_hash)
+        dns_sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        dns_sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 8 << 20)
+        dns_sock.bind(('127.0.0.1', 0))
+        start_daemon(serve_dns, dns_sock, zones, slow_ms)
+        dns_tcp = socket.socket()
+        dns_tcp.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        dns_tcp.bind(dns_sock.getsockname())
+        dns_tcp.listen(128)
+        start_daemon(serve_dns_tcp, dns_tcp, zones, slow_ms)
+        ctx = ssl.SSLContext(ssl.PROTOCOL_SSLv23)
+        ctx.load_cert_chain(chain_fn, key_fn)
+        port_map = {}
+        for (port, kind) in SERVICES.items():
+            port_map[port] = listen(kind, ctx)
+        (db_fn, trace_fn, elapsed) = run_survey(work_dir, dns_sock.getsockname()[1], port_map, zones.domains(), args)
+        r = report(zones, db_fn, trace_fn, elapsed)
+        if out_fn != '':
+            with open(out_fn, 'w') as f:
+                json.dump(r, f, indent=1, sort_keys=True)
+    finally:
+        if keep:
+            print_err('work directory %s\n' % work_dir)
+        else:
+            shutil.rmtree(work_dir)
+
+if __name__ == "__main__":
+    main()
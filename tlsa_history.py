@@ -0,0 +1,145 @@
+#!/usr/bin/env python
+
+# Copyright (c) 2015, Verisign, Inc.
+# All rights reserved.
+# 
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+# 
+# * Redistributions of source code must retain the above copyright notice, this
+#   list of conditions and the following disclaimer.
+# 
+# * Redistributions in binary form must reproduce the above copyright notice,
+#   this list of conditions and the following disclaimer in the documentation
+#   and/or other materials provided with the distribution.
+# 
+# * Neither the name of tlsa-survey nor the names of its
+#   contributors may be used to endorse or promote products derived from
+#   this software without specific prior written permission.
+# 
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+# SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+# OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+# History of the daily survey databases in one file.  Each distinct TLSA
+# record (name, port, usage, selector, mtype, cert_info) is kept as
+# intervals of consecutive surveyed days, first_seen..last_seen, with its
+# valid_info changes in tlsa_history_change.  Per-day per-TLD counts are
+# rolled up in tlsa_daily as each day is ingested, so dnssec_tlsa_zone_num.py
+# -H and time series queries do not reopen the daily files.
+#
+# Days must be ingested in date order; a day already ingested is skipped.
+# A record missing from one ingested day starts a new interval when it
+# comes back.
+
+import sys, os, getopt, sqlite3
+from dnssec_tlsa_zone_num import get_zone
+
+def print_err(s):
+    sys.stderr.write(s)
+
+def create_tables(hdb):
+    cur = hdb.cursor()
+    cur.execute("CREATE TABLE if not exists history_day (date text primary key, timestamp int, source text, records int);")
+    cur.execute("CREATE TABLE if not exists tlsa_history (id integer primary key, zone text, name text, port int, cert_usage int, selector int, mtype int, cert_info text, first_seen text, last_seen text, valid_info text);")
+    cur.execute("CREATE UNIQUE INDEX if not exists tlsa_history_uniq ON tlsa_history(name, port, cert_usage, selector, mtype, cert_info, last_seen);")
+    cur.execute("CREATE INDEX if not exists tlsa_history_seen ON tlsa_history(first_seen, last_seen);")
+    # valid_info of an interval from date on, the first row is its start
+    cur.execute("CREATE TABLE if not exists tlsa_history_change (id int, date text, valid_info text);")
+    cur.execute("CREATE INDEX if not exists tlsa_history_change_id ON tlsa_history_change(id);")
+    # tlsa_name and tlsa_zone as dnssec_tlsa_zone_num.py counts them
+    cur.execute("CREATE TABLE if not exists tlsa_daily (zone text, year int, month int, day int, tlsa_name int, tlsa_zone int, records int, ok_name int);")
+    cur.execute("CREATE UNIQUE INDEX if not exists tlsa_daily_uniq ON tlsa_daily(zone, year, month, day);")
+    hdb.commit()
+    cur.close()
+
+def survey_days(fn):
+    # (year, month, day, latest timestamp) of each day in a survey db
+    db = sqlite3.connect(fn)
+    days = db.execute('select year, month, day, max(timestamp) from tlsa_rdata group by 1, 2, 3 order by 1, 2, 3').fetchall()
+    db.close()
+    return days
+
+def ingest_day(hdb, fn, dy, dm, dd, ts):
+    date = '%04d-%02d-%02d' % (dy, dm, dd)
+    cur = hdb.cursor()
+    if cur.execute('select count(*) from history_day where date=?', (date,)).fetchone()[0] > 0:
+        print_err('[warn] %s already ingested, skipped\n' % date)
+        return False
+    (last,) = cur.execute('select max(date) from history_day').fetchone()
+    if last != None and last > date:
+        sys.exit('[error] %s from %s is older than the last ingested day %s, abort!' % (date, fn, last))
+    cur.execute('ATTACH DATABASE ? AS day', (fn,))
+    # later rounds of the day win
+    rows = {}
+    for (zone, name, port, valid_info, u, s, m, ct) in cur.execute('select zone, name, port, valid_info, cert_usage, selector, mtype, cert_info from day.tlsa_rdata where year=? and month=? and day=? order by timestamp', (dy, dm, dd)):
+        rows[(name, port, u, s, m, str(ct).lower())] = (zone, valid_info)
+    extended = 0
+    for (key, (zone, valid_info)) in rows.items():
+        h = cur.execute('select id, valid_info from tlsa_history where name=? and port=? and cert_usage=? and selector=? and mtype=? and cert_info=? and last_seen=?', key + (last,)).fetchone()
+        if h == None:
+            cur.execute('INSERT INTO tlsa_history (zone, name, port, cert_usage, selector, mtype, cert_info, first_seen, last_seen, valid_info) VALUES (?,?,?,?,?,?,?,?,?,?)', (zone,) + key + (date, date, valid_info))
+            cur.execute('INSERT INTO tlsa_history_change VALUES (?,?,?)', (cur.lastrowid, date, valid_info))
+            continue
+        extended += 1
+        cur.execute('UPDATE tlsa_history SET last_seen=?, valid_info=? WHERE id=?', (date, valid_info, h[0]))
+        if h[1] != valid_info:
+            cur.execute('INSERT INTO tlsa_history_change VALUES (?,?,?)', (h[0], date, valid_info))
+    cur.execute('''INSERT OR REPLACE INTO tlsa_daily
+                   select zone, ?, ?, ?, count(distinct name || ':' || port), count(distinct level2_zone(name)), count(*),
+                          count(distinct case when valid_info = 'OK' then name || ':' || port end)
+                   from (select distinct zone, name, port, valid_info, cert_usage, selector, mtype, cert_info from day.tlsa_rdata where year=? and month=? and day=?)
+                   group by zone''', (dy, dm, dd, dy, dm, dd))
+    cur.execute('INSERT INTO history_day VALUES (?,?,?,?)', (date, ts, os.path.abspath(fn), len(rows)))
+    hdb.commit()
+    cur.execute('DETACH DATABASE day')
+    cur.close()
+    print_err('%s from %s: %d records, %d extended, %d new\n' % (date, fn, len(rows), extended, len(rows) - extended))
+    return True
+
+def ingest(hdb, fns):
+    hdb.create_function('level2_zone', 1, get_zone)
+    days = []
+    for fn in fns:
+        if not os.path.isfile(fn):
+            sys.exit('[error] %s does not exist, abort!' % fn)
+        days += [(d[:3], fn, d[3]) for d in survey_days(fn)]
+    for ((dy, dm, dd), fn, ts) in sorted(days):
+        ingest_day(hdb, fn, dy, dm, dd, ts)
+
+def usage(comm):
+    print 'usage: %s -o HISTORY SURVEY_DB...' % comm
+    print '\t -h           print this message'
+    print '\t -o  HISTORY  history database, created if needed'
+
+def main():
+    try:
+        opts, args = getopt.getopt(sys.argv[1:], 'ho:', ['help', 'output='])
+    except getopt.GetoptError as err:
+        print_err(str(err) + '\n')
+        usage(sys.argv[0])
+        sys.exit(1)
+    out_fn = ''
+    for o, a in opts:
+        if o in ('-h', '--help'):
+            usage(sys.argv[0])
+            sys.exit()
+        elif o in ('-o', '--output'):
+            out_fn = a
+    if out_fn == '' or len(args) == 0:
+        usage(sys.argv[0])
+        sys.exit(1)
+    hdb = sqlite3.connect(out_fn)
+    create_tables(hdb)
+    ingest(hdb, args)
+    hdb.close()
+
+if __name__ == "__main__":
+    main()
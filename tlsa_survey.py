@@ -29,18 +29,15 @@
 # OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
 
 import sys, os, subprocess, getopt
-import ssl, M2Crypto, socket, hashlib
-import dns.resolver
+import ssl, socket, hashlib, collections, itertools, multiprocessing
+import dns.resolver, dns.rcode
 import datetime, time, calendar, sqlite3
 import Queue, threading
+import dns_mux, serv_cert, cert_cache, dns_cache, db_writer, domain_input, survey_journal, merge_shards, resolver_pool, signed_zones, cert_digest, dns_stream, survey_metrics, probe_targets, circuit_breaker, output_sink, pipeline, survey_trace, dns_archive
 
 def hexdump(str, separator=''):
     return separator.join(x.encode('hex') for x in str)
 
-def fmt_str(s):
-    s = s.replace(' ','')
-    return s.upper()
-
 def print_err(s):
     sys.stderr.write(s)
 
@@ -49,29 +46,8 @@ def run_bash(c):
     output, err = p.communicate()
     return output
 
-def tlsa_select(s, cert):
-    if s == 0:
-        return cert.as_der()
-    elif s == 1:
-        return cert.get_pubkey().as_der()
-    else:
-        sys.exit('[error] selector[%d] is not valid\n' % s)
-
-def tlsa_match(mtype, cert_data, from_dns, err_msg, idx):
-    hex_data = hexdump(cert_data)
-    if mtype == 1:
-        hex_data = hashlib.sha256(cert_data).hexdigest()
-    elif mtype == 2:
-        hex_data = hashlib.sha512(cert_data).hexdigest()
-    elif mtype != 0:
-        sys.exit('[error] mathing type[%s] is not valid\n' % mtype)
-    if fmt_str(hex_data) == fmt_str(from_dns):
-        return True
-    else:
-        err_msg[idx] = '# from cert:%s\n# from DNS: %s' % (fmt_str(hex_data), fmt_str(from_dns))
-        return False
-
-def is_valid(certs, tlsa_ans, err_msg, idx):
+def is_valid(chain, tlsa_ans, err_msg, idx):
+    # chain is a list of cert_digest.CertDigests, leaf first
     cert_usage = tlsa_ans.usage
     selector = tlsa_ans.selector
     mtype = tlsa_ans.mtype
@@ -79,20 +55,15 @@ def is_valid(certs, tlsa_ans, err_msg, idx):
         err_msg['BAD-PARA'] = True
         print_err('[error] parameters are not valid\n')
         return False
-    ct = hexdump(tlsa_ans.cert)
     if cert_usage in [0, 2]: # need to find one trust anchor, loop all
-        for cert in certs:
-            cert_obj = M2Crypto.X509.load_cert_string(cert)
-            cert_data = tlsa_select(selector, cert_obj)
-            if tlsa_match(mtype, cert_data, ct, err_msg, idx):
-                return True
-    elif cert_usage in [1, 3]:
-        cert_obj = M2Crypto.X509.load_cert_string(certs[0])
-        cert_data = tlsa_select(selector, cert_obj)
-        if tlsa_match(mtype, cert_data, ct, err_msg, idx):
-            return True
+        candidates = chain
     else:
-        sys.exit('[error] cert_usage[%d] is not valid\n' % cert_usage)
+        candidates = chain[:1]
+    for d in candidates:
+        if d.matches(selector, mtype, tlsa_ans.cert):
+            return True
+    if len(candidates) > 0:
+        err_msg[idx] = '# from cert:%s\n# from DNS: %s' % (hexdump(candidates[-1].digest(selector, mtype) or '').upper(), hexdump(tlsa_ans.cert).upper())
     return False
 
 def rm_last_dot(s):
@@ -110,12 +81,14 @@ def get_tld(n):
     return w[-1]
 
 def split_certs(multi_certs):
+    # PEM text from get_serv_cert.sh to a list of DER certs
     cert_list = []
     certs = multi_certs.split('-----END CERTIFICATE-----')
     for cert in certs:
         if len(cert) == 0 or cert == '\n':
             continue
-        cert_list.append(cert + '-----END CERTIFICATE-----')
+        cert = cert.strip() + '\n-----END CERTIFICATE-----\n'
+        cert_list.append(ssl.PEM_cert_to_DER_cert(cert))
         #print cert_list[-1]
     return cert_list
 
@@ -126,6 +99,12 @@ def get_utc_sec():
 db_lock = None
 sqldb = None
 sqldb_cur = None
+writer = None # db_writer.DbWriter, the only thread writing to sqldb
+sinks = [] # output_sink sinks of the tlsa_rdata rows, --sink
+tracer = None # survey_trace.Tracer from --trace
+capture = None # dns_archive.ArchiveWriter from --capture
+replay = None # dns_archive.Archive from --replay, answers instead of resolvers
+journal = None # survey_journal.Journal, progress for --resume
 is_debug = False
 serv_port = 53
 serv_ip = ''
@@ -133,88 +112,327 @@ this_date = None
 TABLE_NAME = None
 TIMESTAMP = None # the start time of this script, used to identify the probing round
 cert_script = '' 
+native_cert = False # fetch certs in-process with serv_cert instead of cert_script
+SCRIPT_TIMEOUT = 20 # TIMEOUT_NUM of get_serv_cert.sh, when no -t is given
+port_map = {} # service port -> port actually connected to, from --port-map
+chain_cache = None # cert_cache.CertCache shared by all threads
+digest_cache = cert_digest.DigestCache() # TLSA data of every cert seen this run
+store_chains = False # keep fetched chains next to tlsa_rdata for --revalidate
+stored_ders = set() # hashes of DER already handed to the writer
+stored_lock = threading.Lock()
+baseline = None # (name, port) -> (TLSA set, valid_info, fetched) from --baseline
+baseline_ttl = 604800 # carry a result forward at most this long after a fetch
+reverify = 0.1 # fraction of unchanged targets verified in full anyway
+carry_count = {'carried':0, 'verified':0}
+carry_lock = threading.Lock()
+answer_cache = None # dns_cache.DnsCache shared by all threads
+pool = None # resolver_pool.ResolverPool built from -s
+stream = None # dns_stream.StreamTransport for --transport=tcp|tls
+metrics = survey_metrics.Metrics() # stage latencies and counters of this run
+targets = probe_targets.ProbeTargets() # MX/SRV targets probed this round
+max_addrs = 4 # addresses of a target probed at once
+ADDR_STAGGER = 0.25 # seconds between starting two addresses of a target, RFC 8305
+breaker = circuit_breaker.CircuitBreaker() # per (address, port) fetch timeouts
+connect_timeout = None # --connect-timeout, None keeps the fetcher's default
+handshake_timeout = None # --handshake-timeout, STARTTLS and TLS handshake
+probe_pool = None # pipeline.Stage probing the addresses of a target at once
+signed = None # signed_zones.SignedZones from --signed
+unsigned_plan = 'skip' # what to do with zones missing from the index
+plan_count = {'full':0, 'skip':0, 'cheap':0}
+plan_lock = threading.Lock()
 
-def get_cert(name, port, serv_name):
-    global cert_script
-    if not os.path.isfile(cert_script):
-        sys.exit('[error] cert_script[%s] does not exist, abort!' % cert_script)
+def domain_plan(qn):
+    # 'full' unless the index covers qn's TLD and qn is not signed there;
+    # an unsigned zone cannot have a DNSSEC-validated TLSA record of its own
+    plan = 'full'
+    if signed != None and signed.covers(qn) and qn not in signed:
+        plan = unsigned_plan
+    with plan_lock:
+        plan_count[plan] += 1
+    return plan
+
+def worth_probing(plan, name):
+    # MX/SRV targets may sit in a signed zone even when the domain is not
+    return plan == 'full' or signed.maybe_signed(name)
+
+def get_cert(name, port, serv_name, addr=None):
+    # returns the server's chain as a list of DER certs, or None
+    global chain_cache
     #remove last '.', otherwise openssl cannot get cert for unknown reason
     name = rm_last_dot(name)
     serv_name = rm_last_dot(serv_name)
+    with metrics.timer('get_cert_seconds', sni=int(serv_name != '')), survey_trace.span('cert', addr=addr, port=port, sni=serv_name) as s:
+        if addr == None or chain_cache == None:
+            chain = fetch_cert(name, port, serv_name, addr)
+        else:
+            # XMPP names the domain in its stream header even without SNI
+            key = (addr, port, serv_name if serv_name != '' or port not in serv_cert.XMPP_PORTS else name)
+            chain = chain_cache.fetch(key, lambda: fetch_cert(name, port, serv_name, addr))
+        s.set(outcome='chain' if chain != None else 'none')
+    return chain
+
+def fetch_cert(name, port, serv_name, addr):
+    global cert_script, native_cert
+    if native_cert:
+        if addr == None:
+            return None
+        try:
+            cert_list = serv_cert.get_serv_cert(addr, port, name, serv_name,
+                                                connect_timeout=connect_timeout if connect_timeout != None else serv_cert.CONNECT_TIMEOUT,
+                                                starttls_timeout=handshake_timeout if handshake_timeout != None else serv_cert.STARTTLS_TIMEOUT,
+                                                handshake_timeout=handshake_timeout if handshake_timeout != None else serv_cert.HANDSHAKE_TIMEOUT,
+                                                connect_port=port_map.get(port))
+        except serv_cert.CertFetchError as e:
+            if is_debug:
+                print_err('[debug] get_cert %s:[%d] %s: %s\n' % (name, port, addr, str(e)))
+            if e.reason == 'timeout':
+                breaker.failure((addr, port))
+            return None
+        except:
+            print_err("#Unexpected error: %s\n" % str(sys.exc_info()))
+            return None
+        breaker.success((addr, port))
+        if len(cert_list) == 0:
+            return None
+        return cert_list
+    if not os.path.isfile(cert_script):
+        sys.exit('[error] cert_script[%s] does not exist, abort!' % cert_script)
     try:
         sni_ext = ''
         if len(serv_name) != 0:
             sni_ext = '-s %s' % serv_name
+        if addr != None:
+            sni_ext += ' -h %s' % addr
+        # the script has a single timeout for the whole fetch
+        timeout = None
+        if connect_timeout != None or handshake_timeout != None:
+            timeout = (connect_timeout if connect_timeout != None else serv_cert.CONNECT_TIMEOUT) + (handshake_timeout if handshake_timeout != None else serv_cert.HANDSHAKE_TIMEOUT)
+            sni_ext += ' -t %g' % timeout
+        start = time.time()
         certs = run_bash('%s -n %s -p %d %s -a' % (cert_script, name, port, sni_ext))
         cert_list = split_certs(certs)
         if len(cert_list) == 0: 
+            # taking (nearly) the whole timeout is the only sign of one
+            if addr != None and time.time() - start >= 0.9 * (timeout if timeout != None else SCRIPT_TIMEOUT):
+                breaker.failure((addr, port))
             return None
         else:
+            if addr != None:
+                breaker.success((addr, port))
             return cert_list
     except:
         print_err("#Unexpected error: %s\n" % str(sys.exc_info()))
         return None
 
+def pool_query(resolver, qname, type):
+    # ask one resolver from the pool, a timeout or server failure is tried
+    # once more on another one; NXDOMAIN and NoAnswer count as healthy
+    global pool
+    if pool == None:
+        return resolver.query(qname, type)
+    r = None
+    for attempt in range(2):
+        r = pool.acquire(exclude=r)
+        resolver.port = r.port
+        resolver.nameservers = [r.addr]
+        start = time.time()
+        try:
+            if stream != None:
+                answers = stream.query(qname, type, (r.addr, r.port), resolver.lifetime)
+            else:
+                answers = resolver.query(qname, type)
+        except (dns.resolver.NXDOMAIN, dns.resolver.NoAnswer):
+            pool.release(r, time.time() - start, True)
+            raise
+        except (dns.resolver.Timeout, dns.resolver.NoNameservers):
+            pool.release(r, time.time() - start, False)
+            if attempt == 1 or len(pool.resolvers) == 1:
+                raise
+            continue
+        except:
+            pool.release(r, time.time() - start, False)
+            raise
+        pool.release(r, time.time() - start, True)
+        return answers
+
+def timed_query(resolver, qname, type):
+    with metrics.timer('dns_query_seconds', rrtype=type):
+        if replay != None:
+            return replay.query(qname, type)
+        if capture != None:
+            return captured_query(resolver, qname, type)
+        return pool_query(resolver, qname, type)
+
+def captured_query(resolver, qname, type):
+    # pool_query, with the response or timeout kept in the --capture archive
+    try:
+        answers = pool_query(resolver, qname, type)
+    except dns.resolver.NXDOMAIN as e:
+        responses = getattr(e, 'kwargs', {}).get('responses', {}).values()
+        if len(responses) > 0:
+            capture.add(qname, type, dns_archive.RESPONSE, responses[0])
+        else:
+            capture.add(qname, type, dns_archive.ERROR)
+        raise
+    except dns.resolver.NoAnswer as e:
+        capture.add(qname, type, dns_archive.RESPONSE, getattr(e, 'kwargs', {}).get('response'))
+        raise
+    except dns.resolver.Timeout:
+        capture.add(qname, type, dns_archive.TIMEOUT)
+        raise
+    except:
+        # a SERVFAIL or REFUSED response is kept, replay raises it again
+        response = error_response(sys.exc_info()[1])
+        if response != None:
+            capture.add(qname, type, dns_archive.RESPONSE, response)
+        else:
+            capture.add(qname, type, dns_archive.ERROR)
+        raise
+    capture.add(qname, type, dns_archive.RESPONSE, answers.response)
+    return answers
+
 def send_query(resolver, qname, type, myid):
-    global is_debug, serv_ip, serv_port
+    with survey_trace.span('dns', rrtype=type, qname=qname) as s:
+        answers = resolve(resolver, qname, type, myid, s)
+        if s is not survey_trace.NO_SPAN and s.attrs['result'] != 'cached':
+            s.set(resolver='%s:%d' % (resolver.nameservers[0], resolver.port))
+    return answers
+
+def query_result(s, type, result, response=None):
+    # response is the dns.message behind the result, for its rcode
+    metrics.inc('dns_queries_total', rrtype=type, result=result)
+    s.set(result=result)
+    if response != None and s is not survey_trace.NO_SPAN:
+        s.set(rcode=dns.rcode.to_text(response.rcode()))
+
+def error_response(e):
+    # the response a dnspython resolver exception was raised for, if any
+    kwargs = getattr(e, 'kwargs', {})
+    if kwargs.get('response') != None:
+        return kwargs['response']                   # NoAnswer
+    for response in kwargs.get('responses', {}).values():
+        return response                             # NXDOMAIN
+    for err in reversed(kwargs.get('errors', [])):
+        if err[4] != None:
+            return err[4]                           # NoNameservers, SERVFAIL or REFUSED
+    return None
+
+def resolve(resolver, qname, type, myid, s):
+    global is_debug, answer_cache
     resolver.timeout = 5    # default is 2
     resolver.lifetime = 10   # default is 30
+    if answer_cache != None:
+        cached = answer_cache.get(qname, type)
+        if cached != None:
+            if is_debug:
+                print_err('[%d] cached %s: %s[%s]\n' % (myid, cached if isinstance(cached, str) else 'ans', qname, type))
+            query_result(s, type, 'cached')
+            if isinstance(cached, str):
+                return None
+            return cached
     if is_debug:
         print_err('[%d] send query %s[%s]\n' % (myid, qname, type))
-    if serv_ip != '': # just double check,serv_ip may be kicked out if a server failure
-        #resolver = dns.resolver.Resolver(configure=False)
-        resolver.port = serv_port
-        resolver.nameservers = [serv_ip]
     try:
-        answers = resolver.query(qname, type)
+        answers = timed_query(resolver, qname, type)
+        query_result(s, type, 'answer', answers.response)
         if is_debug:
             print_err('[%d] has ans for %s[%s]\n' % (myid, qname, type))
+        if answer_cache != None:
+            answer_cache.put_answer(qname, type, answers)
         return answers
-    except dns.resolver.NXDOMAIN:
+    except dns.resolver.NXDOMAIN as e:
+        query_result(s, type, 'nxdomain', error_response(e))
+        if answer_cache != None:
+            for response in getattr(e, 'kwargs', {}).get('responses', {}).values():
+                answer_cache.put_negative(qname, type, dns_cache.NXDOMAIN, response)
         if is_debug:
             print_err('[%d] NXDOMAIN: %s[%s]\n' % (myid, qname, type))
         return None
     except dns.resolver.Timeout:
+        query_result(s, type, 'timeout')
         if is_debug:
             print_err('[%d] Timeout: %s[%s]\n' % (myid, qname, type))
         return None
-    except dns.resolver.NoAnswer:
+    except dns.resolver.NoAnswer as e:
+        query_result(s, type, 'noanswer', error_response(e))
+        if answer_cache != None:
+            answer_cache.put_negative(qname, type, dns_cache.NOANSWER, getattr(e, 'kwargs', {}).get('response'))
         if is_debug:
             print_err('[%d] NoAnswer: %s[%s]\n' % (myid, qname, type))
         return None
     except:
+        query_result(s, type, 'error', error_response(sys.exc_info()[1]))
         if is_debug:
             print_err('[%d] Other exception: %s[%s]: %s\n' % (myid, qname, type, sys.exc_info()))
         return None
 
 def write_db(qn, port, tlsa_ans, valid_info):
-    global sqldb, sqldb_cur, db_lock, TABLE_NAME, this_date, TIMESTAMP
+    global writer, TABLE_NAME, this_date, TIMESTAMP
     tmp_tld = None
     qn = rm_last_dot(qn)
+    rows = []
     for rdata in tlsa_ans:
         ct = hexdump(rdata.cert)
         tmp_tld = get_tld(qn)
-        sql_stat = "INSERT INTO %s VALUES (\'%s\', %d, %d, %d, %d, \'%s\',%d,\'%s\',%d,%d,%d,\'%s\')" % (TABLE_NAME, tmp_tld, this_date.year, this_date.month, this_date.day, TIMESTAMP, qn, port, valid_info, rdata.usage, rdata.selector,rdata.mtype,ct)
-        with db_lock:
-	    try:
-            	sqldb_cur.execute(sql_stat)
-            	sqldb.commit()
-	    except sqlite3.IntegrityError:
-		sqldb.rollback()
+        rows.append((tmp_tld, this_date.year, this_date.month, this_date.day, TIMESTAMP, qn, port, valid_info, rdata.usage, rdata.selector, rdata.mtype, ct))
+    metrics.inc('targets_total', valid_info=valid_info)
+    metrics.inc('rows_total', len(rows))
+    with metrics.timer('write_db_seconds'), survey_trace.span('write', rows=len(rows), valid_info=valid_info):
+        for sink in sinks:
+            sink.write(rows)
 
-def validator(qn, port, resolver, tlsa_ans, myid):
-    global is_debug
-    # check if there is *A* record, if not, openssl cannot get cert
-    # since IPv6 is not widely used, only validate IPv4 here. TODO: IPv6
-    ipv4_ans = send_query(resolver, qn, 'A', myid)
-    valid_info='EMPTY'
-    if ipv4_ans == None:
-        valid_info='NO-IP'
-        write_db(qn, port, tlsa_ans, valid_info)
-        return
-        
-    norm_cert = get_cert(qn, port, '')
-    sni_cert = get_cert(qn, port, qn)
+def checkpoint(fn):
+    # journal progress: buffered sink rows go out before the line is marked
+    for sink in sinks:
+        sink.flush()
+    writer.call(fn)
+
+def write_chains(qn, port, sni_cert, norm_cert):
+    # link the fetched DER chains to the target, each DER stored once
+    global writer, TABLE_NAME, this_date, TIMESTAMP
+    qn = rm_last_dot(qn)
+    ders = []
+    links = []
+    for (sni, chain) in [(1, sni_cert), (0, norm_cert)]:
+        if chain == None:
+            continue
+        for (position, der) in enumerate(chain):
+            h = hashlib.sha256(der).hexdigest()
+            with stored_lock:
+                if not h in stored_ders:
+                    stored_ders.add(h)
+                    ders.append((h, sqlite3.Binary(der)))
+            links.append((get_tld(qn), this_date.year, this_date.month, this_date.day, TIMESTAMP, qn, port, sni, position, h))
+    if len(ders) > 0:
+        writer.put('INSERT OR IGNORE INTO cert_der VALUES (?,?)', ders)
+    writer.put('INSERT OR IGNORE INTO %s_chain VALUES (?,?,?,?,?,?,?,?,?,?)' % TABLE_NAME, links)
+
+def lookup_addrs(qn, resolver, myid):
+    # A and AAAA addresses of qn, IPv6 and IPv4 interleaved as in RFC 8305,
+    # at most max_addrs of them
+    v4 = send_query(resolver, qn, 'A', myid)
+    v6 = send_query(resolver, qn, 'AAAA', myid)
+    v4 = [rdata.address for rdata in v4] if v4 != None else []
+    v6 = [rdata.address for rdata in v6] if v6 != None else []
+    addrs = []
+    for i in range(max(len(v4), len(v6))):
+        addrs += v6[i:i + 1] + v4[i:i + 1]
+    return addrs[:max_addrs]
+
+def fetch_chains(qn, port, addr, myid):
+    # fetch phase of validator for one address: returns (valid_info,
+    # sni_cert, norm_cert), valid_info is None when there is at least one
+    # chain to match against
+    # a host that keeps timing out is not tried again for every name on it
+    if not breaker.allow((addr, port)):
+        print_err('[warn] CIRCUIT-OPEN, %s:[%d] %s\n' % (qn, port, addr))
+        metrics.inc('circuit_open_total')
+        with survey_trace.span('cert', addr=addr, port=port, outcome='circuit-open'):
+            return ('CIRCUIT-OPEN', None, None)
+    norm_cert = get_cert(qn, port, '', addr)
+    sni_cert = None
+    if norm_cert != None or not breaker.is_open((addr, port)):
+        sni_cert = get_cert(qn, port, qn, addr)
 
     # check if openssl can get certs or not
     # print cert info, none, one or both
@@ -224,18 +442,19 @@ def validator(qn, port, resolver, tlsa_ans, myid):
     if norm_cert != None:
         cert_info += '[norm]'
     if cert_info != '':
-        print_err('[%d] [info] %s cert found, %s:[%d]\n' % (myid, cert_info, qn, port))
+        print_err('[%d] [info] %s cert found, %s:[%d] %s\n' % (myid, cert_info, qn, port, addr))
     else: # no certs, no validation
-        print_err('[warn] NO-CERT found, %s:[%d]\n' % (qn, port))
-        valid_info='NO-CERT'
-        write_db(qn, port, tlsa_ans, valid_info)
-        return
+        print_err('[warn] NO-CERT found, %s:[%d] %s\n' % (qn, port, addr))
+        return ('NO-CERT', None, None)
+    return (None, sni_cert, norm_cert)
 
+def decide(qn, port, tlsa_ans, sni_cert, norm_cert, myid):
+    # decide phase of validator, no I/O: the chains are lists of
+    # cert_digest.CertDigests (or None), returns valid_info
+    valid_info='EMPTY'
     # check if it has TLSA, input might be out of date
     if tlsa_ans == None:
-        valid_info='NO-TLSA'
-        write_db(qn, port, tlsa_ans, valid_info)
-        return
+        return 'NO-TLSA'
 
     # Now, it has certs and TLSA, then just check if there is a match
     err_msg = {}
@@ -270,7 +489,199 @@ def validator(qn, port, resolver, tlsa_ans, myid):
                 print_err('# SNI\n' + err_msg['sni']+'\n')
             if 'norm' in err_msg:
                 print_err('# Norm\n' + err_msg['norm'] + '\n')
-    
+    return valid_info
+
+def load_baseline(fn):
+    # TLSA RRset, valid_info and last chain fetch (None if there is no
+    # _fetch row) of every target in the latest round of a previous survey db
+    db = sqlite3.connect(fn)
+    fetched = {}
+    if db.execute("select count(*) from sqlite_master where type='table' and name=?", (TABLE_NAME + '_fetch',)).fetchone()[0] > 0:
+        for (name, port, t) in db.execute('select name, port, max(fetched) from %s_fetch group by 1, 2' % TABLE_NAME):
+            fetched[(name, port)] = t
+    targets = {}
+    for (ts, name, port, valid_info, u, s, m, ct) in db.execute('select timestamp, name, port, valid_info, cert_usage, selector, mtype, cert_info from %s order by timestamp' % TABLE_NAME):
+        key = (name, port)
+        e = targets.get(key)
+        if e == None or e[3] != ts:
+            e = (set(), valid_info, fetched.get(key), ts)
+            targets[key] = e
+        e[0].add((u, s, m, str(ct).lower()))
+    db.close()
+    return dict((k, (frozenset(e[0]), e[1], e[2])) for (k, e) in targets.items())
+
+def carried(qn, port, tlsa_ans):
+    # the baseline entry of an unchanged, recently fetched target, or None
+    # when it has to be verified in full
+    e = baseline.get((qn, port))
+    # only a result decided on a fetched chain is kept; NO-IP, NO-CERT and
+    # CIRCUIT-OPEN may be a passing outage and are probed again
+    if e == None or e[2] == None or not e[1] in ['OK', 'BAD-HASH', 'BAD-PARA']:
+        return None
+    if TIMESTAMP - e[2] > baseline_ttl:
+        return None
+    # the same targets are picked in every shard and on --resume
+    if domain_input.shard_of('%s:%d:%d' % (qn, port, TIMESTAMP // 86400), 10000) < reverify * 10000:
+        return None
+    if frozenset((r.usage, r.selector, r.mtype, hexdump(r.cert)) for r in tlsa_ans) != e[0]:
+        return None
+    return e
+
+def write_fetched(qn, port, fetched):
+    global writer, TABLE_NAME, TIMESTAMP
+    writer.put('INSERT OR IGNORE INTO %s_fetch VALUES (?,?,?,?)' % TABLE_NAME, [(TIMESTAMP, rm_last_dot(qn), port, fetched)])
+
+def write_addr(qn, port, addr, valid_info):
+    global writer, TABLE_NAME, this_date, TIMESTAMP
+    qn = rm_last_dot(qn)
+    writer.put('INSERT OR IGNORE INTO %s_addr VALUES (?,?,?,?,?,?,?,?,?)' % TABLE_NAME, [(get_tld(qn), this_date.year, this_date.month, this_date.day, TIMESTAMP, qn, port, addr, valid_info)])
+
+def check_addr(qn, port, addr, tlsa_ans, myid):
+    # fetch and decide for one address, recorded in the _addr table
+    (valid_info, sni_cert, norm_cert) = fetch_chains(qn, port, addr, myid)
+    if valid_info == None:
+        with metrics.timer('is_valid_seconds'), survey_trace.span('valid', addr=addr):
+            valid_info = decide(qn, port, tlsa_ans,
+                                digest_cache.chain(sni_cert) if sni_cert != None else None,
+                                digest_cache.chain(norm_cert) if norm_cert != None else None,
+                                myid)
+    write_addr(qn, port, addr, valid_info)
+    return (valid_info, sni_cert, norm_cert)
+
+class TargetResult(object):
+    # result of a target from the results of its addresses: the first
+    # address, in lookup_addrs order, that returned a chain, NO-CERT if
+    # none did (CIRCUIT-OPEN if no address was even tried).  The target is
+    # decided as soon as every address before that one has failed, or has
+    # been running for more than delay seconds when a later one already
+    # has a chain, so a dead address does not hold the target up.
+    def __init__(self, addrs, delay=0):
+        self.lock = threading.Lock()
+        self.addrs = addrs
+        self.delay = delay
+        self.results = {}   # addr -> (valid_info, sni_cert, norm_cert)
+        self.started = {}   # addr -> start time of its probe
+        self.decided = False
+
+    def start(self, addr):
+        with self.lock:
+            self.started[addr] = time.time()
+
+    def add(self, addr, valid_info, sni_cert, norm_cert):
+        # returns (valid_info, sni_cert, norm_cert) once, when it is known
+        with self.lock:
+            self.results[addr] = (valid_info, sni_cert, norm_cert)
+        return self.decide()
+
+    def decide(self):
+        now = time.time()
+        with self.lock:
+            if self.decided:
+                return None
+            for (i, a) in enumerate(self.addrs):
+                r = self.results.get(a)
+                if r != None:
+                    if r[1] != None or r[2] != None:
+                        self.decided = True
+                        return r
+                    continue
+                if a in self.started and now - self.started[a] >= self.delay and self.has_chain(self.addrs[i + 1:]):
+                    continue
+                return None
+            self.decided = True
+        if all(self.results[a][0] == 'CIRCUIT-OPEN' for a in self.addrs):
+            return ('CIRCUIT-OPEN', None, None)
+        return ('NO-CERT', None, None)
+
+    def has_chain(self, addrs):
+        # caller holds the lock
+        for a in addrs:
+            r = self.results.get(a)
+            if r != None and (r[1] != None or r[2] != None):
+                return True
+        return False
+
+    def failed(self):
+        # every address started so far has a result without a chain
+        with self.lock:
+            return all(a in self.results and not self.has_chain([a]) for a in self.started)
+
+    def wait(self):
+        # seconds until a running address may be passed over
+        now = time.time()
+        with self.lock:
+            left = [self.started[a] + self.delay - now for a in self.started if not a in self.results]
+        left = [x for x in left if x > 0]
+        return min(left) if len(left) > 0 else None
+
+def probe_addrs(qn, port, addrs, tlsa_ans, myid):
+    # Happy Eyeballs: the addresses are started ADDR_STAGGER apart (at
+    # once after a failure) on probe_pool and the target takes its result
+    # as TargetResult decides.  Probes still running or not started yet
+    # then finish in the background and only record their own _addr row.
+    if len(addrs) == 1:
+        return check_addr(qn, port, addrs[0], tlsa_ans, myid)
+    results = Queue.Queue()
+    ctx = survey_trace.context()
+    def probe(addr):
+        r = ('NO-CERT', None, None)
+        try:
+            with survey_trace.active(*ctx):
+                r = check_addr(qn, port, addr, tlsa_ans, myid)
+        finally:
+            results.put((addr,) + r)
+    result = TargetResult(addrs, ADDR_STAGGER)
+    left = list(addrs)
+    next_start = 0
+    while True:
+        if len(left) > 0 and (time.time() >= next_start or result.failed()):
+            addr = left.pop(0)
+            result.start(addr)
+            probe_pool.put(lambda addr=addr: probe(addr))
+            next_start = time.time() + ADDR_STAGGER
+        waits = [x for x in [result.wait(), next_start - time.time() if len(left) > 0 else None] if x != None]
+        try:
+            if len(waits) > 0:
+                r = result.add(*results.get(True, max(min(waits), 0.001)))
+            else:
+                r = result.add(*results.get())
+        except Queue.Empty:
+            r = result.decide()
+        if r != None:
+            # the rest is still probed for its _addr row
+            for addr in left:
+                probe_pool.put(lambda addr=addr: probe(addr))
+            return r
+
+def carry_forward(qn, port, tlsa_ans, myid):
+    # incremental survey: True when the baseline result was written and
+    # there is nothing to fetch
+    if baseline == None:
+        return False
+    e = carried(rm_last_dot(qn), port, tlsa_ans)
+    with carry_lock:
+        carry_count['carried' if e != None else 'verified'] += 1
+    if e != None:
+        if is_debug:
+            print_err('[%d] [debug] unchanged, %s carried forward, %s:[%d]\n' % (myid, e[1], qn, port))
+        write_fetched(qn, port, e[2])
+        write_db(qn, port, tlsa_ans, e[1])
+        return True
+    return False
+
+def validator(qn, port, resolver, tlsa_ans, myid):
+    if carry_forward(qn, port, tlsa_ans, myid):
+        return
+    # check if there is an address, if not, openssl cannot get cert
+    addrs = lookup_addrs(qn, resolver, myid)
+    if len(addrs) == 0:
+        valid_info = 'NO-IP'
+    else:
+        (valid_info, sni_cert, norm_cert) = probe_addrs(qn, port, addrs, tlsa_ans, myid)
+        if sni_cert != None or norm_cert != None:
+            write_fetched(qn, port, TIMESTAMP)
+            if store_chains:
+                write_chains(qn, port, sni_cert, norm_cert)
     write_db(qn, port, tlsa_ans, valid_info)
 
 def fmt_tlsa_name(s, port):
@@ -280,9 +691,49 @@ def fmt_tlsa_name(s, port):
 def tlsa_query(qn, port, resolver, myid):
     qn = rm_last_dot(qn);
     tlsa_name = fmt_tlsa_name(qn, port)
-    answers = send_query(resolver, tlsa_name, 'TLSA', myid)
-    if answers != None:
-	validator(qn, port, resolver, answers, myid)
+    with survey_trace.in_target(qn, port):
+        answers = send_query(resolver, tlsa_name, 'TLSA', myid)
+        if answers != None:
+            validator(qn, port, resolver, answers, myid)
+    return answers != None
+
+def write_targets(domains, qn, port):
+    # which input domains reference the MX/SRV target qn:port
+    global writer, TABLE_NAME, this_date, TIMESTAMP
+    if len(domains) == 0:
+        return
+    rows = [(get_tld(d), this_date.year, this_date.month, this_date.day, TIMESTAMP, d, qn, port) for d in domains]
+    writer.put('INSERT OR IGNORE INTO %s_target VALUES (?,?,?,?,?,?,?,?)' % TABLE_NAME, rows)
+
+def wait_target(key, lineno):
+    # the domain on lineno references a target another domain probes, it is
+    # journaled done only once that target's rows are written
+    if journal == None:
+        return
+    journal.hold(lineno)
+    targets.after(key, lambda: journal.release(lineno))
+
+def target_query(domain, lineno, qn, port, resolver, myid):
+    # an MX/SRV target is probed once a round, not once per domain using it
+    qn = rm_last_dot(qn)
+    (probe, referrers) = targets.claim((qn, port), domain)
+    if not probe:
+        wait_target((qn, port), lineno)
+        write_targets(referrers, qn, port)
+        return
+    try:
+        write_targets(targets.done((qn, port), tlsa_query(qn, port, resolver, myid)), qn, port)
+    finally:
+        targets.recorded((qn, port))
+
+def make_resolver(arg):
+    if arg['serv_ip'] != '':
+        resolver = dns.resolver.Resolver(configure=False)
+        resolver.port = arg['serv_port']
+        resolver.nameservers = [arg['serv_ip']]
+    else:
+        resolver = dns.resolver.Resolver()
+    return resolver
 
 class SurveyThread(threading.Thread):
     def __init__(self, queue, myid, arg):
@@ -292,59 +743,77 @@ class SurveyThread(threading.Thread):
         self.arg = arg
         #self.serv_ip = arg['serv_ip']
         #self.serv_port = arg['serv_port']
-        if arg['serv_ip'] != '':
-            self.resolver = dns.resolver.Resolver(configure=False)
-            self.resolver.port = arg['serv_port']
-            self.resolver.nameservers = [arg['serv_ip']]
-        else:
-            self.resolver = dns.resolver.Resolver()
+        self.resolver = make_resolver(arg)
 
     def run(self):
-        arg = self.arg
-        #resolver = self.resolver
         while True:
-            qn = self.queue.get()
-            qn = rm_last_dot(qn)
-	    print_err('qn=' + qn + '\n')
-            # send TLSA
-            # if yes, then validate and write to sql file
-
-            # WWW/HTTPS
-	    tlsa_query(qn, 443, self.resolver, self.myid);
+            (lineno, qn) = self.queue.get()
+            try:
+                self.survey_domain(lineno, qn)
+            except:
+                # not journaled, a resumed run does the domain again
+                print_err('[%d] survey error for %s: %s\n' % (self.myid, qn, sys.exc_info()))
+            finally:
+                self.queue.task_done()
+
+    def survey_domain(self, lineno, qn):
+        start = time.time()
+        qn = rm_last_dot(qn)
+        print_err('qn=' + qn + '\n')
+        plan = domain_plan(qn)
+        trace = tracer.domain(qn, lineno) if tracer != None else None
+        if plan != 'skip':
+            with survey_trace.active(trace):
+                self.survey(qn, plan, lineno)
+        if trace != None:
+            trace.plan = plan
+            trace.finish()
+        metrics.inc('domains_total', plan=plan)
+        metrics.observe('domain_seconds', time.time() - start)
+        print_err('[%d] DONE-ONE\n' % self.myid)
+        sys.stderr.flush()
+        if journal != None:
+            journal.complete(lineno)
+
+    def survey(self, qn, plan, lineno):
+        # send TLSA
+        # if yes, then validate and write to sql file
+
+        # WWW/HTTPS
+        if plan == 'full':
+            tlsa_query(qn, 443, self.resolver, self.myid)
             tlsa_query('www.' + qn, 443, self.resolver, self.myid)
 
-            # SMTP
-            mx_ans = send_query(self.resolver, qn, 'MX', self.myid)
-            if mx_ans != None: # has mx, query _NNN._tcp.$MXNAME
-                for rdata in mx_ans:
-		    for port in [25, 587, 465]:
-                    	tlsa_query(str(rdata.exchange), port, self.resolver, self.myid)
-            else: # no mx, query _NNN._tcp.$ZONE    
-		for port in [25, 587, 465]:
-                    tlsa_query(qn, port, self.resolver, self.myid)
-
-            # JABBER/XMPP
-	    for srv_qn in [ '_xmpp-client._tcp.' + qn, '_xmpp-server._tcp.' + qn ]:
-            	srv_ans = send_query(self.resolver, srv_qn, 'SRV', self.myid)
-		if srv_ans != None:
-		    for rdata in srv_ans:
-			tlsa_query(str(rdata.target), rdata.port, self.resolver, self.myid)
-            else: # no SRV, look for {xmpp,jabber}.$ZONE
-		for x_qn in ['jabber.' + qn, 'xmpp.' + qn]:
-		    for port in [5222, 5269]:
-                    	tlsa_query(x_qn, port, self.resolver, self.myid)
-
-                #time.sleep(0.01) #do NOT send too fast
-            print_err('[%d] DONE-ONE\n' % self.myid)
-            sys.stderr.flush()
-            self.queue.task_done()
+        # SMTP
+        mx_ans = send_query(self.resolver, qn, 'MX', self.myid)
+        if mx_ans != None: # has mx, query _NNN._tcp.$MXNAME
+            for rdata in mx_ans:
+                if worth_probing(plan, str(rdata.exchange)):
+                    for port in [25, 587, 465]:
+                        target_query(qn, lineno, str(rdata.exchange), port, self.resolver, self.myid)
+        elif plan == 'full': # no mx, query _NNN._tcp.$ZONE
+            for port in [25, 587, 465]:
+                tlsa_query(qn, port, self.resolver, self.myid)
+
+        # JABBER/XMPP
+        for srv_qn in [ '_xmpp-client._tcp.' + qn, '_xmpp-server._tcp.' + qn ]:
+            srv_ans = send_query(self.resolver, srv_qn, 'SRV', self.myid)
+            if srv_ans != None:
+                for rdata in srv_ans:
+                    if worth_probing(plan, str(rdata.target)):
+                        target_query(qn, lineno, str(rdata.target), rdata.port, self.resolver, self.myid)
+        # {xmpp,jabber}.$ZONE are always looked up, SRV or not
+        if plan == 'full':
+            for x_qn in ['jabber.' + qn, 'xmpp.' + qn]:
+                for port in [5222, 5269]:
+                    tlsa_query(x_qn, port, self.resolver, self.myid)
 
-def tlsa_survey(in_fn, serv_ip, serv_port, num_threads):
+def tlsa_survey(in_fn, serv_ip, serv_port, num_threads, seen=None, shard=None):
     global is_debug
-    f = sys.stdin
-    if in_fn != '-':
-        f = open(in_fn,'r')
-    queue = Queue.Queue()
+    f = domain_input.open_input(in_fn)
+    # bounded, so reading the input waits for the workers to catch up
+    queue = Queue.Queue(num_threads * 4)
+    metrics.gauge('input_queue', queue.qsize)
     arg = {'debug':False, 'serv_ip':'', 'serv_port':'53'}
     arg['serv_ip'] = serv_ip
     arg['serv_port'] = serv_port
@@ -352,17 +821,446 @@ def tlsa_survey(in_fn, serv_ip, serv_port, num_threads):
         t = SurveyThread(queue, i, arg)
         t.setDaemon(True)
         t.start()
-    for l in f:
-        if len(l) == 0 or l[0] == '#' or l == '\n':
-            continue
-        l = l.strip()
+    for (lineno, l) in domain_input.read_domains(f, seen, shard):
+        if writer.error != None:
+            break
+        if journal != None:
+            if journal.is_done(lineno):
+                continue
+            journal.issue(lineno)
         if is_debug:
             print_err('[main]: %s\n' % l)
-        queue.put(l)
+        queue.put((lineno, l))
     queue.join()
     if in_fn != '-':
         f.close()
 
+class ValidatorThread(threading.Thread):
+    # validation workers for the async engine, DNS discovery happens in the
+    # event loop and only names that have TLSA records are queued here
+    def __init__(self, jobs, myid, arg):
+        threading.Thread.__init__(self)
+        self.jobs = jobs
+        self.myid = myid
+        self.resolver = make_resolver(arg)
+
+    def run(self):
+        while True:
+            (qn, port, answers, trace, done) = self.jobs.get()
+            try:
+                with survey_trace.active(trace, survey_trace.target_key(qn, port)):
+                    validator(qn, port, self.resolver, answers, self.myid)
+            except:
+                print_err('[%d] validator error for %s:[%d]: %s\n' % (self.myid, qn, port, sys.exc_info()))
+            done()
+            self.jobs.task_done()
+
+class AsyncDomain(object):
+    def __init__(self, qn, lineno):
+        self.qn = qn
+        self.lineno = lineno
+        self.pending = 0
+        self.plan = 'full'
+        self.start = time.time()
+        self.trace = None
+
+def tlsa_survey_async(in_fn, serv_ip, serv_port, num_threads, max_inflight, seen=None, shard=None):
+    # same query plan as SurveyThread.run, but every independent query of a
+    # domain is issued at once and many domains are in flight together
+    global is_debug
+    f = domain_input.open_input(in_fn)
+    domains = domain_input.read_domains(f, seen, shard)
+    arg = {'debug':False, 'serv_ip':serv_ip, 'serv_port':serv_port}
+    mux_pool = pool
+    if mux_pool == None:
+        mux_pool = resolver_pool.ResolverPool([(ns, 53) for ns in dns.resolver.Resolver().nameservers], max_inflight)
+    mux = dns_mux.DnsMux(mux_pool, 5, 10, max_inflight, cache=answer_cache, stream=stream)
+    jobs = Queue.Queue()
+    for i in range(num_threads):
+        t = ValidatorThread(jobs, i, arg)
+        t.setDaemon(True)
+        t.start()
+    state = {'active': 0}
+    metrics.gauge('active_domains', lambda: state['active'])
+    metrics.gauge('dns_pending', mux.pending)
+    metrics.gauge('validate_queue', jobs.qsize)
+
+    def step(d):
+        d.pending -= 1
+        if d.pending == 0:
+            state['active'] -= 1
+            metrics.inc('domains_total', plan=d.plan)
+            metrics.observe('domain_seconds', time.time() - d.start)
+            if d.trace != None:
+                d.trace.plan = d.plan
+                d.trace.finish()
+            print_err('[async] DONE-ONE\n')
+            sys.stderr.flush()
+            if journal != None:
+                journal.complete(d.lineno)
+
+    def query(d, qname, type, cb, target=None):
+        d.pending += 1
+        if is_debug:
+            print_err('[async] send query %s[%s]\n' % (qname, type))
+        start = time.time()
+        def done(answers, rcode):
+            metrics.observe('dns_query_seconds', time.time() - start, rrtype=type)
+            metrics.inc('dns_queries_total', rrtype=type, result='answer' if answers != None else 'none')
+            if d.trace != None:
+                attrs = {'rrtype': type, 'qname': qname, 'result': 'answer' if answers != None else 'none'}
+                if rcode != None:
+                    attrs['rcode'] = dns.rcode.to_text(rcode)
+                d.trace.add('dns', start, time.time() - start, target, attrs)
+            cb(answers)
+            step(d)
+        mux.submit(qname, type, done)
+
+    def tlsa(d, qn, port, shared=False):
+        # shared: an MX/SRV target, see target_query
+        qn = rm_last_dot(qn)
+        if shared:
+            (probe, referrers) = targets.claim((qn, port), d.qn)
+            write_targets(referrers, qn, port)
+            if not probe:
+                wait_target((qn, port), d.lineno)
+                return
+        def validated():
+            # called by the validator thread
+            if shared:
+                targets.recorded((qn, port))
+            mux.call_soon(lambda: step(d))
+        def done(answers):
+            if shared:
+                write_targets(targets.done((qn, port), answers != None), qn, port)
+            if answers != None:
+                d.pending += 1
+                jobs.put((qn, port, answers, d.trace, validated))
+            elif shared:
+                targets.recorded((qn, port))
+        query(d, fmt_tlsa_name(qn, port), 'TLSA', done, survey_trace.target_key(qn, port))
+
+    def mx_done(d, mx_ans):
+        if mx_ans != None:
+            for rdata in mx_ans:
+                if worth_probing(d.plan, str(rdata.exchange)):
+                    for port in [25, 587, 465]:
+                        tlsa(d, str(rdata.exchange), port, True)
+        elif d.plan == 'full':
+            for port in [25, 587, 465]:
+                tlsa(d, d.qn, port)
+
+    def srv_done(d, srv_ans):
+        if srv_ans != None:
+            for rdata in srv_ans:
+                if worth_probing(d.plan, str(rdata.target)):
+                    tlsa(d, str(rdata.target), rdata.port, True)
+
+    def start(qn, lineno):
+        qn = rm_last_dot(qn)
+        print_err('qn=' + qn + '\n')
+        d = AsyncDomain(qn, lineno)
+        d.plan = domain_plan(qn)
+        if tracer != None:
+            d.trace = tracer.domain(qn, lineno)
+        state['active'] += 1
+        d.pending += 1 # held until the whole plan is issued
+        if d.plan == 'skip':
+            step(d)
+            return
+        if d.plan == 'full':
+            tlsa(d, qn, 443)
+            tlsa(d, 'www.' + qn, 443)
+        query(d, qn, 'MX', lambda ans: mx_done(d, ans))
+        for srv_qn in [ '_xmpp-client._tcp.' + qn, '_xmpp-server._tcp.' + qn ]:
+            query(d, srv_qn, 'SRV', lambda ans: srv_done(d, ans))
+        if d.plan == 'full':
+            for x_qn in ['jabber.' + qn, 'xmpp.' + qn]:
+                for port in [5222, 5269]:
+                    tlsa(d, x_qn, port)
+        step(d)
+
+    eof = False
+    while True:
+        while not eof and state['active'] < max_inflight and mux.pending() < max_inflight:
+            (lineno, l) = next(domains, (0, None)) if writer.error == None else (0, None)
+            if l == None:
+                eof = True
+                break
+            if journal != None:
+                if journal.is_done(lineno):
+                    continue
+                journal.issue(lineno)
+            if is_debug:
+                print_err('[main]: %s\n' % l)
+            start(l, lineno)
+        if eof and state['active'] == 0:
+            break
+        mux.run_once()
+    jobs.join()
+    mux.close()
+    if in_fn != '-':
+        f.close()
+
+class PipelineDomain(object):
+    # a domain of the pipeline engine, finished when none of its jobs is
+    # left in any stage
+    def __init__(self, qn, lineno, finish):
+        self.qn = qn
+        self.lineno = lineno
+        self.plan = 'full'
+        self.start = time.time()
+        self.finish = finish
+        self.lock = threading.Lock()
+        self.pending = 1
+        self.trace = None
+
+    def hold(self):
+        with self.lock:
+            self.pending += 1
+
+    def release(self):
+        with self.lock:
+            self.pending -= 1
+            last = self.pending == 0
+        if last:
+            self.finish(self)
+
+class PipelineTarget(object):
+    def __init__(self, qn, port, tlsa_ans, addrs, shared):
+        self.qn = qn
+        self.port = port
+        self.tlsa_ans = tlsa_ans
+        self.result = TargetResult(addrs, ADDR_STAGGER)
+        self.shared = shared
+        self.lock = threading.Lock()
+        self.left = len(addrs)
+
+    def matched(self):
+        # True once every address has been through the match stage
+        with self.lock:
+            self.left -= 1
+            return self.left == 0
+
+def tlsa_survey_pipeline(in_fn, serv_ip, serv_port, workers, max_queue, seen=None, shard=None):
+    # same query plan as SurveyThread.run, split into stages with their own
+    # workers and bounded queues: expand (plan, MX/SRV lookups), tlsa (TLSA
+    # and address lookups), fetch (one address), match (decide); the db
+    # writer thread is the write stage
+    global is_debug
+    f = domain_input.open_input(in_fn)
+    arg = {'debug':False, 'serv_ip':serv_ip, 'serv_port':serv_port}
+    init = lambda myid: (myid, make_resolver(arg))
+    state = {'active': 0}
+    cv = threading.Condition()
+    metrics.gauge('active_domains', lambda: state['active'])
+
+    def finish(d):
+        if d.trace != None:
+            d.trace.plan = d.plan
+            d.trace.finish()
+        metrics.inc('domains_total', plan=d.plan)
+        metrics.observe('domain_seconds', time.time() - d.start)
+        print_err('[pipeline] DONE-ONE\n')
+        sys.stderr.flush()
+        if journal != None:
+            journal.complete(d.lineno)
+        with cv:
+            state['active'] -= 1
+            cv.notify_all()
+
+    def tlsa(d, qn, port, shared=False):
+        d.hold()
+        lookup.put((d, rm_last_dot(qn), port, shared))
+
+    def expand(ctx, d):
+        (myid, resolver) = ctx
+        try:
+            with survey_trace.active(d.trace):
+                expand_domain(d, resolver, myid)
+        finally:
+            d.release()
+
+    def expand_domain(d, resolver, myid):
+        if d.plan == 'full':
+            tlsa(d, d.qn, 443)
+            tlsa(d, 'www.' + d.qn, 443)
+        mx_ans = send_query(resolver, d.qn, 'MX', myid)
+        if mx_ans != None:
+            for rdata in mx_ans:
+                if worth_probing(d.plan, str(rdata.exchange)):
+                    for port in [25, 587, 465]:
+                        tlsa(d, str(rdata.exchange), port, True)
+        elif d.plan == 'full':
+            for port in [25, 587, 465]:
+                tlsa(d, d.qn, port)
+        for srv_qn in [ '_xmpp-client._tcp.' + d.qn, '_xmpp-server._tcp.' + d.qn ]:
+            srv_ans = send_query(resolver, srv_qn, 'SRV', myid)
+            if srv_ans != None:
+                for rdata in srv_ans:
+                    if worth_probing(d.plan, str(rdata.target)):
+                        tlsa(d, str(rdata.target), rdata.port, True)
+        if d.plan == 'full':
+            for x_qn in ['jabber.' + d.qn, 'xmpp.' + d.qn]:
+                for port in [5222, 5269]:
+                    tlsa(d, x_qn, port)
+
+    def lookup_tlsa(ctx, job):
+        (myid, resolver) = ctx
+        (d, qn, port, shared) = job
+        try:
+            with survey_trace.active(d.trace, survey_trace.target_key(qn, port)):
+                lookup_target(d, qn, port, shared, resolver, myid)
+        finally:
+            d.release()
+
+    def lookup_target(d, qn, port, shared, resolver, myid):
+        # shared: an MX/SRV target, see target_query
+        if shared:
+            (probe, referrers) = targets.claim((qn, port), d.qn)
+            write_targets(referrers, qn, port)
+            if not probe:
+                wait_target((qn, port), d.lineno)
+                return
+        fetching = False
+        try:
+            fetching = probe_target(d, qn, port, shared, resolver, myid)
+        finally:
+            # otherwise match_addr records it after the last address
+            if shared and not fetching:
+                targets.recorded((qn, port))
+
+    def probe_target(d, qn, port, shared, resolver, myid):
+        # returns True if the target's addresses went to the fetch stage
+        answers = send_query(resolver, fmt_tlsa_name(qn, port), 'TLSA', myid)
+        if shared:
+            write_targets(targets.done((qn, port), answers != None), qn, port)
+        if answers == None or carry_forward(qn, port, answers, myid):
+            return False
+        addrs = lookup_addrs(qn, resolver, myid)
+        if len(addrs) == 0:
+            write_db(qn, port, answers, 'NO-IP')
+            return False
+        t = PipelineTarget(qn, port, answers, addrs, shared)
+        for addr in addrs:
+            d.hold()
+            fetch.put((d, t, addr))
+        return True
+
+    def fetch_addr(ctx, job):
+        (myid, resolver) = ctx
+        (d, t, addr) = job
+        r = ('NO-CERT', None, None)
+        try:
+            with survey_trace.active(d.trace, survey_trace.target_key(t.qn, t.port)):
+                t.result.start(addr)
+                r = fetch_chains(t.qn, t.port, addr, myid)
+        finally:
+            # the domain's hold moves on with the job
+            match.put((d, t, addr) + r)
+
+    def match_addr(ctx, job):
+        (myid, resolver) = ctx
+        (d, t, addr, valid_info, sni_cert, norm_cert) = job
+        try:
+            with survey_trace.active(d.trace, survey_trace.target_key(t.qn, t.port)):
+                match_target(t, addr, valid_info, sni_cert, norm_cert, myid)
+        finally:
+            if t.matched() and t.shared:
+                targets.recorded((t.qn, t.port))
+            d.release()
+
+    def match_target(t, addr, valid_info, sni_cert, norm_cert, myid):
+        if valid_info == None:
+            with metrics.timer('is_valid_seconds'), survey_trace.span('valid', addr=addr):
+                valid_info = decide(t.qn, t.port, t.tlsa_ans,
+                                    digest_cache.chain(sni_cert) if sni_cert != None else None,
+                                    digest_cache.chain(norm_cert) if norm_cert != None else None,
+                                    myid)
+        write_addr(t.qn, t.port, addr, valid_info)
+        r = t.result.add(addr, valid_info, sni_cert, norm_cert)
+        if r != None:
+            (valid_info, sni_cert, norm_cert) = r
+            if sni_cert != None or norm_cert != None:
+                write_fetched(t.qn, t.port, TIMESTAMP)
+                if store_chains:
+                    write_chains(t.qn, t.port, sni_cert, norm_cert)
+            write_db(t.qn, t.port, t.tlsa_ans, valid_info)
+
+    stages = [pipeline.Stage('expand', workers['expand'], expand, max_queue, init, metrics),
+              pipeline.Stage('tlsa', workers['tlsa'], lookup_tlsa, max_queue, init, metrics),
+              pipeline.Stage('fetch', workers['fetch'], fetch_addr, max_queue, init, metrics),
+              pipeline.Stage('match', workers['match'], match_addr, max_queue, init, metrics)]
+    (expansion, lookup, fetch, match) = stages
+    for stage in stages:
+        stage.start()
+    for (lineno, l) in domain_input.read_domains(f, seen, shard):
+        if writer.error != None:
+            break
+        if journal != None:
+            if journal.is_done(lineno):
+                continue
+            journal.issue(lineno)
+        if is_debug:
+            print_err('[main]: %s\n' % l)
+        qn = rm_last_dot(l)
+        print_err('qn=' + qn + '\n')
+        d = PipelineDomain(qn, lineno, finish)
+        d.plan = domain_plan(qn)
+        if tracer != None:
+            d.trace = tracer.domain(qn, lineno)
+        with cv:
+            state['active'] += 1
+        if d.plan == 'skip':
+            d.release()
+            continue
+        expansion.put(d)
+    with cv:
+        while state['active'] > 0:
+            cv.wait(1)
+    print_err('stages: %s\n' % ' '.join(stage.stats() for stage in stages))
+    if in_fn != '-':
+        f.close()
+
+def shard_fn(out_fn, k):
+    # data/stats.2015-01-01.db -> data/stats.2015-01-01.3.db
+    (base, ext) = os.path.splitext(out_fn)
+    return '%s.%d%s' % (base, k, ext)
+
+def tlsa_survey_procs(in_fn, out_fn, procs, child_opts, seen=None, metrics_fn='', trace_fn='', capture_fn=''):
+    # one child survey per shard, each reading its domains from a pipe and
+    # writing its own database, all in the same round; merged at the end
+    global TIMESTAMP
+    children = []
+    for k in range(procs):
+        argv = [sys.executable, sys.argv[0]] + child_opts + ['-i', '-', '-o', shard_fn(out_fn, k), '--round', str(TIMESTAMP)]
+        if metrics_fn != '':
+            argv += ['--metrics', shard_fn(metrics_fn, k)]
+        if trace_fn != '':
+            argv += ['--trace', shard_fn(trace_fn, k)]
+        if capture_fn != '':
+            argv += ['--capture', shard_fn(capture_fn, k)]
+        children.append(subprocess.Popen(argv, stdin=subprocess.PIPE))
+    f = domain_input.open_input(in_fn)
+    for (lineno, l) in domain_input.read_domains(f, seen):
+        try:
+            children[domain_input.shard_of(l, procs)].stdin.write(l + '\n')
+        except IOError:
+            pass # the child died, counted as failed below
+    if in_fn != '-':
+        f.close()
+    failed = 0
+    for p in children:
+        p.stdin.close()
+    for p in children:
+        if p.wait() != 0:
+            failed += 1
+    if failed > 0:
+        print_err('[error] %d of %d shards failed, not merged\n' % (failed, procs))
+        return False
+    merge_shards.merge_db(sqldb, [shard_fn(out_fn, k) for k in range(procs)])
+    return True
+
 def tlsa_only_validation(in_fn, serv_ip, serv_port):
     global is_debug
     resolver = dns.resolver.Resolver(configure=False)
@@ -392,25 +1290,172 @@ def tlsa_only_validation(in_fn, serv_ip, serv_port):
     select_cur.close()
     select_db.close()
                 
+TlsaRecord = collections.namedtuple('TlsaRecord', ['usage', 'selector', 'mtype', 'cert'])
+
+revalidate_db = None # survey db holding the chains, one connection per pool worker
+
+def revalidate_init(in_fn):
+    global revalidate_db
+    revalidate_db = sqlite3.connect(in_fn)
+
+def load_der(h):
+    return str(revalidate_db.execute('select der from cert_der where hash=?', (h,)).fetchone()[0])
+
+def revalidate_target(job):
+    # runs in a pool worker: decide one target again from its stored chains
+    (key, old_info, records, links) = job
+    chains = {}
+    for (sni, position, h) in sorted(links):
+        chains.setdefault(sni, []).append(digest_cache.fetch(h.decode('hex'), lambda: load_der(h)))
+    return (key, old_info, records, decide(key[5], key[6], records, chains.get(1), chains.get(0), os.getpid()))
+
+def tlsa_revalidate(in_fn, procs):
+    # match the TLSA records of a survey db against the chains it stored
+    # (--store-chains) again, without any DNS or TLS; targets without
+    # chains (NO-IP, NO-CERT) keep their valid_info
+    global writer, TABLE_NAME
+    src = sqlite3.connect(in_fn, check_same_thread=False)
+    if src.execute("select count(*) from sqlite_master where type='table' and name=?", (TABLE_NAME + '_chain',)).fetchone()[0] == 0:
+        sys.exit('[error] %s has no stored chains, abort!' % in_fn)
+    links = {}
+    for row in src.execute('select timestamp, name, port, sni, position, hash from %s_chain' % TABLE_NAME):
+        links.setdefault(tuple(row[:3]), []).append(tuple(row[3:]))
+    sql = 'INSERT OR IGNORE INTO %s VALUES (?,?,?,?,?,?,?,?,?,?,?,?)' % TABLE_NAME
+    count = {'targets':0, 'kept':0, 'changed':0}
+
+    def jobs():
+        # consumed by the pool's feeder thread
+        rows = src.execute('select zone, year, month, day, timestamp, name, port, valid_info, cert_usage, selector, mtype, cert_info from %s order by timestamp, name, port' % TABLE_NAME)
+        for (key, group) in itertools.groupby(rows, lambda r: tuple(r[:7])):
+            group = list(group)
+            count['targets'] += 1
+            link = links.get(key[4:7])
+            if link == None:
+                count['kept'] += 1
+                writer.put(sql, group)
+                continue
+            records = []
+            for r in group:
+                rec = TlsaRecord(r[8], r[9], r[10], str(r[11]).decode('hex'))
+                if not rec in records:
+                    records.append(rec)
+            yield (key, group[0][7], records, link)
+
+    workers = multiprocessing.Pool(procs, revalidate_init, (in_fn,))
+    for (key, old_info, records, valid_info) in workers.imap_unordered(revalidate_target, jobs(), 64):
+        if old_info != valid_info:
+            count['changed'] += 1
+        writer.put(sql, [key + (valid_info, r.usage, r.selector, r.mtype, hexdump(r.cert)) for r in records])
+    workers.close()
+    workers.join()
+    src.close()
+    print_err('revalidated %d targets: %d changed, %d kept without chains\n' % (count['targets'], count['changed'], count['kept']))
+
 def usage(comm):
     print 'usage: %s [-htsioc]' % comm
     print '\t -h           print this message'
     print '\t -t  NUM      # of threads, default 10'
     print '\t -s  IP:PORT  server ip and port, like 1.2.3.4:53'
     print '\t              otherwise, using default DNS server'
+    print '\t              several servers are comma separated, queries'
+    print '\t              are spread over the healthy ones'
+    print '\t --transport=PROTO  udp (default), tcp or tls: keep persistent'
+    print '\t                    TCP or DNS-over-TLS connections to the'
+    print '\t                    servers and pipeline queries on them (give'
+    print '\t                    the DoT port with -s, e.g. 1.2.3.4:853)'
+    print '\t --transport-conns=NUM  connections per server, default 2'
+    print '\t --max-outstanding=NUM  max queries in flight per server,'
+    print '\t                        default 64, or -m with the async engine'
     print '\t -i  INPUT    input file, default is - (stdin)'
+    print '\t              .bz2, .gz and .xz files are read directly'
+    print '\t --journal=FILE   progress journal, default is OUTPUT.journal'
+    print '\t --resume         continue the round recorded in the journal,'
+    print '\t                  the input must be the same'
+    print '\t --procs=NUM      split the input over NUM child processes,'
+    print '\t                  each writing OUTPUT.<shard>, merged at the end'
+    print '\t --shard=K/N      only survey domains in shard K of N (for'
+    print '\t                  running shards on several hosts)'
+    print '\t --round=SEC      use SEC as the round timestamp, so that'
+    print '\t                  shards run separately share one round'
     print '\t -o  OUTPUT   output file, default is ./stats.db'
     print '\t -c  SCRIPT   a script to get server certs'
     print '\t              default is ./get_serv_cert.sh'
+    print '\t -n           fetch server certs in-process (SMTP/XMPP'
+    print '\t              STARTTLS, implicit TLS) instead of SCRIPT'
+    print '\t --port-map=P:Q,... with -n, connect to port Q for service'
+    print '\t                    port P (for test setups)'
+    print '\t --max-addrs=NUM    A and AAAA addresses of a target probed at'
+    print '\t                    once, default 4'
+    print '\t --sink=SPEC        where tlsa_rdata rows go, sqlite (default),'
+    print '\t                    parquet:DIR or arrow:DIR (needs pyarrow);'
+    print '\t                    may be given more than once'
+    print '\t --connect-timeout=SEC    TCP connect timeout of a cert fetch,'
+    print '\t                          default 5'
+    print '\t --handshake-timeout=SEC  STARTTLS and TLS handshake timeout,'
+    print '\t                          default 10; a cert script gets the sum'
+    print '\t --breaker=NUM      after NUM timeouts in a row skip an address'
+    print '\t                    and port (CIRCUIT-OPEN), 0 disables, default 3'
+    print '\t --breaker-cooldown=SEC  try a skipped address again after SEC,'
+    print '\t                    default 600'
+    print '\t --cert-cache=NUM   max cached cert chains, 0 disables,'
+    print '\t                    default 10000'
+    print '\t --cert-ttl=SEC     keep fetched chains SEC, default 21600'
+    print '\t --cert-fail-ttl=SEC  keep failed fetches SEC, default 600'
+    print '\t --dns-cache=NUM    max cached DNS answers, 0 disables,'
+    print '\t                    default 100000'
+    print '\t --max-neg-ttl=SEC  cap for NXDOMAIN/NODATA caching, default 3600'
+    print '\t --dedup=MB         skip repeated input domains with a Bloom'
+    print '\t                    filter of MB megabytes, default 0 (off)'
+    print '\t --signed=INDEX     signed zone index from signed_zones.py'
+    print '\t --unsigned=PLAN    for zones of covered TLDs missing from'
+    print '\t                    INDEX: skip (default) or cheap, only'
+    print '\t                    MX/SRV targets in signed zones'
+    print '\t --store-chains     keep fetched chains in the output (cert_der'
+    print '\t                    and tlsa_rdata_chain) for --revalidate'
+    print '\t --revalidate       match the TLSA records of INPUT, a survey'
+    print '\t                    db with stored chains, against them again'
+    print '\t                    in --procs processes (default: all CPUs),'
+    print '\t                    without network I/O'
+    print '\t --baseline=DB      incremental survey: targets whose TLSA'
+    print '\t                    RRset is unchanged since DB (e.g. the'
+    print '\t                    previous day) keep its valid_info without'
+    print '\t                    fetching certs'
+    print '\t --baseline-ttl=SEC refetch after SEC anyway, default 604800'
+    print '\t --reverify=FRAC    fraction of unchanged targets verified in'
+    print '\t                    full each day, default 0.1'
+    print '\t --progress=SEC     print a progress line every SEC, 0 disables,'
+    print '\t                    default 10'
+    print '\t --trace=FILE       append one JSON line per domain with its DNS'
+    print '\t                    queries, cert fetches, matching and writes'
+    print '\t                    and their latencies, see trace_report.py'
+    print '\t --capture=FILE     keep every DNS response in the archive FILE'
+    print '\t --replay=FILE,...  answer DNS queries from --capture archives'
+    print '\t                    instead of resolvers (threads and pipeline'
+    print '\t                    engines)'
+    print '\t --metrics=FILE     write stage latencies and counters at the'
+    print '\t                    end, Prometheus text if FILE ends in .prom,'
+    print '\t                    JSON otherwise'
     print '\t -v           only do validation, only work'
     print '\t              with input $X.$YEAR-$MONTH-$DAY.$Y.$Z'
+    print '\t -e  ENGINE   threads (default), async or pipeline'
+    print '\t -m  NUM      async engine: max DNS queries in flight,'
+    print '\t              default 1000'
+    print '\t --stage-workers=STAGE:NUM,...  pipeline engine: workers of the'
+    print '\t              expand (4), tlsa (16), fetch (-t) and match (2)'
+    print '\t              stages'
+    print '\t --stage-queue=NUM  pipeline engine: queue size of each stage,'
+    print '\t              default 1000'
 
 def get_serv(s):
     if not ':' in s:
         print_err('[error] -s must have argument like 1.2.3.4:53\n')
         sys.exit(1)
-    w = s.split(':')
-    return (w[0], int(w[1]))
+    w = s.rsplit(':', 1)
+    return (w[0].strip('[]'), int(w[1]))
+
+def get_servs(s):
+    # 1.2.3.4:53,[2001:db8::1]:53
+    return [get_serv(x) for x in s.split(',')]
 
 def init():
     global this_date, sqldb, sqldb_cur, db_lock, is_debug, serv_port, serv_ip, TABLE_NAME, TIMESTAMP
@@ -426,7 +1471,7 @@ def init():
 
 def main():
     try:
-        opts, args = getopt.getopt(sys.argv[1:], 'hdvt:s:i:o:c:', ['help', 'debug', 'valid', 'threads=', 'server=', 'input=', 'output=', 'cert='])
+        opts, args = getopt.getopt(sys.argv[1:], 'hdvnt:s:i:o:c:e:m:', ['help', 'debug', 'valid', 'native', 'threads=', 'server=', 'input=', 'output=', 'cert=', 'engine=', 'max-inflight=', 'cert-cache=', 'cert-ttl=', 'cert-fail-ttl=', 'dns-cache=', 'max-neg-ttl=', 'dedup=', 'journal=', 'resume', 'procs=', 'shard=', 'round=', 'max-outstanding=', 'signed=', 'unsigned=', 'store-chains', 'revalidate', 'baseline=', 'baseline-ttl=', 'reverify=', 'transport=', 'transport-conns=', 'metrics=', 'progress=', 'port-map=', 'max-addrs=', 'breaker=', 'breaker-cooldown=', 'connect-timeout=', 'handshake-timeout=', 'sink=', 'stage-workers=', 'stage-queue=', 'trace=', 'capture=', 'replay='])
     except getopt.GetoptError as err:
         print_err(str(err) + '\n')
         usage(sys.argv[0])
@@ -436,17 +1481,44 @@ def main():
     in_fn = '-'
     out_fn = './stats.db'
     init()
-    global sqldb, sqldb_cur, is_debug, serv_ip, serv_port, TABLE_NAME, cert_script
+    global sqldb, sqldb_cur, is_debug, serv_ip, serv_port, TABLE_NAME, cert_script, native_cert, chain_cache, answer_cache, writer, journal, this_date, TIMESTAMP, pool, port_map, max_addrs, breaker, connect_timeout, handshake_timeout, probe_pool, sinks, tracer, capture, replay, signed, unsigned_plan, store_chains, baseline, baseline_ttl, reverify, stream
     cert_script = './get_serv_cert.sh'
     only_validation = False
+    engine = 'threads'
+    max_inflight = 1000
+    chain_cache = cert_cache.CertCache()
+    answer_cache = dns_cache.DnsCache()
+    dedup_mb = 0
+    journal_fn = ''
+    resume = False
+    procs = 0
+    revalidate = False
+    baseline_fn = ''
+    transport = 'udp'
+    sink_specs = []
+    stage_workers = {'expand':4, 'tlsa':16, 'fetch':0, 'match':2} # fetch 0: -t
+    stage_queue = 1000
+    transport_conns = 2
+    metrics_fn = ''
+    trace_fn = ''
+    capture_fn = ''
+    replay_fns = []
+    progress = 10
+    shard = None
+    max_outstanding = 0
+    child_opts = []
     for o, a in opts:
+        if not o in ('-i', '--input', '-o', '--output', '--procs', '--dedup', '--journal', '--metrics', '--trace', '--capture'):
+            child_opts += [o, a] if a != '' else [o]
         if o in ('-h', '--help'):
             usage(sys.argv[0])
             sys.exit()
         elif o in ('-t', '--threads'):
             num_threads = int(a)
         elif o in ('-s', '--server'):
-            (serv_ip, serv_port) = get_serv(a)
+            servers = get_servs(a)
+            (serv_ip, serv_port) = servers[0]
+            pool = resolver_pool.ResolverPool(servers)
         elif o in ('-i', '--input'):
             in_fn = a
         elif o in ('-d', '--debug'):
@@ -455,30 +1527,248 @@ def main():
             out_fn = a
         elif o in ('-c', '--cert'):
             cert_script = a
+        elif o in ('-n', '--native'):
+            native_cert = True
         elif o in ('-v', '--valid'):
             only_validation = True
+        elif o in ('-e', '--engine'):
+            engine = a
+        elif o in ('-m', '--max-inflight'):
+            max_inflight = int(a)
+        elif o == '--cert-cache':
+            chain_cache.max_size = int(a)
+        elif o == '--cert-ttl':
+            chain_cache.ttl = int(a)
+        elif o == '--cert-fail-ttl':
+            chain_cache.fail_ttl = int(a)
+        elif o == '--dns-cache':
+            answer_cache.max_size = int(a)
+        elif o == '--max-neg-ttl':
+            answer_cache.max_neg_ttl = int(a)
+        elif o == '--dedup':
+            dedup_mb = int(a)
+        elif o == '--journal':
+            journal_fn = a
+        elif o == '--resume':
+            resume = True
+        elif o == '--procs':
+            procs = int(a)
+        elif o == '--shard':
+            shard = tuple(int(x) for x in a.split('/'))
+            if len(shard) != 2 or not 0 <= shard[0] < shard[1]:
+                sys.exit('[error] --shard must be K/N with 0 <= K < N, abort!')
+        elif o == '--max-outstanding':
+            max_outstanding = int(a)
+        elif o == '--store-chains':
+            store_chains = True
+        elif o == '--revalidate':
+            revalidate = True
+        elif o == '--max-addrs':
+            max_addrs = int(a)
+        elif o == '--stage-workers':
+            # fetch:64,tlsa:16
+            for m in a.split(','):
+                (name, num) = m.split(':')
+                if not name in stage_workers:
+                    sys.exit('[error] unknown stage[%s], abort!' % name)
+                stage_workers[name] = int(num)
+        elif o == '--stage-queue':
+            stage_queue = int(a)
+        elif o == '--sink':
+            sink_specs.append(a)
+        elif o == '--breaker':
+            breaker.threshold = int(a)
+        elif o == '--breaker-cooldown':
+            breaker.cooldown = int(a)
+        elif o == '--connect-timeout':
+            connect_timeout = float(a)
+        elif o == '--handshake-timeout':
+            handshake_timeout = float(a)
+        elif o == '--port-map':
+            # 443:10443,25:10025
+            port_map = dict(tuple(int(x) for x in m.split(':')) for m in a.split(','))
+        elif o == '--metrics':
+            metrics_fn = a
+        elif o == '--trace':
+            trace_fn = a
+        elif o == '--capture':
+            capture_fn = a
+        elif o == '--replay':
+            replay_fns = a.split(',')
+        elif o == '--progress':
+            progress = int(a)
+        elif o == '--transport':
+            transport = a
+        elif o == '--transport-conns':
+            transport_conns = int(a)
+        elif o == '--baseline':
+            baseline_fn = a
+        elif o == '--baseline-ttl':
+            baseline_ttl = int(a)
+        elif o == '--reverify':
+            reverify = float(a)
+        elif o == '--signed':
+            signed = signed_zones.SignedZones(a)
+        elif o == '--unsigned':
+            unsigned_plan = a
+        elif o == '--round':
+            TIMESTAMP = int(a)
+            this_date = datetime.datetime.fromtimestamp(TIMESTAMP)
+
+    if max_outstanding <= 0:
+        # the async engine never blocks on a full resolver, so let -m decide
+        max_outstanding = max_inflight if engine == 'async' else 64
+    elif engine == 'async' and pool != None and len(pool.resolvers) * max_outstanding < max_inflight:
+        print_err('[warn] only %d queries in flight with %d server(s) at --max-outstanding=%d\n' % (len(pool.resolvers) * max_outstanding, len(pool.resolvers), max_outstanding))
+    if pool != None:
+        pool.max_outstanding = max_outstanding
+    if engine not in ['threads', 'async', 'pipeline']:
+        sys.exit('[error] unknown engine[%s], abort!' % engine)
+    if transport not in ['udp', 'tcp', 'tls']:
+        sys.exit('[error] unknown transport[%s], abort!' % transport)
+    if unsigned_plan not in ['skip', 'cheap']:
+        sys.exit('[error] unknown unsigned plan[%s], abort!' % unsigned_plan)
+    if stage_queue < 1 or min(stage_workers.values()) < 0 or stage_workers['expand'] * stage_workers['tlsa'] * stage_workers['match'] == 0:
+        sys.exit('[error] every stage needs a worker and a queue, abort!')
+    if (capture_fn != '' or len(replay_fns) > 0) and engine == 'async':
+        sys.exit('[error] --capture and --replay work with the threads and pipeline engines, abort!')
+    if capture_fn != '' and len(replay_fns) > 0:
+        sys.exit('[error] --capture and --replay do not go together, abort!')
+    if max_addrs < 1:
+        sys.exit('[error] max_addrs[%d] < 1, abort!' % max_addrs)
+    if max_inflight < 1:
+        sys.exit('[error] max_inflight[%d] < 1, abort!' % max_inflight)
 
     if is_debug:
         print_err('serv_ip[%s], serv_port[%d], input[%s], output[%s], threads[%d], cert_script[%s]\n' % (serv_ip if serv_ip != '' else 'default', serv_port, in_fn, out_fn, num_threads, cert_script))
     if in_fn != '-' and not os.path.isfile(in_fn):
         sys.exit('[error] input file %s does not exist!' % in_fn)
 
-    if not os.path.isfile(cert_script):
+    if revalidate and in_fn == '-':
+        sys.exit('[error] --revalidate needs a survey db as input, abort!')
+    if not native_cert and not revalidate and not os.path.isfile(cert_script):
         sys.exit('[error] cert_script[%s] does not exist, abort!' % cert_script)
     
     sqldb = sqlite3.connect(out_fn, check_same_thread=False)
     sqldb_cur = sqldb.cursor()
-    sql_stat = "CREATE TABLE if not exists " + TABLE_NAME + " (zone text, year int, month int, day int, timestamp, name text, port int, valid_info text, cert_usage int, selector int, mtype int, cert_info);"
-    sqldb_cur.execute(sql_stat)
-    sql_stat = "CREATE UNIQUE INDEX if not exists " + TABLE_NAME + "_uniq ON " + TABLE_NAME + "(zone, year, month, day, timestamp, name, port, valid_info, cert_usage, selector, mtype, cert_info);"
-    sqldb_cur.execute(sql_stat)
-    sqldb.commit()
+    sqldb_cur.execute('PRAGMA journal_mode=WAL').fetchall()
+    db_writer.create_tables(sqldb, TABLE_NAME)
+    if store_chains:
+        db_writer.create_chain_tables(sqldb, TABLE_NAME)
+    # every chain fetch is kept, so any round can be tomorrow's baseline
+    db_writer.create_fetch_table(sqldb, TABLE_NAME)
+    if baseline_fn != '' and not os.path.isfile(baseline_fn):
+        sys.exit('[error] baseline %s does not exist, abort!' % baseline_fn)
+    seen = None
+    if dedup_mb > 0:
+        seen = domain_input.BloomFilter(dedup_mb * 8 * 1024 * 1024)
+    if procs > 1 and not only_validation and not revalidate:
+        print_err('start @ ' + str(datetime.datetime.now()) + '\n')
+        ok = tlsa_survey_procs(in_fn, out_fn, procs, child_opts, seen, metrics_fn, trace_fn, capture_fn)
+        print_err('end @ ' + str(datetime.datetime.now()) + '\n')
+        sqldb.close()
+        sys.exit(0 if ok else 1)
+    if baseline_fn != '' and not only_validation and not revalidate:
+        baseline = load_baseline(baseline_fn)
+        print_err('baseline %s: %d targets\n' % (baseline_fn, len(baseline)))
+    if transport != 'udp' and not revalidate:
+        stream = dns_stream.StreamTransport(transport == 'tls', transport_conns)
+        if pool == None:
+            pool = resolver_pool.ResolverPool([(ns, 53 if transport == 'tcp' else 853) for ns in dns.resolver.Resolver().nameservers], max_outstanding)
+    if len(replay_fns) > 0:
+        try:
+            replay = dns_archive.Archive(replay_fns)
+        except (IOError, ValueError) as e:
+            sys.exit('[error] --replay: %s, abort!' % str(e))
+    if capture_fn != '' and not revalidate:
+        try:
+            capture = dns_archive.ArchiveWriter(capture_fn)
+        except (IOError, ValueError) as e:
+            sys.exit('[error] --capture: %s, abort!' % str(e))
+    writer = db_writer.DbWriter(sqldb, metrics=metrics)
+    if trace_fn != '' and not revalidate and not only_validation:
+        tracer = survey_trace.Tracer(trace_fn)
+    writer.start()
+    metrics.gauge('writer_queue', writer.queue.qsize)
+    if max_addrs > 1 and (engine != 'pipeline' or only_validation) and not revalidate:
+        # the pipeline engine has its fetch stage instead
+        probe_pool = pipeline.Stage('probe', num_threads * max_addrs, lambda ctx, job: job(), num_threads * max_addrs, None, metrics)
+        probe_pool.start()
+    try:
+        sinks = [output_sink.open_sink(spec, writer, TABLE_NAME) for spec in (sink_specs if len(sink_specs) > 0 else ['sqlite'])]
+    except ValueError as e:
+        sys.exit('[error] %s, abort!' % str(e))
+    if progress > 0:
+        metrics.start_reporter(progress)
+    if not only_validation and not revalidate:
+        if journal_fn == '':
+            journal_fn = out_fn + '.journal'
+        journal = survey_journal.Journal(journal_fn, defer=checkpoint)
+        if resume:
+            if not journal.load():
+                sys.exit('[error] no journal %s to resume, abort!' % journal_fn)
+            (TIMESTAMP, dy, dm, dd) = journal.round
+            this_date = datetime.datetime(dy, dm, dd)
+            print_err('[warn] resume round %d from line %d\n' % (TIMESTAMP, journal.mark))
+        journal.open(TIMESTAMP, this_date.year, this_date.month, this_date.day)
     print_err('start @ ' + str(datetime.datetime.now()) + '\n')
-    if only_validation:
-        print_err('[warn] only validation!\n')
-        tlsa_only_validation(in_fn, serv_ip, serv_port)
-    else:
-        tlsa_survey(in_fn, serv_ip, serv_port, num_threads)
+    try:
+        try:
+            if only_validation:
+                print_err('[warn] only validation!\n')
+                tlsa_only_validation(in_fn, serv_ip, serv_port)
+            elif revalidate:
+                tlsa_revalidate(in_fn, procs if procs > 0 else multiprocessing.cpu_count())
+            elif engine == 'async':
+                tlsa_survey_async(in_fn, serv_ip, serv_port, num_threads, max_inflight, seen, shard)
+            elif engine == 'pipeline':
+                if stage_workers['fetch'] == 0:
+                    stage_workers['fetch'] = num_threads
+                tlsa_survey_pipeline(in_fn, serv_ip, serv_port, stage_workers, stage_queue, seen, shard)
+            else:
+                tlsa_survey(in_fn, serv_ip, serv_port, num_threads, seen, shard)
+        finally:
+            if probe_pool != None:
+                # probes that outlived their target
+                probe_pool.join()
+            for sink in sinks:
+                sink.close()
+            if tracer != None:
+                tracer.close()
+            if capture != None:
+                capture.close()
+            writer.close()
+            if journal != None:
+                journal.close()
+    except db_writer.DbWriterError as e:
+        # the journal is not flushed, --resume goes on from the last commit
+        sys.exit('[error] %s, abort!' % str(e))
+    print_err('db writer: %s\n' % writer.stats())
+    print_err('sinks: %s\n' % ', '.join(sink.stats() for sink in sinks))
+    if tracer != None:
+        print_err('trace: %d domains to %s\n' % (tracer.domains, trace_fn))
+    if capture != None:
+        print_err('dns capture: %s\n' % capture.stats())
+    if replay != None:
+        print_err('dns replay: %s\n' % replay.stats())
+    if seen != None:
+        print_err('dedup: %d domains, false positive rate ~%.2g\n' % (seen.added, seen.fp_rate()))
+    print_err('probe targets: %s\n' % targets.stats())
+    print_err('circuit breaker: %s\n' % breaker.stats())
+    print_err('cert cache: %s\n' % chain_cache.stats())
+    print_err('cert digests: %s\n' % digest_cache.stats())
+    print_err('dns cache: %s\n' % answer_cache.stats())
+    if pool != None:
+        print_err('resolvers: %s\n' % pool.stats())
+    if stream != None:
+        print_err('transport: %s\n' % stream.stats())
+    if baseline != None:
+        print_err('baseline: %d carried forward, %d verified\n' % (carry_count['carried'], carry_count['verified']))
+    if signed != None:
+        print_err('signed zones: %d full, %d cheap, %d skipped\n' % (plan_count['full'], plan_count['cheap'], plan_count['skip']))
+    print_err(metrics.progress() + '\n')
+    if metrics_fn != '':
+        metrics.dump(metrics_fn)
     print_err('end @ ' + str(datetime.datetime.now()) + '\n')
     sqldb.close()
 
@@ -44,13 +44,24 @@ mkdir -p $DATA_DIR
 DB="$DATA_DIR/stats.$DATE.db"
 THREAD_NUM="20"
 
-# script to get server certs using openssl
-CERT_SCRIPT="$SCRIPT_DIR/get_serv_cert.sh"
+# incremental when yesterday's survey is there: unchanged targets keep
+# yesterday's result, a tenth of them are verified again
+BASELINE=""
+PREV_DB="$DATA_DIR/stats.`date -d yesterday +%Y-%m-%d`.db"
+if test -f $PREV_DB ; then
+	BASELINE="--baseline=$PREV_DB"
+fi
+
+# server certs are fetched in-process (-n), get_serv_cert.sh is only
+# needed when -c is used instead
+cat $DOMAIN_LIST | python $SCRIPT_DIR/tlsa_survey.py -d -s $NAME_SERVER:53 -t $THREAD_NUM -o $DB -n $BASELINE
 
-cat $DOMAIN_LIST | python $SCRIPT_DIR/tlsa_survey.py -d -s $NAME_SERVER:53 -t $THREAD_NUM -o $DB -c $CERT_SCRIPT
+# add the day to the history db, which keeps the per-day counts too
+HISTORY_DB="$DATA_DIR/history.db"
+python $SCRIPT_DIR/tlsa_history.py -o $HISTORY_DB $DB
 
 # get tlsa zone and dnssec zone number
-python $SCRIPT_DIR/dnssec_tlsa_zone_num.py -i $DATA_DIR/dnssec_tlsa_zone_num.db -d $DATE -n 0 -p $SCRIPT_DIR
+python $SCRIPT_DIR/dnssec_tlsa_zone_num.py -i $DATA_DIR/dnssec_tlsa_zone_num.db -d $DATE -n 0 -p $SCRIPT_DIR -H $HISTORY_DB
 
 echo "tlsa survey is successful for $DATE" 1>&2
 exit 0
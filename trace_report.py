@@ -0,0 +1,115 @@
+#!/usr/bin/env python
+
+# Copyright (c) 2015, Verisign, Inc.
+# All rights reserved.
+# 
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+# 
+# * Redistributions of source code must retain the above copyright notice, this
+#   list of conditions and the following disclaimer.
+# 
+# * Redistributions in binary form must reproduce the above copyright notice,
+#   this list of conditions and the following disclaimer in the documentation
+#   and/or other materials provided with the distribution.
+# 
+# * Neither the name of tlsa-survey nor the names of its
+#   contributors may be used to endorse or promote products derived from
+#   this software without specific prior written permission.
+# 
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+# SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+# OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+# Report on --trace files of tlsa_survey.py: the slowest domains and the
+# slowest targets, each with the time spent per kind of work (dns, cert,
+# valid, write).  Work on a domain overlaps, so the parts can add up to
+# more than its wall-clock time.
+
+import sys, getopt, json
+import domain_input
+
+OPS = ['dns', 'cert', 'valid', 'write']
+
+def print_err(s):
+    sys.stderr.write(s)
+
+def breakdown(spans):
+    # op -> [count, seconds]
+    b = dict((op, [0, 0.0]) for op in OPS)
+    for s in spans:
+        e = b.setdefault(s['op'], [0, 0.0])
+        e[0] += 1
+        e[1] += s['dur']
+    return b
+
+def fmt_breakdown(b):
+    return ' '.join('%s %d/%.3fs' % (op, b[op][0], b[op][1]) for op in OPS if b[op][0] > 0)
+
+def read_traces(fns):
+    for fn in fns:
+        f = domain_input.open_input(fn)
+        for l in f:
+            l = l.strip()
+            if l == '':
+                continue
+            try:
+                yield json.loads(l)
+            except ValueError:
+                print_err('[warn] bad trace line in %s skipped\n' % fn)
+        if fn != '-':
+            f.close()
+
+def report(fns, top):
+    domains = []
+    targets = []
+    for r in read_traces(fns):
+        spans = r['spans'] + [s for ss in r['targets'].values() for s in ss]
+        domains.append((r['dur'], r['domain'], breakdown(spans)))
+        for (key, ss) in r['targets'].items():
+            # wall-clock time from the target's first span to its last
+            wall = max(s['t'] + s['dur'] for s in ss) - min(s['t'] for s in ss)
+            slow = max(ss, key=lambda s: s['dur'])
+            targets.append((wall, key, r['domain'], breakdown(ss), slow))
+    print '# %d slowest of %d domains' % (min(top, len(domains)), len(domains))
+    for (dur, name, b) in sorted(domains, reverse=True)[:top]:
+        print '%8.3fs %s %s' % (dur, name, fmt_breakdown(b))
+    print
+    print '# %d slowest of %d targets' % (min(top, len(targets)), len(targets))
+    for (wall, key, name, b, slow) in sorted(targets, reverse=True)[:top]:
+        detail = ' '.join('%s=%s' % (k, slow[k]) for k in sorted(slow) if not k in ('op', 't', 'dur'))
+        print '%8.3fs %s (%s) %s; slowest %s %.3fs %s' % (wall, key, name, fmt_breakdown(b), slow['op'], slow['dur'], detail)
+
+def usage(comm):
+    print 'usage: %s [-n NUM] TRACE...' % comm
+    print '\t -h           print this message'
+    print '\t -n  NUM      domains and targets listed, default 20'
+
+def main():
+    try:
+        opts, args = getopt.getopt(sys.argv[1:], 'hn:', ['help', 'top='])
+    except getopt.GetoptError as err:
+        print_err(str(err) + '\n')
+        usage(sys.argv[0])
+        sys.exit(1)
+    top = 20
+    for o, a in opts:
+        if o in ('-h', '--help'):
+            usage(sys.argv[0])
+            sys.exit()
+        elif o in ('-n', '--top'):
+            top = int(a)
+    if len(args) == 0:
+        usage(sys.argv[0])
+        sys.exit(1)
+    report(args, top)
+
+if __name__ == "__main__":
+    main()